@@ -0,0 +1,150 @@
+"""Capture of raw input reports, and replay of these captures through the Controller / VirtualController pipeline
+
+Capture file layout (little endian) :
+    header : magic "S2CAP", version (u8), capture start unix time (f64)
+    records : type (u8), timestamp in seconds since capture start (f64), controller id (u16), payload length (u16), payload
+A RECORD_CONTROLLER record, containing the controller address and data as json, is written before the first input report of each controller.
+"""
+import asyncio
+import json
+import logging
+import mmap
+import struct
+import sys
+import time
+from controller_cache import CachedControllerData
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b"S2CAP"
+CAPTURE_VERSION = 1
+HEADER_STRUCT = struct.Struct("<5sBd")
+RECORD_STRUCT = struct.Struct("<BdHH")
+
+RECORD_CONTROLLER = 1
+RECORD_INPUT_REPORT = 2
+
+# Seconds between flushes of the capture file
+FLUSH_INTERVAL = 1
+
+class CaptureWriter:
+    """Appends raw input reports received from controllers to a capture file"""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.file = open(file_path, "wb")
+        self.start_time = time.perf_counter()
+        self.last_flush_time = self.start_time
+        self.controller_ids = {}
+        self.file.write(HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time()))
+        logger.info(f"Capturing input reports to {file_path}")
+
+    def write_record(self, record_type: int, timestamp: float, controller_id: int, payload: bytes):
+        self.file.write(RECORD_STRUCT.pack(record_type, timestamp, controller_id, len(payload)))
+        self.file.write(payload)
+
+    def write_input_report(self, controller, data: bytes):
+        if self.file is None:
+            return
+        now = time.perf_counter()
+        controller_id = self.controller_ids.get(controller)
+        if controller_id is None:
+            controller_id = self.controller_ids[controller] = len(self.controller_ids)
+            controller_record = {"address": controller.device.address, **controller.controller_data.to_dict()}
+            self.write_record(RECORD_CONTROLLER, now - self.start_time, controller_id, json.dumps(controller_record).encode())
+
+        self.write_record(RECORD_INPUT_REPORT, now - self.start_time, controller_id, data)
+
+        if now - self.last_flush_time > FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush_time = now
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class CaptureReader:
+    """Reads a capture file through a memory mapping"""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        with open(file_path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.start_unix_time = HEADER_STRUCT.unpack_from(self.mmap)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise Exception(f"{file_path} is not a supported capture file")
+
+    def records(self):
+        """Yields (type, timestamp, controller id, payload) for each record"""
+        data = self.mmap
+        offset = HEADER_STRUCT.size
+        end = len(data)
+        while offset + RECORD_STRUCT.size <= end:
+            record_type, timestamp, controller_id, length = RECORD_STRUCT.unpack_from(data, offset)
+            offset += RECORD_STRUCT.size
+            if offset + length > end:
+                # Truncated capture
+                break
+            yield record_type, timestamp, controller_id, data[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.mmap.close()
+
+async def replay(file_path: str, speed: float = 1, virtual: bool = True):
+    """Feed the input reports of a capture to controllers, at <speed> times the original speed, or as fast as possible if <speed> is 0.
+    If <virtual> is set, controllers are assigned to virtual controllers like when discovered
+    Returns the number of replayed reports
+    """
+    from controller import Controller
+    from virtual_controller import assign_virtual_controller, MAX_VIRTUAL_CONTROLLERS
+
+    reader = CaptureReader(file_path)
+    controllers: dict[int, Controller] = {}
+    virtual_controllers = [None] * MAX_VIRTUAL_CONTROLLERS
+    report_count = 0
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    try:
+        for record_type, timestamp, controller_id, payload in reader.records():
+            if speed:
+                delay = start_time + timestamp / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            if record_type == RECORD_CONTROLLER:
+                controller_record = json.loads(payload)
+                controller = Controller.create_from_capture(controller_record.pop("address"), CachedControllerData.from_dict(controller_record))
+                controllers[controller_id] = controller
+                if virtual:
+                    virtual_controller = assign_virtual_controller(virtual_controllers, controller)
+                    await virtual_controller.init_added_controller(controller)
+                logger.info(f"Replaying {controller}")
+            elif record_type == RECORD_INPUT_REPORT:
+                controllers[controller_id].handle_input_report(payload)
+                report_count += 1
+    finally:
+        reader.close()
+        for controller in controllers.values():
+            logger.info(f"Input latency of {controller}\n{controller.input_latency.format_summary()}")
+            logger.info(f"Reports of {controller} : {controller.report_stats.format_summary()}")
+        for vc in virtual_controllers:
+            if vc is not None:
+                vc.vibration_dispatcher.stop()
+    return report_count
+
+def main(args: list[str]):
+    """Usage: capture.py <capture file> [speed (default 1, 0 for as fast as possible)] [--no-virtual]"""
+    if len(args) < 1:
+        print(main.__doc__)
+        return 1
+    virtual = "--no-virtual" not in args
+    args = [a for a in args if a != "--no-virtual"]
+    speed = float(args[1]) if len(args) > 1 else 1
+    start_time = time.perf_counter()
+    report_count = asyncio.run(replay(args[0], speed, virtual))
+    duration = time.perf_counter() - start_time
+    print(f"Replayed {report_count} reports in {duration:.3f}s ({report_count / duration:.0f} reports/s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
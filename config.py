@@ -1,6 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import MappingProxyType
 import os
-import yaml
+import threading
 import logging
 import sys
 
@@ -103,18 +104,54 @@ DS4_DPAD = [
     "DOWN", "UP", "LEFT", "RIGHT"
 ]
 
-@dataclass
+DS4_DPAD_DIRECTIONS = {
+    frozenset(): 0x8,
+    frozenset(["UP"]): 0x0,
+    frozenset(["UP", "RIGHT"]): 0x1,
+    frozenset(["RIGHT"]): 0x2,
+    frozenset(["DOWN", "RIGHT"]): 0x3,
+    frozenset(["DOWN"]): 0x4,
+    frozenset(["DOWN", "LEFT"]): 0x5,
+    frozenset(["LEFT"]): 0x6,
+    frozenset(["UP", "LEFT"]): 0x7,
+}
+
+# DS4 dpad value indexed by a bit mask of pressed DS4_DPAD directions, invalid combinations are released
+DS4_DPAD_VALUES = [
+    DS4_DPAD_DIRECTIONS.get(frozenset(d for i, d in enumerate(DS4_DPAD) if mask & (1 << i)), 0x8)
+    for mask in range(1 << len(DS4_DPAD))
+]
+
+# Layout of a compiled button table entry
+TABLE_BUTTONS_MASK = 0xFFFF
+TABLE_SPECIAL_SHIFT = 16
+TABLE_DPAD_SHIFT = 24
+TABLE_LEFT_TRIGGER = 1 << 28
+TABLE_RIGHT_TRIGGER = 1 << 29
+
+DEFAULT_MAX_REPORT_INTERVAL = 0.1
+
+# Seconds between two checks of the config file for changes
+CONFIG_WATCH_INTERVAL = 1
+
+def set_fields(obj, **values):
+    """Sets fields of a frozen dataclass, for its __init__"""
+    for name, value in values.items():
+        object.__setattr__(obj, name, value)
+
+@dataclass(frozen=True)
 class ButtonConfig:
-    buttons: dict[int, int]
-    left_trigger: list[int]
-    right_trigger: list[int]
-    dpad: dict[int, str]
+    buttons: MappingProxyType[int, int]
+    left_trigger: tuple[int, ...]
+    right_trigger: tuple[int, ...]
+    dpad: MappingProxyType[int, str]
+    tables: tuple[tuple[int, ...], ...] = field(repr=False)
 
     def __init__(self, buttons_dict: dict[str, str], is_usb: bool = False):
-        self.buttons = {}
-        self.left_trigger = []
-        self.right_trigger = []
-        self.dpad = {}
+        buttons = {}
+        left_trigger = []
+        right_trigger = []
+        dpad = {}
 
         for k, v in buttons_dict.items():
             if k not in (is_usb and SWITCH_BUTTONS_USB or SWITCH_BUTTONS):
@@ -123,62 +160,73 @@ class ButtonConfig:
             switch_button = (is_usb and SWITCH_BUTTONS_USB or SWITCH_BUTTONS)[k]
             if v is not None:
                 if v == "LT":
-                    self.left_trigger.append(switch_button)
+                    left_trigger.append(switch_button)
                 elif v == "RT":
-                    self.right_trigger.append(switch_button)
+                    right_trigger.append(switch_button)
                 elif v in DS4_DPAD:
-                    self.dpad[switch_button] = v
+                    dpad[switch_button] = v
                 else:
                     if v not in DS4_BUTTONS:
                         raise Exception(f"Unknown XB button name in config: {v}")
                     ds4_button = DS4_BUTTONS[v]
 
-                    self.buttons[switch_button] = ds4_button
+                    buttons[switch_button] = ds4_button
+
+        set_fields(self, buttons=MappingProxyType(buttons), left_trigger=tuple(left_trigger), right_trigger=tuple(right_trigger),
+                   dpad=MappingProxyType(dpad))
+        set_fields(self, tables=self.compile_tables())
+
+    def compile_tables(self):
+        """Returns 4 tables of 256 entries, one per byte of the switch buttons value.
+        Each entry combines the DS4 buttons, special buttons, dpad directions and triggers of every switch button set in that byte
+        """
+        tables = []
+        for byte_index in range(4):
+            table = []
+            for byte_value in range(256):
+                switch_buttons = byte_value << (8 * byte_index)
+                entry = 0
+                for switch_button, ds4_button in self.buttons.items():
+                    if switch_buttons & switch_button:
+                        if ds4_button == DS4_BUTTONS["TOUCHPAD"] or ds4_button == DS4_BUTTONS["GUIDE"]:
+                            entry |= ds4_button << TABLE_SPECIAL_SHIFT
+                        else:
+                            entry |= ds4_button
+                for switch_button, dpad_key in self.dpad.items():
+                    if switch_buttons & switch_button:
+                        entry |= 1 << (DS4_DPAD.index(dpad_key) + TABLE_DPAD_SHIFT)
+                if any(b & switch_buttons for b in self.left_trigger):
+                    entry |= TABLE_LEFT_TRIGGER
+                if any(b & switch_buttons for b in self.right_trigger):
+                    entry |= TABLE_RIGHT_TRIGGER
+                table.append(entry)
+            tables.append(tuple(table))
+        return tuple(tables)
 
     def convert_buttons(self, switch_buttons: int):
-        DS4_BUTTONS_ = 0x0000
-        DS4_SPECIAL = 0x0000
-        DS4_DPAD = []
-        for switch_button, ds4_button in self.buttons.items():
-            if switch_buttons & switch_button:
-                if ds4_button == DS4_BUTTONS["TOUCHPAD"] or ds4_button == DS4_BUTTONS["GUIDE"]:
-                    DS4_SPECIAL |= ds4_button
-                else:
-                    DS4_BUTTONS_ |= ds4_button
-
-        for switch_button, dpad_key in self.dpad.items():
-            if switch_buttons & switch_button:
-                DS4_DPAD.append(dpad_key)
-
-        left_trigger = any([b & switch_buttons for b in self.left_trigger])
-        right_trigger = any([b & switch_buttons for b in self.right_trigger])
-
-        dpad_value = {
-            frozenset(): 0x8,
-            frozenset(["UP"]): 0x0,
-            frozenset(["UP", "RIGHT"]): 0x1,
-            frozenset(["RIGHT"]): 0x2,
-            frozenset(["DOWN", "RIGHT"]): 0x3,
-            frozenset(["DOWN"]): 0x4,
-            frozenset(["DOWN", "LEFT"]): 0x5,
-            frozenset(["LEFT"]): 0x6,
-            frozenset(["UP", "LEFT"]): 0x7,
-        }.get(frozenset(d.upper() for d in DS4_DPAD), 0x8)
-
-        return DS4_BUTTONS_, DS4_SPECIAL, dpad_value, left_trigger, right_trigger
-
-@dataclass
+        """Returns DS4 (buttons, special buttons, dpad value, left trigger, right trigger) for a switch buttons value"""
+        table_0, table_1, table_2, table_3 = self.tables
+        value = (table_0[switch_buttons & 0xFF] | table_1[(switch_buttons >> 8) & 0xFF] |
+                 table_2[(switch_buttons >> 16) & 0xFF] | table_3[(switch_buttons >> 24) & 0xFF])
+
+        return (value & TABLE_BUTTONS_MASK, (value >> TABLE_SPECIAL_SHIFT) & 0xFF, DS4_DPAD_VALUES[(value >> TABLE_DPAD_SHIFT) & 0xF],
+                bool(value & TABLE_LEFT_TRIGGER), bool(value & TABLE_RIGHT_TRIGGER))
+
+@dataclass(frozen=True)
 class MouseButtonConfig:
     left_button: int
     middle_button: int
     right_button: int
 
     def __init__(self, buttons_dict: dict[str, str]):
-        self.left_button = SWITCH_BUTTONS[buttons_dict["left_button"]]
-        self.middle_button = SWITCH_BUTTONS[buttons_dict["middle_button"]]
-        self.right_button = SWITCH_BUTTONS[buttons_dict["right_button"]]
+        for k in ("left_button", "middle_button", "right_button"):
+            if buttons_dict.get(k) not in SWITCH_BUTTONS:
+                raise Exception(f"Unknown switch button name for mouse {k} in config: {buttons_dict.get(k)}")
+        set_fields(self, left_button=SWITCH_BUTTONS[buttons_dict["left_button"]],
+                   middle_button=SWITCH_BUTTONS[buttons_dict["middle_button"]],
+                   right_button=SWITCH_BUTTONS[buttons_dict["right_button"]])
 
-@dataclass
+@dataclass(frozen=True)
 class MouseConfig:
     enabled: bool
     sensitivity: float
@@ -187,16 +235,28 @@ class MouseConfig:
     joycon_r_buttons: MouseButtonConfig
 
     def __init__(self, config_dict: dict[str, str]):
-        self.enabled = config_dict["enabled"]
-        self.sensitivity = config_dict["sensitivity"]
-        self.scroll_sensitivity = config_dict["scroll_sensitivity"]
         buttons_config = config_dict["buttons"]
-        self.joycon_l_buttons = MouseButtonConfig(buttons_config["left_joycon"])
-        self.joycon_r_buttons = MouseButtonConfig(buttons_config["right_joycon"])
+        set_fields(self, enabled=bool(config_dict["enabled"]),
+                   sensitivity=get_number(config_dict, "sensitivity", 0),
+                   scroll_sensitivity=get_number(config_dict, "scroll_sensitivity", 0),
+                   joycon_l_buttons=MouseButtonConfig(buttons_config["left_joycon"]),
+                   joycon_r_buttons=MouseButtonConfig(buttons_config["right_joycon"]))
+
 
+def get_number(config_dict: dict, key: str, minimum: float, maximum: float = None, default: float = None):
+    """Returns the number <key> of <config_dict>, raising if it is missing or out of [minimum, maximum]"""
+    value = config_dict.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise Exception(f"{key} must be a number in config, got {value!r}")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise Exception(f"{key} must be between {minimum} and {maximum} in config, got {value}" if maximum is not None else f"{key} must be at least {minimum} in config, got {value}")
+    return value
 
-@dataclass
+@dataclass(frozen=True)
 class Config:
+    """Validated settings along with their precomputed tables.
+    Shared between threads, a config and its button and mouse configs are frozen: a reload creates a new one
+    """
     combine_joycons: bool
     motion_controls: bool
     deadzone: int
@@ -205,26 +265,142 @@ class Config:
     single_joycon_r_config: ButtonConfig
     procon_config: ButtonConfig
     mouse_config: MouseConfig
+    capture_file: str
+    max_report_interval: float
+    frame_interval: float
+
+    def __init__(self, config: dict, is_usb: bool = False):
+        if not isinstance(config, dict):
+            raise Exception("Config is not a mapping")
+
+        buttons_config = config["buttons"]
+
+        set_fields(self,
+            combine_joycons=bool(config["combine_joycons"]),
+            deadzone=int(get_number(config, "deadzone", 0, 0x7FF)),
+            motion_controls=bool(config["motion_controls"]),
+
+            dual_joycons_config=ButtonConfig(buttons_config["dual_joycons"], is_usb),
+            single_joycon_l_config=ButtonConfig(buttons_config["single_joycon_l"], is_usb),
+            single_joycon_r_config=ButtonConfig(buttons_config["single_joycon_r"], is_usb),
+            procon_config=ButtonConfig(buttons_config["procon"], is_usb),
+
+            mouse_config=MouseConfig(config["mouse"]),
+
+            # Optional, seconds after which an unchanged report is sent again to the virtual controller
+            max_report_interval=get_number(config, "max_report_interval", 0, default=DEFAULT_MAX_REPORT_INTERVAL),
+
+            # Optional, seconds between reports sent to virtual controllers, 0 to send them as soon as inputs are received
+            frame_interval=get_number(config, "frame_interval", 0, default=0),
+
+            # Optional, path of a file to record input reports to, see capture.py
+            capture_file=config.get("capture_file"))
+
+def read_config(config_file_path: str, is_usb: bool = False):
+    import yaml
+    with open(config_file_path) as cf:
+        config = Config(yaml.safe_load(cf), is_usb)
+    logger.info(f"Config successfully read {config}")
+    return config
+
+# Settings that are only read when a controller connects, changing them doesn't affect the connected ones
+CONNECTION_SETTINGS = ("motion_controls", "capture_file", "frame_interval")
+
+# Read from the config file on first use
+current_config: Config = None
+config_lock = threading.Lock()
+config_listeners = []
+
+def get_config():
+    """Returns the current config. It can be replaced at any time, read it once and use that for a whole report"""
+    config = current_config
+    if config is None:
+        config = load_config()
+    return config
+
+def load_config():
+    with config_lock:
+        if current_config is None:
+            set_config(read_config(get_config_file_path(), is_usb))
+    return current_config
+
+def set_config(config: Config):
+    """Replace the current config, then call listeners with (previous config, config)"""
+    global current_config
+    previous_config = current_config
+    current_config = config
+    for listener in config_listeners:
+        try:
+            listener(previous_config, config)
+        except Exception:
+            logger.exception("Unable to apply config")
 
-    def __init__(self, config_file_path: str, is_usb: bool = False):
+def add_config_listener(listener):
+    """<listener> is called from the thread that replaced the config"""
+    config_listeners.append(listener)
 
-        with open(config_file_path) as cf:
-            config = yaml.safe_load(cf)
+class ConfigWatcher:
+    """Reloads the config file in a background thread when it is modified.
+    An invalid file is reported and the current config kept
+    """
+    def __init__(self, config_file_path: str, is_usb: bool = False, interval: float = CONFIG_WATCH_INTERVAL):
+        self.config_file_path = config_file_path
+        self.is_usb = is_usb
+        self.interval = interval
+        self.file_state = self.get_file_state()
+        self.pending_file_state = self.file_state
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread = None
 
-            self.combine_joycons = config["combine_joycons"]
-            self.deadzone = config["deadzone"]
-            self.motion_controls = config["motion_controls"]
+    def get_file_state(self):
+        try:
+            stat = os.stat(self.config_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
-            buttons_config = config["buttons"]
+    def check(self):
+        """Returns True if the config was reloaded.
+        A modified file is only read once it stayed the same for a whole interval, to not read it while it is being written
+        """
+        file_state = self.get_file_state()
+        pending_file_state = self.pending_file_state
+        self.pending_file_state = file_state
+        if file_state is None or file_state == self.file_state or file_state != pending_file_state:
+            return False
+        self.file_state = file_state
+        try:
+            config = read_config(self.config_file_path, self.is_usb)
+        except Exception as e:
+            logger.error(f"Invalid config in {self.config_file_path}, keeping the current one : {e}")
+            return False
+        previous_config = current_config
+        if config == previous_config:
+            return False
+        set_config(config)
+        changed_settings = [s for s in CONNECTION_SETTINGS if previous_config is not None and getattr(config, s) != getattr(previous_config, s)]
+        if changed_settings:
+            logger.info(f"Config reloaded, {', '.join(changed_settings)} will apply to newly connected controllers")
+        else:
+            logger.info("Config reloaded")
+        return True
 
-            self.dual_joycons_config = ButtonConfig(buttons_config["dual_joycons"], is_usb)
-            self.single_joycon_l_config = ButtonConfig(buttons_config["single_joycon_l"], is_usb)
-            self.single_joycon_r_config = ButtonConfig(buttons_config["single_joycon_r"], is_usb)
-            self.procon_config = ButtonConfig(buttons_config["procon"], is_usb)
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Unable to reload config")
 
-            self.mouse_config = MouseConfig(config["mouse"])
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="Config watcher", daemon=True)
+        self.thread.start()
 
-        logger.info(f"Config successfully read {self}")
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
 def get_resource(resource_path: str, resource_name = "resources"):
     # PyInstallerでonefile化された場合
@@ -238,4 +414,5 @@ def get_resource(resource_path: str, resource_name = "resources"):
 
     return os.path.join(base_path, resource_name, resource_path)
     
-CONFIG = Config(get_resource("config.yaml", "."), is_usb)
\ No newline at end of file
+def get_config_file_path():
+    return get_resource("config.yaml", ".")
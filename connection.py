@@ -0,0 +1,166 @@
+"""Management of the BLE connection parameters of controllers, according to the report rate they actually achieve and their activity
+"""
+import logging
+import sys
+from abc import ABC, abstractmethod
+from collections import deque
+from metrics import ReportStats
+
+logger = logging.getLogger(__name__)
+
+PROFILE_THROUGHPUT = "throughput_optimized"
+PROFILE_BALANCED = "balanced"
+PROFILE_POWER = "power_optimized"
+
+# Seconds between two evaluations of the connection
+EVALUATE_INTERVAL = 1
+# Minimum seconds between two requests, to let the link settle
+REQUEST_COOLDOWN = 5
+# The report rate is degraded when below this ratio of the best rate seen
+DEGRADED_RATE_RATIO = 0.7
+# Seconds without activity after which the connection is relaxed
+IDLE_BALANCED_DELAY = 30
+IDLE_POWER_DELAY = 300
+# Number of decisions kept
+DECISIONS_HISTORY = 50
+
+class ConnectionParametersBackend(ABC):
+    """Requests connection parameters to the OS"""
+    @abstractmethod
+    def request(self, profile: str):
+        """Returns True if the request was accepted"""
+
+    def close(self):
+        pass
+
+class WinRTConnectionParametersBackend(ConnectionParametersBackend):
+    """Windows 11 (build >= 22000) preferred connection parameters"""
+    def __init__(self, requester):
+        from winrt.windows.devices.bluetooth import BluetoothLEPreferredConnectionParameters, BluetoothLEPreferredConnectionParametersRequestStatus
+        self.requester = requester
+        self.parameters = BluetoothLEPreferredConnectionParameters
+        self.success_status = BluetoothLEPreferredConnectionParametersRequestStatus.SUCCESS
+        # The preference lasts as long as the request is not closed
+        self.current_request = None
+
+    @classmethod
+    def create(cls, client):
+        """Returns a backend for this bleak client if supported, None otherwise"""
+        if sys.platform != "win32" or sys.getwindowsversion().build < 22000:
+            return None
+        from bleak.backends.winrt.client import BleakClientWinRT
+        backend = client._backend
+        if not isinstance(backend, BleakClientWinRT):
+            return None
+        return cls(backend._requester)
+
+    def request(self, profile: str):
+        request = self.requester.request_preferred_connection_parameters(getattr(self.parameters, profile))
+        if self.current_request is not None:
+            self.current_request.close()
+        self.current_request = request
+        return request.status == self.success_status
+
+    def close(self):
+        if self.current_request is not None:
+            self.current_request.close()
+            self.current_request = None
+
+class FakeConnectionParametersBackend(ConnectionParametersBackend):
+    """Records requests, to exercise the policy without hardware"""
+    def __init__(self, accept: bool = True):
+        self.accept = accept
+        self.requests: list[str] = []
+
+    def request(self, profile: str):
+        self.requests.append(profile)
+        return self.accept
+
+class ConnectionManager:
+    """Requests throughput optimized parameters while a controller is used, requests them again when the report rate degrades,
+    and relaxes the connection when the controller is idle
+    """
+    def __init__(self, backend: ConnectionParametersBackend, report_stats: ReportStats):
+        self.backend = backend
+        self.report_stats = report_stats
+        self.profile: str = None
+        self.last_request_time: float = None
+        self.last_evaluate_time: float = None
+        self.last_activity_time: float = None
+        self.last_window: dict = None
+        self.best_rate = 0.0
+        self.requests = {PROFILE_THROUGHPUT: 0, PROFILE_BALANCED: 0, PROFILE_POWER: 0}
+        self.failed_requests = 0
+        self.degraded_windows = 0
+        self.decisions = deque(maxlen=DECISIONS_HISTORY)
+
+    def start(self, now: float):
+        self.last_activity_time = now
+        self.request(PROFILE_THROUGHPUT, "connected", now)
+
+    def request(self, profile: str, reason: str, now: float):
+        try:
+            accepted = self.backend.request(profile)
+        except Exception:
+            logger.debug("Connection parameters request failed", exc_info=True)
+            accepted = False
+        self.requests[profile] += 1
+        if not accepted:
+            self.failed_requests += 1
+        self.profile = profile
+        self.last_request_time = now
+        window = self.last_window
+        self.decisions.append((now, reason, profile, accepted, window["hz"] if window else None))
+        logger.info(f"Requested {profile} connection ({reason}) : {'accepted' if accepted else 'refused'}")
+
+    def on_report(self, now: float, active: bool):
+        """Called for every input report, <active> when the controller is being used"""
+        if active:
+            self.last_activity_time = now
+            if self.profile != PROFILE_THROUGHPUT:
+                # Don't wait for the cooldown when the controller is used again
+                self.request(PROFILE_THROUGHPUT, "active", now)
+                return
+
+        if self.last_evaluate_time is not None and now - self.last_evaluate_time < EVALUATE_INTERVAL:
+            return
+        self.last_evaluate_time = now
+        self.evaluate(now)
+
+    def evaluate(self, now: float):
+        idle_duration = now - self.last_activity_time
+        if idle_duration >= IDLE_POWER_DELAY:
+            if self.profile != PROFILE_POWER:
+                self.request(PROFILE_POWER, f"idle for {idle_duration:.0f}s", now)
+            return
+        if idle_duration >= IDLE_BALANCED_DELAY:
+            if self.profile not in (PROFILE_BALANCED, PROFILE_POWER):
+                self.request(PROFILE_BALANCED, f"idle for {idle_duration:.0f}s", now)
+            return
+
+        window = self.report_stats.last_window
+        if window is None or window is self.last_window:
+            return
+        self.last_window = window
+        if self.profile != PROFILE_THROUGHPUT:
+            return
+
+        rate = window["hz"]
+        if rate > self.best_rate:
+            self.best_rate = rate
+        elif rate < DEGRADED_RATE_RATIO * self.best_rate:
+            self.degraded_windows += 1
+            if now - self.last_request_time >= REQUEST_COOLDOWN:
+                self.request(PROFILE_THROUGHPUT, f"rate degraded to {rate:.1f}Hz (best {self.best_rate:.1f}Hz)", now)
+
+    def summary(self):
+        return {
+            "profile": self.profile,
+            "best_rate": self.best_rate,
+            "requests": dict(self.requests),
+            "failed_requests": self.failed_requests,
+            "degraded_windows": self.degraded_windows,
+        }
+
+    def close(self):
+        self.backend.close()
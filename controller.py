@@ -1,14 +1,25 @@
-from bleak import BleakScanner, BleakClient, BleakGATTCharacteristic
-from bleak.backends.device import BLEDevice
 import asyncio
 import logging
-import bluetooth
-import win32api
-import sys
-import win32con
+import struct
+import threading
+import time
+import weakref
+from collections import deque
 from dataclasses import dataclass
-from config import CONFIG, SWITCH_BUTTONS
-from utils import apply_calibration_to_axis, get_stick_xy, press_or_release_mouse_button, reverse_bits, signed_looping_difference_16bit, to_hex, decodeu, decodes, convert_mac_string_to_value
+from typing import TYPE_CHECKING
+from config import Config, SWITCH_BUTTONS, add_config_listener, get_config
+from controller_cache import CONTROLLER_CACHE, CachedControllerData
+from metrics import InputLatency, ReportStats
+from motion import MotionEstimator
+from connection import ConnectionManager, WinRTConnectionParametersBackend
+from utils import apply_calibration_to_axis, get_stick_xy, reverse_bits, to_hex, decodeu, convert_mac_string_to_value
+from mouse import MouseOutput, MouseState, create_default_mouse_sink
+from vibration import RUMBLE_TO_AMPLITUDE, encode_sample
+
+# bleak and bluetooth are slow to import and not needed to replay captures or over USB, they are imported when first used
+if TYPE_CHECKING:
+    from bleak import BleakClient, BleakGATTCharacteristic
+    from bleak.backends.device import BLEDevice
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
@@ -62,6 +73,12 @@ FEATUER_BATTERY_CURRENT = 0x20
 FEATURE_MOUSE = 0x10
 FEATURE_MAGNOMETER = 0x80
 
+# Seconds to wait for a command response
+DEFAULT_COMMAND_TIMEOUT = 2
+COMMAND_TIMEOUTS = {
+    COMMAND_PAIR: 5,
+}
+
 # Addresses in controller memory
 ADDRESS_CONTROLLER_INFO = 0x00013000
 CALIBRATION_JOYSTICK_1 = 0x0130A8
@@ -83,29 +100,79 @@ LED_PATTERN = {
 ### Dataclasses
 
 @dataclass
-class MouseState:
-    x: int
-    y: int
-    lb: bool
-    mb: bool 
-    rb: bool
+class ControllerDevice:
+    """Device of a controller that is not connected by bluetooth (USB, replayed capture), has the fields of a BLEDevice that are used"""
+    address: str
+    name: str = None
+
+# Stick axis values are 12 bits
+STICK_AXIS_RANGE = 0x1000
 
 @dataclass
 class StickCalibrationData:
     center: tuple[int, int]
     max: tuple[int, int]
     min: tuple[int, int]
-
-    def __init__(self, data: bytes):
+    deadzone: int
+    x_values: list[float]
+    y_values: list[float]
+    x_ds4: bytes
+    y_ds4: bytes
+    x_ds4_inverted: bytes
+    y_ds4_inverted: bytes
+
+    def __init__(self, data: bytes, deadzone: int = None):
         self.center = get_stick_xy(data[0:3])
         self.max = get_stick_xy(data[3:6])
         self.min = get_stick_xy(data[6:9])
+        self.deadzone = get_config().deadzone if deadzone is None else deadzone
+        self.build_tables()
 
-    def apply_calibration(self, raw_values: tuple[int, int]):
-        return apply_calibration_to_axis(raw_values[0], self.center[0], self.max[0], self.min[0]), apply_calibration_to_axis(raw_values[1], self.center[1], self.max[1], self.min[1])
-
+    def build_tables(self):
+        """Precompute the calibrated value of every raw axis value, both as a float in [-1, 1] and as a DS4 axis byte.
+        Tables are all built before being replaced, so that they can be rebuilt while reports are processed
+        """
+        x_values = [apply_calibration_to_axis(raw, self.center[0], self.max[0], self.min[0], self.deadzone) for raw in range(STICK_AXIS_RANGE)]
+        y_values = [apply_calibration_to_axis(raw, self.center[1], self.max[1], self.min[1], self.deadzone) for raw in range(STICK_AXIS_RANGE)]
+        x_ds4 = bytes(128 + round(v * 127) for v in x_values)
+        y_ds4 = bytes(128 + round(v * 127) for v in y_values)
+        x_ds4_inverted = bytes(128 + round(-v * 127) for v in x_values)
+        y_ds4_inverted = bytes(128 + round(-v * 127) for v in y_values)
+        self.x_values, self.y_values, self.x_ds4, self.y_ds4, self.x_ds4_inverted, self.y_ds4_inverted = x_values, y_values, x_ds4, y_ds4, x_ds4_inverted, y_ds4_inverted
+
+    def set_deadzone(self, deadzone: int):
+        """Rebuild the tables if <deadzone> differs from the one they were built with"""
+        if deadzone != self.deadzone:
+            self.deadzone = deadzone
+            self.build_tables()
 
-@dataclass
+    def apply_calibration(self, raw_values: tuple[int, int]):
+        return self.x_values[raw_values[0]], self.y_values[raw_values[1]]
+
+
+# Input report layout, see ControllerInputData. Sticks are packed as 12 bits x / 12 bits y
+# over 3 bytes, unpacked here as a 16 bit word followed by a byte.
+INPUT_REPORT_STRUCT = struct.Struct(
+    "<"
+    "I"     # 0x00 time
+    "I"     # 0x04 buttons
+    "2x"    # 0x08 unknown
+    "HB"    # 0x0A left stick
+    "HB"    # 0x0D right stick
+    "HH"    # 0x10 mouse x, y
+    "H"     # 0x14 mouse roughness
+    "H"     # 0x16 mouse distance
+    "x"     # 0x18 unknown
+    "3h"    # 0x19 magnometer x, y, z
+    "H"     # 0x1F battery voltage
+    "H"     # 0x21 battery current
+    "11x"   # 0x23 unknown
+    "H"     # 0x2E temperature
+    "3h"    # 0x30 accelerometer x, y, z
+    "3h"    # 0x36 gyroscope x, y, z
+)
+
+@dataclass(slots=True)
 class ControllerInputData:
     """Class for representing the input data received from controller."""
     raw_data: bytes
@@ -113,6 +180,10 @@ class ControllerInputData:
     buttons: int
     left_stick: tuple[int, int]
     right_stick: tuple[int, int]
+    left_stick_raw: tuple[int, int]
+    right_stick_raw: tuple[int, int]
+    left_stick_calibration: StickCalibrationData
+    right_stick_calibration: StickCalibrationData
     mouse_coords: tuple[int, int]
     mouse_roughness: int
     mouse_distance: int
@@ -125,22 +196,29 @@ class ControllerInputData:
 
     def __init__(self, data: bytes, left_stick_calibration: StickCalibrationData, right_stick_calibration: StickCalibrationData):
         self.raw_data = data
-        self.time = decodeu(data[0:4])
-        self.buttons = decodeu(data[4:8])
-        # 2 Unknown bytes data[8:10]
-        self.left_stick = get_stick_xy(data[10:13])
-        self.right_stick = get_stick_xy(data[13:16])
-        self.mouse_coords = decodeu(data[16:18]), decodeu(data[18:20])
-        self.mouse_roughness = decodeu(data[20:22])
-        self.mouse_distance = decodeu(data[22:24])
-        # 1 Unknown byte data[24:25]
-        self.magnometer = decodes(data[25:27]), decodes(data[27:29]), decodes(data[29:31])
-        self.battery_voltage = decodeu(data[31:33]) / 1000
-        self.battery_current = decodeu(data[33:35]) / 100
-        # 11 Unknown byte data[35:46]
-        self.temperature = 25 + decodeu(data[46:48]) / 127
-        self.accelerometer = decodes(data[48:50]), decodes(data[50:52]), decodes(data[52:54])
-        self.gyroscope = decodes(data[54:56]), decodes(data[56:58]), decodes(data[58:60])
+        if len(data) < INPUT_REPORT_STRUCT.size:
+            # Missing bytes used to decode as 0
+            data = bytes(data).ljust(INPUT_REPORT_STRUCT.size, b'\0')
+
+        (self.time, self.buttons,
+         left_stick_low, left_stick_high, right_stick_low, right_stick_high,
+         mouse_x, mouse_y, self.mouse_roughness, self.mouse_distance,
+         mag_x, mag_y, mag_z,
+         battery_voltage, battery_current, temperature,
+         acc_x, acc_y, acc_z,
+         gyro_x, gyro_y, gyro_z) = INPUT_REPORT_STRUCT.unpack_from(data)
+
+        self.left_stick = self.left_stick_raw = left_stick_low & 0xFFF, (left_stick_low >> 12) | (left_stick_high << 4)
+        self.right_stick = self.right_stick_raw = right_stick_low & 0xFFF, (right_stick_low >> 12) | (right_stick_high << 4)
+        self.left_stick_calibration = left_stick_calibration
+        self.right_stick_calibration = right_stick_calibration
+        self.mouse_coords = mouse_x, mouse_y
+        self.magnometer = mag_x, mag_y, mag_z
+        self.battery_voltage = battery_voltage / 1000
+        self.battery_current = battery_current / 100
+        self.temperature = 25 + temperature / 127
+        self.accelerometer = acc_x, acc_y, acc_z
+        self.gyroscope = gyro_x, gyro_y, gyro_z
 
         # Apply stick calibration
         if left_stick_calibration:
@@ -194,39 +272,162 @@ class VibrationData:
     hf_en_tone : bool = False
     hf_amp: int = 0x000
 
+    @classmethod
+    def from_rumble(cls, large_motor: int, small_motor: int):
+        """Vibration of the large and small motors intensities (0-255) of a virtual controller"""
+        return cls(lf_amp=RUMBLE_TO_AMPLITUDE[large_motor], hf_amp=RUMBLE_TO_AMPLITUDE[small_motor])
+
     def get_bytes(self):
         """Returns a 5 bytes representation to send"""
-        value = 0x0000000000
-        # Low Frequency 20 bits
-        value |= (self.lf_freq & 0x1FF)        # 9bits
-        value |= int(self.lf_en_tone) << 9     # 1 bit
-        value |= (self.lf_amp & 0x3FF) << 10   # 10 bits
-        # High Frequency 20 bits
-        value |= (self.hf_freq & 0x1FF) << 20  # 9bits
-        value |= int(self.hf_en_tone) << 29    # 1 bit
-        value |= (self.hf_amp & 0x3FF) << 30   # 10 bits
-        # print(f"{value:08X}")
-        # High Freaquency
-        return value.to_bytes(byteorder='little', length=5)
+        return encode_sample(self.lf_freq, self.lf_en_tone, self.lf_amp, self.hf_freq, self.hf_en_tone, self.hf_amp)
+
+@dataclass
+class CommandLatency:
+    """Round trip time statistics of a command, in seconds"""
+    count: int = 0
+    timeouts: int = 0
+    total: float = 0
+    min: float = None
+    max: float = None
+    last: float = None
+
+    def add(self, latency: float):
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+@dataclass
+class PendingCommand:
+    future: asyncio.Future
+    start_time: float
+    match: callable
+
+class CommandChannel:
+    """Sends commands and matches their responses to the pending requests by command and subcommand id,
+    so that independent commands can be in flight at the same time
+    """
+    def __init__(self, client: "BleakClient"):
+        self.client = client
+        self.pending: dict[tuple[int, int], deque[PendingCommand]] = {}
+        self.latencies: dict[tuple[int, int], CommandLatency] = {}
+
+    async def start(self):
+        await self.client.start_notify(COMMAND_RESPONSE_UUID, self.response_callback)
+
+    def response_callback(self, sender: "BleakGATTCharacteristic", data: bytearray):
+        logger.debug(f"Resp {to_hex(data)}")
+        if len(data) < 8:
+            logger.warning(f"Invalid command response : {to_hex(data)}")
+            return
+
+        key, pending_command = self.find_pending_command(data)
+        if pending_command is None:
+            logger.debug(f"Unexpected command response : {to_hex(data)}")
+            return
+
+        self.pending[key].remove(pending_command)
+        self.get_latency(key).add(time.perf_counter() - pending_command.start_time)
+        if pending_command.future.done():
+            return
+        if data[1] != 0x01:
+            pending_command.future.set_exception(Exception(f"Unexpected response : {data}"))
+        else:
+            pending_command.future.set_result(data)
+
+    def find_pending_command(self, data: bytearray):
+        """Returns the oldest request matching the response <data>, first by command and subcommand id, then by command id only"""
+        keys = [(data[0], data[3])] + [k for k in self.pending if k[0] == data[0] and k[1] != data[3]]
+        for key in keys:
+            for pending_command in self.pending.get(key, ()):
+                if pending_command.match is None or pending_command.match(data):
+                    return key, pending_command
+        return None, None
+
+    def get_latency(self, key: tuple[int, int]):
+        latency = self.latencies.get(key)
+        if latency is None:
+            latency = self.latencies[key] = CommandLatency()
+        return latency
+
+    async def write_command(self, command_id: int, subcommand_id: int, command_data = b'', timeout: float = None, match = None):
+        """Write a command and returns its response.
+        <match> can be used to tell apart responses of identical commands from their content
+        """
+        command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
+        logger.debug(f"Req {to_hex(command_buffer)}")
+
+        key = command_id, subcommand_id
+        # Register before writing as the response could be received before the write returns
+        pending_command = PendingCommand(asyncio.get_running_loop().create_future(), time.perf_counter(), match)
+        self.pending.setdefault(key, deque()).append(pending_command)
+
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(command_id, DEFAULT_COMMAND_TIMEOUT)
+        try:
+            await self.client.write_gatt_char(COMMAND_WRITE_UUID, command_buffer)
+            return await asyncio.wait_for(pending_command.future, timeout)
+        except asyncio.TimeoutError:
+            self.get_latency(key).timeouts += 1
+            raise Exception(f"No response to command {command_id:02x} {subcommand_id:02x} after {timeout}s")
+        finally:
+            if pending_command in self.pending[key]:
+                self.pending[key].remove(pending_command)
 
 ########################
 ### Controller Class ###
 ########################
 
+# Controllers that settings of a reloaded config are applied to
+controllers = weakref.WeakSet()
+controllers_lock = threading.Lock()
+
+def apply_reloaded_config(previous_config: Config, config: Config):
+    """Config listener, rebuilds stick tables in the reloading thread so that input processing never waits for it"""
+    if previous_config is None or config.deadzone == previous_config.deadzone:
+        return
+    with controllers_lock:
+        current_controllers = list(controllers)
+    for controller in current_controllers:
+        controller.set_deadzone(config.deadzone)
+
+add_config_listener(apply_reloaded_config)
+
 class Controller:
-    def __init__(self, device: BLEDevice):
-        self.device: BLEDevice = device
-        self.client: BleakClient = None
+    def __init__(self, device: "BLEDevice | ControllerDevice"):
+        self.device: "BLEDevice | ControllerDevice" = device
+        self.client: "BleakClient" = None
         self.controller_info: ControllerInfo = None
         self.input_report_callback = None
         self.disconnected_callback = None
         self.left_stick_calibration: StickCalibrationData = None
         self.right_stick_calibration: StickCalibrationData = None
-        self.previous_mouse_state: MouseState = None
+        self.stick_calibration: StickCalibrationData = None
+        self.second_stick_calibration: StickCalibrationData = None
+        self.mouse_output = MouseOutput(create_default_mouse_sink())
 
         self.side_buttons_pressed = False
-        self.response_future = None
+        self.command_channel: CommandChannel = None
+        self.connect_start_time: float = None
+        self.init_timings: dict[str, float] = {}
+        self.controller_data: CachedControllerData = None
+        self.cache_refresh_task: asyncio.Task = None
+        self.capture_writer = None
+        self.input_latency = InputLatency()
+        self.report_stats = ReportStats()
+        self.connection_manager: ConnectionManager = None
+        self.last_activity = None
+        self.motion_estimator = MotionEstimator() if get_config().motion_controls else None
         self.vibration_packet_id = 0
+        with controllers_lock:
+            controllers.add(self)
 
     def __repr__(self):
         return f"{CONTROLER_NAMES[self.controller_info.product_id]} : {self.device.address}"
@@ -235,54 +436,89 @@ class Controller:
         if (self.client is not None):
             raise Exception("Already connected")
         
+        from bleak import BleakClient
+
         def disconnected_callback(client: BleakClient):
             if (self.disconnected_callback is not None):
                 asyncio.create_task(self.disconnected_callback(self))
         
+        self.connect_start_time = time.perf_counter()
+        self.init_timings = {}
+        phase_start_time = self.connect_start_time
+        def end_phase(phase: str):
+            nonlocal phase_start_time
+            now = time.perf_counter()
+            self.init_timings[phase] = now - phase_start_time
+            phase_start_time = now
+
         self.client = BleakClient(self.device, disconnected_callback=disconnected_callback)
         await self.client.connect()
         logger.debug(f"Connected to {self.device.address}")
 
-        # Reduce connection interval
-        from bleak.backends.winrt.client import BleakClientWinRT
-        from winrt.windows.devices.bluetooth import BluetoothLEPreferredConnectionParameters
-        backend = self.client._backend
-        if isinstance(backend, BleakClientWinRT) and sys.getwindowsversion().build >= 22000:
-            backend._requester.request_preferred_connection_parameters(BluetoothLEPreferredConnectionParameters.throughput_optimized)
+        # Reduce connection interval, then adapt it to the achieved report rate and activity
+        connection_parameters_backend = WinRTConnectionParametersBackend.create(self.client)
+        if connection_parameters_backend is not None:
+            self.connection_manager = ConnectionManager(connection_parameters_backend, self.report_stats)
+            self.connection_manager.start(time.perf_counter())
+        end_phase("connect")
 
         # Needed to get response from commands
-        self.response_future = None
-        def command_response_callback(sender: BleakGATTCharacteristic, data: bytearray):
-            if self.response_future:
-                self.response_future.set_result(data)
-        await self.client.start_notify(COMMAND_RESPONSE_UUID, command_response_callback)
-
-        # Read controller info and stick calibration
-        self.controller_info = await self.read_controller_info()
-        self.stick_calibration, self.second_stick_calibration = await self.read_calibration_data()
-
-        # Enable input report notification
-        await self.enable_input_notify_callback()
-        
-        if CONFIG.mouse_config.enabled:
-            await self.enableFeatures(FEATURE_MOUSE)
-        if CONFIG.motion_controls:
-            await self.enableFeatures(FEATURE_MOTION)
+        self.command_channel = CommandChannel(self.client)
+        await self.command_channel.start()
+        end_phase("command_channel")
+
+        # Read controller info and stick calibration, they don't depend on each other
+        cached_data = CONTROLLER_CACHE.get(self.device.address)
+        if cached_data is not None:
+            # Refreshed in background once initialized
+            self.apply_controller_data(cached_data)
+        else:
+            self.apply_controller_data(await self.read_controller_data())
+            CONTROLLER_CACHE.put(self.device.address, self.controller_data)
+        end_phase("read_info_and_calibration")
+
+        # Enable input report notification along with all the needed features at once
+        feature_flags = 0
+        config = get_config()
+        if config.mouse_config.enabled:
+            feature_flags |= FEATURE_MOUSE
+        if config.motion_controls:
+            feature_flags |= FEATURE_MOTION
+        await asyncio.gather(self.enable_input_notify_callback(), self.enableFeatures(feature_flags) if feature_flags else asyncio.sleep(0))
+        end_phase("enable_input_and_features")
+
+        if cached_data is not None:
+            self.cache_refresh_task = asyncio.create_task(self.refresh_cached_data(cached_data))
 
         logger.debug(f"Succesfully initialized {self.device.address} : {self.controller_info}")
+        logger.info(f"Initialized {self.device.address} in {sum(self.init_timings.values()):.3f}s : " + ", ".join(f"{k} {v:.3f}s" for k, v in self.init_timings.items()))
 
     @classmethod
-    async def create_from_device(cls, device: BLEDevice):
+    async def create_from_device(cls, device: "BLEDevice"):
         controller = cls(device)
         await controller.connect()
         return controller
     
+    @classmethod
+    def create_from_capture(cls, address: str, controller_data: CachedControllerData):
+        """Create a controller that is not connected, used to replay captured input reports"""
+        controller = cls(ControllerDevice(address))
+        controller.apply_controller_data(controller_data)
+        return controller
+
     @classmethod
     async def create_from_mac_address(cls, mac_address):
+        from bleak import BleakScanner
         device = await BleakScanner.find_device_by_address(mac_address)
         return await cls.create_from_device(device)
         
+    def is_connected(self):
+        """False when disconnected, or created from a capture"""
+        return self.client is not None and self.client.is_connected
+
     async def disconnect(self):
+        if self.connection_manager is not None:
+            self.connection_manager.close()
         if self.client and self.client.is_connected:
             await self.client.disconnect()
 
@@ -300,20 +536,14 @@ class Controller:
 
     ### Commands ###
 
-    async def write_command(self, command_id: int, subcommand_id: int, command_data = b''):
+    async def write_command(self, command_id: int, subcommand_id: int, command_data = b'', timeout: float = None, match = None):
         """Generic write command method"""
-        command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
-        logger.debug(f"Req {to_hex(command_buffer)}")
-
-        self.response_future = asyncio.get_running_loop().create_future()
-        
-        await self.client.write_gatt_char(COMMAND_WRITE_UUID, command_buffer)
-        response_buffer = await self.response_future
-        logger.debug(f"Resp {to_hex(response_buffer)}")
-        if len(response_buffer) < 8 or response_buffer[0] != command_id or response_buffer[1] != 0x01:
-            raise Exception(f"Unexpected response : {response_buffer}")
-
+        response_buffer = await self.command_channel.write_command(command_id, subcommand_id, command_data, timeout, match)
         return response_buffer[8:]
+
+    def get_command_latencies(self):
+        """Returns the round trip time statistics of each (command, subcommand) sent"""
+        return self.command_channel.latencies if self.command_channel else {}
     
     async def set_leds(self, player_number: int, reversed=False):
         """Set the player indicator led to the specified <player_number>"""
@@ -337,7 +567,9 @@ class Controller:
         """Returns the requested <length> bytes of data located at <address>"""
         if length > 0x4F:
             raise Exception("Maximum read size is 0x4F bytes")
-        data = await self.write_command(COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, length.to_bytes() + b'\x7e\0\0' + address.to_bytes(length=4,byteorder='little'))
+        # Several reads can be pending, match the response with the address
+        data = await self.write_command(COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, length.to_bytes() + b'\x7e\0\0' + address.to_bytes(length=4,byteorder='little'),
+                                        match=lambda response: decodeu(response[12:16]) == address)
         # Ensure the response is the data we requested
         if (data[0] != length or decodeu(data[4:8]) != address):
             raise Exception(f"Unexpected response from read commmand : {data}")
@@ -347,16 +579,55 @@ class Controller:
         info = await self.read_memory(0x40, ADDRESS_CONTROLLER_INFO)
         return ControllerInfo(info)
 
+    async def read_controller_data(self):
+        """Read controller info and stick calibration from the controller memory"""
+        controller_info_data, (calibration_data_1, calibration_data_2) = await asyncio.gather(self.read_memory(0x40, ADDRESS_CONTROLLER_INFO), self.read_calibration_blocks())
+        return CachedControllerData(ControllerInfo(controller_info_data).serial_number, bytes(controller_info_data), bytes(calibration_data_1), bytes(calibration_data_2))
+
+    def apply_controller_data(self, controller_data: CachedControllerData):
+        self.controller_data = controller_data
+        self.controller_info = ControllerInfo(controller_data.controller_info)
+        self.stick_calibration, self.second_stick_calibration = self.create_stick_calibrations(controller_data.calibration_data_1, controller_data.calibration_data_2)
+
+    async def refresh_cached_data(self, cached_data: CachedControllerData):
+        """Read again the data that was taken from the cache, and replace it if it changed"""
+        try:
+            controller_data = await self.read_controller_data()
+        except Exception:
+            logger.debug(f"Unable to refresh cached data of {self.device.address}", exc_info=True)
+            return
+        if controller_data != cached_data:
+            if controller_data.serial_number != cached_data.serial_number:
+                logger.info(f"Cached data of {self.device.address} was for another controller ({cached_data.serial_number}), updating it")
+            else:
+                logger.info(f"Cached data of {self.device.address} is outdated, updating it")
+            self.apply_controller_data(controller_data)
+            CONTROLLER_CACHE.put(self.device.address, controller_data)
+
     async def read_calibration_data(self):
         """Returns a tuple with calibration data of left and right stick (if present)"""
-        calibration_data_1 = await self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_1)
-        if (decodeu(calibration_data_1[:3]) == 0xFFFFFF):
+        return self.create_stick_calibrations(*await self.read_calibration_blocks())
+
+    async def read_calibration_blocks(self):
+        """Returns the raw calibration data of both sticks, user calibration if present, factory calibration otherwise"""
+        calibration_data_1, calibration_data_2 = await asyncio.gather(self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_1), self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_2))
+        no_user_calibration_1 = decodeu(calibration_data_1[:3]) == 0xFFFFFF
+        no_user_calibration_2 = decodeu(calibration_data_2[:3]) == 0xFFFFFF
+        if no_user_calibration_1:
             logger.debug("no user calib for stick 1")
-            calibration_data_1 = await self.read_memory(0x0b, CALIBRATION_JOYSTICK_1)
-        calibration_data_2 = await self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_2)
-        if (decodeu(calibration_data_2[:3]) == 0xFFFFFF):
-            calibration_data_2 = await self.read_memory(0x0b, CALIBRATION_JOYSTICK_2)
+        if no_user_calibration_2:
             logger.debug("no user calib for stick 2")
+        factory_data_1, factory_data_2 = await asyncio.gather(
+            self.read_memory(0x0b, CALIBRATION_JOYSTICK_1) if no_user_calibration_1 else asyncio.sleep(0, calibration_data_1),
+            self.read_memory(0x0b, CALIBRATION_JOYSTICK_2) if no_user_calibration_2 else asyncio.sleep(0, calibration_data_2))
+        return factory_data_1, factory_data_2
+
+    def set_deadzone(self, deadzone: int):
+        for calibration in (self.stick_calibration, self.second_stick_calibration):
+            if calibration is not None:
+                calibration.set_deadzone(deadzone)
+
+    def create_stick_calibrations(self, calibration_data_1: bytes, calibration_data_2: bytes):
         # when joycon, the stick calibration is store in first slot
         if self.is_joycon_left():
             return StickCalibrationData(calibration_data_1), None
@@ -371,6 +642,7 @@ class Controller:
 
     async def pair(self):
         """Pair this controller with the local bluetooth adapter"""
+        import bluetooth
         mac_value = convert_mac_string_to_value(bluetooth.read_local_bdaddr()[0])
         # Real Switch2 actually sends 2 different mac addreses (switch 2 has 2 bluetooth adapter ? I think I read someting about that in the welcome tour)
         await self.write_command(COMMAND_PAIR, SUBCOMMAND_PAIR_SET_MAC,b"\x00\x02" +  mac_value.to_bytes(6, 'little') + mac_value.to_bytes(6, 'little'))
@@ -384,64 +656,83 @@ class Controller:
 
     async def enable_input_notify_callback(self):
         def input_report_callback(sender, data):
-            inputData = ControllerInputData(data, self.stick_calibration, self.second_stick_calibration)
+            self.input_report_received(data, time.perf_counter())
+
+        await self.client.start_notify(INPUT_REPORT_UUID, input_report_callback)
 
-            if inputData.buttons & (SWITCH_BUTTONS["SR_R"] | SWITCH_BUTTONS["SR_L"] | SWITCH_BUTTONS["SL_R"] | SWITCH_BUTTONS["SL_L"]):
-                self.side_buttons_pressed = True
+    def input_report_received(self, data: bytes, received_time: float):
+        """Called for each input report received from the controller"""
+        if self.capture_writer is not None:
+            self.capture_writer.write_input_report(self, data)
 
-            self.simulate_mouse(inputData)
+        if "first_input" not in self.init_timings:
+            self.init_timings["first_input"] = time.perf_counter() - self.connect_start_time
+            logger.info(f"First input from {self.device.address} {self.init_timings['first_input']:.3f}s after connecting")
 
-            if self.input_report_callback is not None:
-                self.input_report_callback(inputData, self)
+        self.handle_input_report(data, received_time)
 
-        await self.client.start_notify(INPUT_REPORT_UUID, input_report_callback)
+    def handle_input_report(self, data: bytes, received_time: float = None):
+        """Process a raw input report, received from the controller or replayed from a capture"""
+        input_latency = self.input_latency
+        input_latency.start(received_time)
+        inputData = ControllerInputData(data, self.stick_calibration, self.second_stick_calibration)
+        input_latency.mark("decode")
+        self.report_stats.update(inputData.time, input_latency.received_time)
+
+        if self.connection_manager is not None:
+            activity = inputData.buttons, inputData.left_stick, inputData.right_stick, inputData.mouse_coords
+            self.connection_manager.on_report(input_latency.received_time, activity != self.last_activity)
+            self.last_activity = activity
+
+        if self.motion_estimator is not None:
+            self.motion_estimator.update(inputData.time, inputData.accelerometer, inputData.gyroscope)
+            input_latency.mark("motion")
+
+        if inputData.buttons & (SWITCH_BUTTONS["SR_R"] | SWITCH_BUTTONS["SR_L"] | SWITCH_BUTTONS["SL_R"] | SWITCH_BUTTONS["SL_L"]):
+            self.side_buttons_pressed = True
+
+        # Read once, the config can be reloaded at any time
+        config = get_config()
+        self.simulate_mouse(inputData, config.mouse_config)
+        input_latency.mark("mouse")
+
+        if self.input_report_callback is not None:
+            self.input_report_callback(inputData, self, config)
+        input_latency.finish()
 
     def set_input_report_callback(self, callback):
+        """<callback> is called with (input data, controller, config the report is processed with)"""
         self.input_report_callback = callback
 
-    def simulate_mouse(self, inputData: ControllerInputData):
-        mouse_config = CONFIG.mouse_config
+    def simulate_mouse(self, inputData: ControllerInputData, mouse_config):
         if mouse_config.enabled and self.is_joycon():
             # Check if joycon is being used as a mouse
             if inputData.mouse_distance != 0 and inputData.mouse_distance < 1000 and inputData.mouse_roughness < 4000:
                 x, y = inputData.mouse_coords
                 mouseButtonsConfig = mouse_config.joycon_l_buttons if self.is_joycon_left() else mouse_config.joycon_r_buttons
-                lb = inputData.buttons & mouseButtonsConfig.left_button
-                mb = inputData.buttons & mouseButtonsConfig.middle_button
-                rb = inputData.buttons & mouseButtonsConfig.right_button
+                lb = bool(inputData.buttons & mouseButtonsConfig.left_button)
+                mb = bool(inputData.buttons & mouseButtonsConfig.middle_button)
+                rb = bool(inputData.buttons & mouseButtonsConfig.right_button)
 
                 # prevent buttons used by mouse from being sent to virtual controller
                 inputData.buttons &= ~(mouseButtonsConfig.left_button | mouseButtonsConfig.middle_button | mouseButtonsConfig.right_button)
 
-                if self.previous_mouse_state is not None:
-                    dx = signed_looping_difference_16bit(self.previous_mouse_state.x, x)
-                    dy = signed_looping_difference_16bit(self.previous_mouse_state.y ,y)
-
-                    mx, my = win32api.GetCursorPos()
-                    if (dx != 0 or dy != 0):
-                        mx += int(dx * mouse_config.sensitivity)
-                        my += int(dy * mouse_config.sensitivity)
-                        win32api.SetCursorPos((mx, my))
-
-                    press_or_release_mouse_button(lb, self.previous_mouse_state.lb, win32con.MOUSEEVENTF_LEFTDOWN, mx, my)
-                    press_or_release_mouse_button(mb, self.previous_mouse_state.mb, win32con.MOUSEEVENTF_MIDDLEDOWN, mx, my)
-                    press_or_release_mouse_button(rb, self.previous_mouse_state.rb, win32con.MOUSEEVENTF_RIGHTDOWN, mx, my)
-
+                scroll_value = 0
+                if self.mouse_output.previous_state is not None:
                     if self.is_joycon_right():
                         scroll_value = inputData.right_stick[1]
                         # inhibit stick from being sent to virtual controller
                         inputData.right_stick = 0,0
+                        inputData.right_stick_raw = inputData.right_stick_calibration.center
                     else:
                         scroll_value = inputData.left_stick[1]
                         # inhibit stick from being sent to virtual controller
                         inputData.left_stick = 0,0
+                        inputData.left_stick_raw = inputData.left_stick_calibration.center
 
-                    if abs(scroll_value) > 0.2:
-                        win32api.mouse_event(win32con.MOUSEEVENTF_WHEEL, 0, 0, int(scroll_value * 60 * mouse_config.scroll_sensitivity), 0)
-                        
-                self.previous_mouse_state = MouseState(x, y, lb, mb, rb)
-            else:
-                self.previous_mouse_state = None
+                self.mouse_output.update(MouseState(x, y, lb, mb, rb), scroll_value, mouse_config.sensitivity, mouse_config.scroll_sensitivity)
+            elif self.mouse_output.previous_state is not None:
+                self.mouse_output.reset()
 
     ### Controller info
 
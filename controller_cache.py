@@ -0,0 +1,69 @@
+"""Local cache of the controller info and stick calibration data read from controllers memory
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass
+from config import get_resource
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = "controller_cache.json"
+
+@dataclass
+class CachedControllerData:
+    serial_number: str
+    controller_info: bytes
+    calibration_data_1: bytes
+    calibration_data_2: bytes
+
+    def to_dict(self):
+        return {
+            "serial_number": self.serial_number,
+            "controller_info": self.controller_info.hex(),
+            "calibration_data_1": self.calibration_data_1.hex(),
+            "calibration_data_2": self.calibration_data_2.hex(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d["serial_number"], bytes.fromhex(d["controller_info"]), bytes.fromhex(d["calibration_data_1"]), bytes.fromhex(d["calibration_data_2"]))
+
+class ControllerCache:
+    """Controller data keyed by MAC address, the serial number is checked when the data is read again from the controller"""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.entries: dict[str, CachedControllerData] = None
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path) as f:
+                self.entries = {address: CachedControllerData.from_dict(d) for address, d in json.load(f).items()}
+        except Exception:
+            logger.exception(f"Unable to read controller cache {self.file_path}, ignoring it")
+
+    def save(self):
+        temp_path = self.file_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({address: data.to_dict() for address, data in self.entries.items()}, f, indent=2)
+            os.replace(temp_path, self.file_path)
+        except Exception:
+            logger.exception(f"Unable to write controller cache {self.file_path}")
+
+    def get(self, address: str):
+        if self.entries is None:
+            self.load()
+        return self.entries.get(address)
+
+    def put(self, address: str, data: CachedControllerData):
+        if self.entries is None:
+            self.load()
+        if self.entries.get(address) != data:
+            self.entries[address] = data
+            self.save()
+
+CONTROLLER_CACHE = ControllerCache(get_resource(CACHE_FILE_NAME, "."))
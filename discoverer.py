@@ -1,5 +1,6 @@
 """A class used to find switch 2 controllers via Bluetooth
 """
+import sys
 import threading
 from bleak import BleakScanner, BleakClient, BleakGATTCharacteristic
 from bleak.backends.device import BLEDevice
@@ -11,22 +12,89 @@ import bluetooth
 import yaml
 from utils import to_hex, convert_mac_string_to_value, decodeu
 from controller import Controller, ControllerInputData, NINTENDO_VENDOR_ID, CONTROLER_NAMES, VibrationData
-from virtual_controller import VirtualController
-from config import CONFIG
+from virtual_controller import VirtualController, assign_virtual_controller, load_vgamepad, MAX_VIRTUAL_CONTROLLERS
+from config import ConfigWatcher, get_config, get_config_file_path, is_usb
+from capture import CaptureWriter
 
 logger = logging.getLogger(__name__)
 
 NINTENDO_BLUETOOTH_MANUFACTURER_ID = 0x0553
 
+# Number of controllers that can be connecting at the same time
+CONNECTION_WORKERS = 2
+# Maximum number of distinct manufacturer data kept in the parse cache
+PARSE_CACHE_SIZE = 256
+
+def parse_manufacturer_data(data: bytes, host_mac_value: int):
+    """Returns (product id, paired) if the manufacturer data is the one of a switch 2 controller pairing or paired to this host, None otherwise"""
+    vendor_id = decodeu(data[3:5])
+    product_id = decodeu(data[5:7])
+    reconnect_mac = decodeu(data[10:16])
+    if vendor_id != NINTENDO_VENDOR_ID or product_id not in CONTROLER_NAMES:
+        return None
+    if reconnect_mac == 0:
+        return product_id, False
+    if reconnect_mac == host_mac_value:
+        return product_id, True
+    return None
+
+def get_passive_scanner_args():
+    """Returns BleakScanner arguments for a passive scan filtered on the Nintendo manufacturer ID, None if the backend has none.
+    Only BlueZ has them, and they need its advertisement monitor API which is still experimental
+    """
+    if sys.platform != "linux":
+        return None
+    try:
+        from bleak.assigned_numbers import AdvertisementDataType
+        from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+    except ImportError:
+        return None
+    company_id = NINTENDO_BLUETOOTH_MANUFACTURER_ID.to_bytes(2, "little")
+    return {
+        "scanning_mode": "passive",
+        "bluez": {"or_patterns": [OrPattern(0, AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA, company_id)]},
+    }
+
+async def start_scanner(callback):
+    """Returns a started scanner, scanning passively if the adapter supports it, actively otherwise.
+    Advertisements are filtered in <callback> in both cases
+    """
+    passive_args = get_passive_scanner_args()
+    if passive_args is not None:
+        try:
+            scanner = BleakScanner(callback, **passive_args)
+            await scanner.start()
+            return scanner
+        except BleakError as e:
+            logger.info(f"Passive scanning is not supported, scanning actively : {e}")
+    scanner = BleakScanner(callback)
+    await scanner.start()
+    return scanner
+
+def preload_vgamepad():
+    """Import vgamepad while scanning, instead of when the first controller connects"""
+    try:
+        load_vgamepad()
+    except Exception:
+        logger.exception("Unable to load vgamepad")
+
 async def run_discovery(update_controllers_threadsafe, quit_event):
+    # Before anything that can fail, they are cleaned up at the end
+    virtual_controllers: list[VirtualController] = [None] * MAX_VIRTUAL_CONTROLLERS
+    capture_writer: CaptureWriter = None
+    config_watcher = ConfigWatcher(get_config_file_path(), is_usb)
+    config_watcher.start()
     try:
         host_mac_value = convert_mac_string_to_value(bluetooth.read_local_bdaddr()[0])
-        connected_mac_addresses: list[str] = []
-        virtual_controllers: list[VirtualController] = [None] * 8
+        connected_mac_addresses: set[str] = set()
+        parse_cache: dict[bytes, tuple[int, bool]] = {}
+        connection_queue: asyncio.Queue[tuple[BLEDevice, bool]] = asyncio.Queue()
+        capture_file = get_config().capture_file
+        capture_writer = CaptureWriter(capture_file) if capture_file else None
 
         async def disconnected_controller(controller: Controller):
             logger.info(f"Controller disconected {controller.client.address}")
-            connected_mac_addresses.remove(controller.client.address)
+            connected_mac_addresses.discard(controller.client.address)
             for i, vc in enumerate(virtual_controllers[:]):
                 if vc is not None and await vc.remove_controller(controller):
                     virtual_controllers[i] = None
@@ -42,27 +110,14 @@ async def run_discovery(update_controllers_threadsafe, quit_event):
                 controller = await Controller.create_from_device(device)
                 logger.info(f"Connected to {device.address}")
                 controller.disconnected_callback = disconnected_controller
+                controller.capture_writer = capture_writer
                 if not paired:
                     await controller.pair()
                     logger.info(f"Paired successfully to {device.address}")
 
-                virtual_controller = None
                 await lock.acquire()
                 try:
-                    if CONFIG.combine_joycons and not controller.side_buttons_pressed:
-                        # try to find an already connected joycon to combine with
-                        if controller.is_joycon_left():
-                            virtual_controller = next(filter(lambda vc: vc is not None and vc.is_single_joycon_right(), virtual_controllers), None)
-                        elif controller.is_joycon_right():
-                            virtual_controller = next(filter(lambda vc: vc is not None and vc.is_single_joycon_left(), virtual_controllers), None)
-
-                    if virtual_controller is None:
-                        # Find an emtpy slot
-                        slot_index = next(i for i, c in enumerate(virtual_controllers) if c == None)
-                        virtual_controller = VirtualController(slot_index+1)
-                        virtual_controllers[slot_index] = virtual_controller
-                    
-                    virtual_controller.add_controller(controller)
+                    virtual_controller = assign_virtual_controller(virtual_controllers, controller)
                 finally:
                     lock.release()
                 
@@ -73,35 +128,62 @@ async def run_discovery(update_controllers_threadsafe, quit_event):
                     update_controllers_threadsafe(virtual_controllers)
             except Exception:
                 logger.exception(f"Unable to initialize device {device.address}")
-                connected_mac_addresses.remove(device.address)
+                connected_mac_addresses.discard(device.address)
 
-        async def callback(device: BLEDevice, advertising_data: AdvertisementData):
+        async def connection_worker():
+            while True:
+                device, paired = await connection_queue.get()
+                await add_controller(device, paired)
+
+        def callback(device: BLEDevice, advertising_data: AdvertisementData):
             if device.address in connected_mac_addresses:
                 return
             nintendo_manufacturer_data = advertising_data.manufacturer_data.get(NINTENDO_BLUETOOTH_MANUFACTURER_ID)
-            if nintendo_manufacturer_data:
-                vendor_id = decodeu(nintendo_manufacturer_data[3:5])
-                product_id = decodeu(nintendo_manufacturer_data[5:7])
-                reconnect_mac = decodeu(nintendo_manufacturer_data[10:16])
-                if vendor_id == NINTENDO_VENDOR_ID and product_id in CONTROLER_NAMES:
-                    logger.debug(f"Manufacturer data: {to_hex(nintendo_manufacturer_data)}")
-                    if reconnect_mac == 0:
-                        logger.info(f"Found pairing device {CONTROLER_NAMES[product_id]} {device.address}")
-                        connected_mac_addresses.append(device.address)
-                        await add_controller(device, False)
-                    elif reconnect_mac == host_mac_value:
-                        logger.info(f"Found already paired device {CONTROLER_NAMES[product_id]} {device.address}")
-                        connected_mac_addresses.append(device.address)
-                        await add_controller(device, True)
-
-        async with BleakScanner(callback) as scanner:
-            print("Presss a button on a paired controller, or hold sync button on an unpaired controller")
-            await asyncio.get_event_loop().run_in_executor(None, quit_event.wait)
+            if not nintendo_manufacturer_data:
+                return
+            try:
+                parsed = parse_cache[nintendo_manufacturer_data]
+            except KeyError:
+                if len(parse_cache) >= PARSE_CACHE_SIZE:
+                    parse_cache.clear()
+                parsed = parse_cache[nintendo_manufacturer_data] = parse_manufacturer_data(nintendo_manufacturer_data, host_mac_value)
+            if parsed is None:
+                return
+
+            product_id, paired = parsed
+            logger.debug(f"Manufacturer data: {to_hex(nintendo_manufacturer_data)}")
+            if paired:
+                logger.info(f"Found already paired device {CONTROLER_NAMES[product_id]} {device.address}")
+            else:
+                logger.info(f"Found pairing device {CONTROLER_NAMES[product_id]} {device.address}")
+            connected_mac_addresses.add(device.address)
+            connection_queue.put_nowait((device, paired))
+
+        workers = [asyncio.create_task(connection_worker()) for _ in range(CONNECTION_WORKERS)]
+        threading.Thread(target=preload_vgamepad, name="Preload vgamepad", daemon=True).start()
+        try:
+            scanner = await start_scanner(callback)
+            try:
+                print("Presss a button on a paired controller, or hold sync button on an unpaired controller")
+                await asyncio.get_event_loop().run_in_executor(None, quit_event.wait)
+            finally:
+                await scanner.stop()
+        finally:
+            for worker in workers:
+                worker.cancel()
     finally:
+        config_watcher.stop()
         for vc in virtual_controllers:
             if vc is not None:
+                logger.info(f"Player {vc.player_number} : {vc.submitted_reports} reports sent to the virtual controller, {vc.suppressed_reports} unchanged reports skipped")
                 for controller in vc.controllers:
+                    logger.info(f"Input latency of {controller}\n{controller.input_latency.format_summary()}")
+                    logger.info(f"Reports of {controller} : {controller.report_stats.format_summary()}")
+                    if controller.connection_manager is not None:
+                        logger.info(f"Connection of {controller} : {controller.connection_manager.summary()}")
                     await controller.disconnect()
+        if capture_writer is not None:
+            capture_writer.close()
 
 def start_discoverer(update_controllers_threadsafe, quit_event):
     asyncio.run(run_discovery(update_controllers_threadsafe, quit_event))
@@ -1,10 +1,16 @@
+import logging
 import queue
 import threading
 import tkinter as tk
 import tkinter.font as tkFont
-from discoverer import start_discoverer
-from config import get_resource
-from virtual_controller import VirtualController
+from typing import TYPE_CHECKING
+from config import get_config, get_resource
+
+# The discovery stack is imported by the background thread, once the window is shown
+if TYPE_CHECKING:
+    from virtual_controller import VirtualController
+
+logger = logging.getLogger(__name__)
 
 controller_frame_size = 200
 
@@ -13,14 +19,46 @@ block_color = "#404040"
 player_number_bg_color = "#8B8B8B"
 
 CONTROLLER_UPDATED_EVENT = '<<ControllersUpdated>>'
+BACKEND_ERROR_EVENT = '<<BackendError>>'
+
+# Number of players shown in the window
+DISPLAYED_PLAYERS = 4
+
+class ImageCache:
+    """Images of the images resource folder, each loaded once and shared by every widget.
+    Needs to be created after the tk root
+    """
+    def __init__(self):
+        self.images: dict[str, tk.PhotoImage] = {}
+
+    def get(self, name: str):
+        image = self.images.get(name)
+        if image is None:
+            image = self.images[name] = tk.PhotoImage(file=get_resource(f"images/{name}.png"))
+        return image
+
+def get_controller_image_name(virtualController: "VirtualController"):
+    if not virtualController.is_single():
+        return "joycon2leftandright"
+    elif virtualController.is_single_joycon_right():
+        return "joycon2right_sideway"
+    elif virtualController.is_single_joycon_left():
+        return "joycon2left_sideway"
+    else:
+        return "procontroller2"
+
+def get_slots_info(virtual_controllers: list["VirtualController"]):
+    """Returns what is displayed for each player, (controller image name, player number) or None.
+    Computed by the thread owning the virtual controllers, the window then only compares these tuples
+    """
+    return tuple(None if vc is None or not vc.controllers else (get_controller_image_name(vc), vc.player_number) for vc in virtual_controllers[:DISPLAYED_PLAYERS])
 
 class PlayerInfoBlock:
-    def __init__(self, parent):
+    def __init__(self, parent, images: ImageCache):
         self.parent = parent
-        self.controller_label = None
-        self.player_led_label = None
+        self.images = images
+        self.slot_info = None
 
-        self.load_pictures()
         self.init_interface()
 
     def init_interface(self):
@@ -32,88 +70,116 @@ class PlayerInfoBlock:
         self.controllers_frame.pack()
         self.controllers_frame.pack_propagate(False)
 
-    def load_pictures(self):
-        self.joycon2leftandright = tk.PhotoImage(file=get_resource("images/joycon2leftandright.png"))
-        self.joycon2right_sideway = tk.PhotoImage(file=get_resource("images/joycon2right_sideway.png"))
-        self.joycon2left_sideway = tk.PhotoImage(file=get_resource("images/joycon2left_sideway.png"))
-        self.procontroller2 = tk.PhotoImage(file=get_resource("images/procontroller2.png"))
-        self.player_leds = {nb: tk.PhotoImage(file=get_resource(f"images/player{nb}.png")) for nb in range(1,5)}
+        # Shown once a controller is assigned to this player
+        self.controller_label = tk.Label(self.controllers_frame, bg=block_color)
+        self.player_led_label = tk.Label(self.main_frame, bg=player_number_bg_color)
 
     def clearControllerInfo(self):
-        if self.controller_label is not None:
-            self.controller_label.destroy()
-            self.controller_label = None
-
-        if self.player_led_label is not None:
-            self.player_led_label.destroy()
-            self.player_led_label = None
-
-    def displayControllersInfo(self, virtualController : VirtualController):
-        if not virtualController.is_single():
-            image = self.joycon2leftandright
-        elif virtualController.is_single_joycon_right():
-            image = self.joycon2right_sideway
-        elif virtualController.is_single_joycon_left():
-            image = self.joycon2left_sideway
-        else:
-            image = self.procontroller2
-
-
-        self.controller_label = tk.Label(self.controllers_frame, image=image, bg=block_color)
-        self.controller_label.pack(fill="none", expand=True)
-
-        self.player_led_label = tk.Label(self.main_frame, image=self.player_leds[virtualController.player_number], bg=player_number_bg_color)
-        self.player_led_label.pack(pady=20)
+        self.controller_label.pack_forget()
+        self.player_led_label.pack_forget()
+        self.slot_info = None
+
+    def displayControllersInfo(self, slot_info: tuple[str, int]):
+        """Show <slot_info> from get_slots_info, widgets are only touched if it changed"""
+        if slot_info == self.slot_info:
+            return
+        if slot_info is None:
+            self.clearControllerInfo()
+            return
+        image_name, player_number = slot_info
+        self.controller_label.configure(image=self.images.get(image_name))
+        self.player_led_label.configure(image=self.images.get(f"player{player_number}"))
+        if self.slot_info is None:
+            self.controller_label.pack(fill="none", expand=True)
+            self.player_led_label.pack(pady=20)
+        self.slot_info = slot_info
 
 class ControllerWindow:
     def __init__(self):
         self.root = None
-        self.main_frame = None
-        self.no_controllers = True
-        self.message_queue = queue.Queue()
+        self.hint_frame = None
+        self.players_frame = None
+        self.error_frame = None
+        self.players_info: list[PlayerInfoBlock] = []
+        self.no_controllers = None
+        # Latest slots info not yet displayed, updates received in the meantime replace it
+        self.pending_slots_info = None
+        self.pending_lock = threading.Lock()
+        self.error_queue = queue.Queue()
         self.quit_event = threading.Event()
     
     def init_interface(self):
         self.root = tk.Tk()
-        photo = tk.PhotoImage(file = get_resource('images/icon.png'))
-        self.root.wm_iconphoto(False, photo)
+        self.images = ImageCache()
+        self.root.wm_iconphoto(False, self.images.get("icon"))
         self.root.title("Switch2 Controllers")
         self.root.geometry("1000x400+50+50")
         self.root.minsize(1000,400)
         self.root.config(bg=background_color, padx=10, pady=10)
         self.font = tkFont.Font(family="Arial", size=16, weight="bold")
-        self.pairing_hint_image = tk.PhotoImage(file=get_resource("images/pairing_hint.png"))
-
-        self.update([None])
-
-    def update(self, controllers_info):
-        self.no_controllers = all(c is None for c in controllers_info)
-        
-        if self.main_frame is not None:
-            self.main_frame.destroy()
-
-        self.main_frame = tk.Frame(self.root, bg=background_color)
-        self.main_frame.pack(pady=50, fill=tk.Y)
-
-        if self.no_controllers:
-            tk.Label(self.main_frame, text="ペアリングしたコントローラーのボタンを押すか、\nSyncボタンを長押ししてペアリングしてください。", font=self.font, bg=background_color).pack()
-            pairing_hint = tk.Label(self.main_frame, image=self.pairing_hint_image, bg=background_color)
-            pairing_hint.pack(pady=10)
-        else:
-            self.players_info = [PlayerInfoBlock(self.main_frame) for i in range(4)]
 
-            for i, player_info in enumerate(self.players_info):
-                controller_info = controllers_info[i]
-                if controller_info is not None:
-                    player_info.displayControllersInfo(controller_info)
+        self.hint_frame = tk.Frame(self.root, bg=background_color)
+        tk.Label(self.hint_frame, text="ペアリングしたコントローラーのボタンを押すか、\nSyncボタンを長押ししてペアリングしてください。", font=self.font, bg=background_color).pack()
+        tk.Label(self.hint_frame, image=self.images.get("pairing_hint"), bg=background_color).pack(pady=10)
+
+        self.players_frame = tk.Frame(self.root, bg=background_color)
+        self.players_info = [PlayerInfoBlock(self.players_frame, self.images) for i in range(DISPLAYED_PLAYERS)]
+
+        self.update((None,) * DISPLAYED_PLAYERS)
+
+    def update(self, slots_info: tuple):
+        """Show <slots_info> from get_slots_info, only the players that changed are updated"""
+        no_controllers = all(c is None for c in slots_info)
+        if no_controllers != self.no_controllers:
+            self.no_controllers = no_controllers
+            shown_frame, hidden_frame = (self.hint_frame, self.players_frame) if no_controllers else (self.players_frame, self.hint_frame)
+            hidden_frame.pack_forget()
+            shown_frame.pack(pady=50, fill=tk.Y)
+
+        for i, player_info in enumerate(self.players_info):
+            player_info.displayControllersInfo(slots_info[i] if i < len(slots_info) else None)
+
+    def show_error(self, message: str):
+        self.hint_frame.pack_forget()
+        self.players_frame.pack_forget()
+        if self.error_frame is not None:
+            self.error_frame.destroy()
+        self.error_frame = tk.Frame(self.root, bg=background_color)
+        self.error_frame.pack(pady=50, fill=tk.Y)
+        tk.Label(self.error_frame, text=message, font=self.font, bg=background_color, wraplength=900).pack()
+
+    def on_controllers_updated(self, event):
+        with self.pending_lock:
+            slots_info = self.pending_slots_info
+            self.pending_slots_info = None
+        if slots_info is not None:
+            self.update(slots_info)
 
     def start(self):
-        def update_controllers_callback_threadsafe(controllers: list[VirtualController]):
-            self.message_queue.put(controllers)
-            self.root.event_generate(CONTROLLER_UPDATED_EVENT)
-        
-        self.root.bind(CONTROLLER_UPDATED_EVENT, lambda e : self.update(self.message_queue.get()))
-        t = threading.Thread(target=start_discoverer, args=(update_controllers_callback_threadsafe, self.quit_event))
+        def update_controllers_callback_threadsafe(controllers: list["VirtualController"]):
+            slots_info = get_slots_info(controllers)
+            with self.pending_lock:
+                # An event is already pending when a previous update wasn't displayed yet, it will display this one instead
+                event_pending = self.pending_slots_info is not None
+                self.pending_slots_info = slots_info
+            if not event_pending:
+                self.root.event_generate(CONTROLLER_UPDATED_EVENT)
+
+        def run_backend():
+            """Read the config and import the bluetooth and virtual controller backends without delaying the window"""
+            try:
+                get_config()
+                from discoverer import start_discoverer
+            except Exception as e:
+                logger.exception("Unable to start")
+                self.error_queue.put(str(e))
+                self.root.event_generate(BACKEND_ERROR_EVENT)
+                return
+            start_discoverer(update_controllers_callback_threadsafe, self.quit_event)
+
+        self.root.bind(CONTROLLER_UPDATED_EVENT, self.on_controllers_updated)
+        self.root.bind(BACKEND_ERROR_EVENT, lambda e : self.show_error(self.error_queue.get()))
+        t = threading.Thread(target=run_backend)
         t.start()
 
         def on_quit():
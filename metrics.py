@@ -0,0 +1,205 @@
+"""Runtime metrics of the input processing
+"""
+import statistics
+import time
+
+class LatencyHistogram:
+    """Fixed-size histogram of durations.
+    Durations are counted in microseconds, in 8 buckets per power of two (precise to 1/8th)
+    """
+    SUB_BUCKETS = 8
+    # Durations from 8 << 23 us (about 67s) share the last bucket
+    MAX_BUCKET_INDEX = 24 * SUB_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * (self.MAX_BUCKET_INDEX + 1)
+        self.count = 0
+        self.max = 0
+
+    @classmethod
+    def bucket_index(cls, microseconds: int):
+        if microseconds < 2 * cls.SUB_BUCKETS:
+            return microseconds
+        shift = microseconds.bit_length() - 4
+        return min((shift << 3) + (microseconds >> shift), cls.MAX_BUCKET_INDEX)
+
+    @classmethod
+    def bucket_upper_bound(cls, index: int):
+        """Returns the smallest duration in microseconds above the bucket <index>"""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index + 1
+        shift = (index >> 3) - 1
+        return ((index & 7) + 9) << shift
+
+    def add(self, duration: float):
+        """Add a <duration> in seconds"""
+        microseconds = int(duration * 1000000)
+        if microseconds < 0:
+            microseconds = 0
+        self.counts[self.bucket_index(microseconds)] += 1
+        self.count += 1
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, p: float):
+        """Returns an upper bound in seconds of the <p> percentile (0-100)"""
+        if self.count == 0:
+            return None
+        target = self.count * p / 100
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            cumulated += count
+            if count and cumulated >= target:
+                # The last bucket has no upper bound, only the max is known
+                if index == self.MAX_BUCKET_INDEX:
+                    return self.max
+                return min(self.bucket_upper_bound(index) / 1000000, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+class InputLatency:
+    """Latency of each stage of the processing of input reports of a controller.
+    start() is called when the report is received, then mark() at the end of each stage, and finish() once fully processed
+    """
+    STAGES = ("decode", "motion", "mouse", "mapping", "virtual_controller", "total")
+
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.received_time = None
+        self.last_time = None
+
+    def start(self, received_time: float = None):
+        self.received_time = self.last_time = time.perf_counter() if received_time is None else received_time
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.histograms[stage].add(now - self.last_time)
+        self.last_time = now
+
+    def finish(self):
+        self.histograms["total"].add(time.perf_counter() - self.received_time)
+
+    def summary(self):
+        """Returns count, p50, p95, p99 and max in seconds of each stage"""
+        return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+
+    def format_summary(self):
+        lines = []
+        for stage, s in self.summary().items():
+            if s["count"]:
+                lines.append(f"{stage: <18} n={s['count']: <8} p50={s['p50'] * 1000:.3f}ms p95={s['p95'] * 1000:.3f}ms p99={s['p99'] * 1000:.3f}ms max={s['max'] * 1000:.3f}ms")
+        return "\n".join(lines)
+
+class ReportStats:
+    """Report rate, loss and jitter of a controller, derived from the time counter of its reports and the host reception time.
+    Stats are computed over successive windows of <window> seconds
+    """
+    # Unit of ControllerInputData.time
+    TIME_SECONDS_PER_TICK = 0.000001
+    # A time delta this much bigger than the report interval means reports were lost
+    GAP_FACTOR = 1.5
+    # The report interval starts from the median of this many first time deltas, a single one could be a gap or a burst
+    SEED_DELTAS = 8
+
+    def __init__(self, window: float = 2):
+        self.window = window
+        self.interval: float = None
+        self.seed_deltas: list[float] = []
+        self.last_time: int = None
+        self.last_received_time: float = None
+        self.jitter = 0.0
+        self.total = {"received": 0, "lost": 0, "duplicates": 0, "reordered": 0}
+        self.window_start_time: float = None
+        self.window_counts = dict(self.total)
+        self.last_window: dict = None
+
+    def update(self, time: int, received_time: float):
+        """<time> is the controller time counter of the report, <received_time> the host time in seconds it was received at"""
+        if self.window_start_time is None:
+            self.window_start_time = received_time
+        elif received_time - self.window_start_time >= self.window:
+            self.end_window(received_time)
+
+        counts = self.window_counts
+        counts["received"] += 1
+        last_time = self.last_time
+        if last_time is not None:
+            # signed difference of the 32 bits counter
+            delta = ((time - last_time + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+            if delta == 0:
+                counts["duplicates"] += 1
+                return
+            if delta < 0:
+                # Older than the last report, keep the newest as reference
+                counts["reordered"] += 1
+                return
+
+            delta_seconds = delta * self.TIME_SECONDS_PER_TICK
+            if self.interval is None:
+                self.seed_deltas.append(delta_seconds)
+                if len(self.seed_deltas) == self.SEED_DELTAS:
+                    # Losses of the seed deltas are only known now, they are counted in the current window
+                    self.interval = statistics.median(self.seed_deltas)
+                    for seed_delta in self.seed_deltas:
+                        self.add_delta(seed_delta, counts)
+                    self.seed_deltas = []
+            else:
+                self.add_delta(delta_seconds, counts)
+
+            # Inter-arrival jitter (RFC 3550)
+            transit_difference = (received_time - self.last_received_time) - delta_seconds
+            self.jitter += (abs(transit_difference) - self.jitter) / 16
+
+        self.last_time = time
+        self.last_received_time = received_time
+
+    def add_delta(self, delta_seconds: float, counts: dict):
+        """Count the reports lost in <delta_seconds>, or adapt the report interval to it"""
+        if delta_seconds > self.GAP_FACTOR * self.interval:
+            counts["lost"] += round(delta_seconds / self.interval) - 1
+        else:
+            self.interval += (delta_seconds - self.interval) / 16
+
+    def end_window(self, now: float):
+        counts = self.window_counts
+        duration = now - self.window_start_time
+        expected = counts["received"] + counts["lost"]
+        self.last_window = {
+            **counts,
+            "hz": counts["received"] / duration if duration > 0 else 0,
+            "loss_rate": counts["lost"] / expected if expected else 0,
+            "jitter": self.jitter,
+            "interval": self.interval,
+        }
+        for k, v in counts.items():
+            self.total[k] += v
+        self.window_counts = dict.fromkeys(counts, 0)
+        self.window_start_time = now
+
+    def summary(self):
+        """Returns the stats of the last complete window, and the totals"""
+        total = {k: v + self.window_counts[k] for k, v in self.total.items()}
+        expected = total["received"] + total["lost"]
+        return {
+            "window": self.last_window,
+            "total": {**total, "loss_rate": total["lost"] / expected if expected else 0},
+        }
+
+    def format_summary(self):
+        s = self.summary()
+        total = s["total"]
+        text = f"received {total['received']}, lost {total['lost']} ({total['loss_rate']:.1%}), duplicates {total['duplicates']}, reordered {total['reordered']}"
+        if self.interval:
+            text += f", report interval {self.interval * 1000:.2f}ms, jitter {self.jitter * 1000:.2f}ms"
+        window = s["window"]
+        if window is not None:
+            text += f", last {self.window}s : {window['hz']:.1f}Hz, lost {window['loss_rate']:.1%}"
+        return text
@@ -0,0 +1,118 @@
+"""Orientation estimation from the controllers accelerometer and gyroscope
+"""
+import math
+
+# Raw sensor units
+ACCEL_G_PER_LSB = 1 / 4096
+GYRO_DPS_PER_LSB = 2000 / 32768
+GYRO_RAD_PER_LSB = math.radians(GYRO_DPS_PER_LSB)
+# Unit of ControllerInputData.time
+TIME_SECONDS_PER_TICK = 0.000001
+
+# Samples further apart are not integrated
+MAX_SAMPLE_INTERVAL = 0.1
+
+# Mahony filter gain, how fast the accelerometer corrects the orientation
+DEFAULT_KP = 1.0
+
+# Rest detection, to learn the gyroscope bias
+REST_ACCEL_TOLERANCE = 0.05 # g
+REST_GYRO_TOLERANCE = 1.5 / GYRO_DPS_PER_LSB # variation around the recent mean, in raw units
+REST_GYRO_MAX = 10 / GYRO_DPS_PER_LSB # bias can't be higher than that, in raw units
+REST_MIN_DURATION = 0.5 # seconds
+GYRO_MEAN_FACTOR = 0.1
+BIAS_LEARNING_FACTOR = 0.02
+
+class MotionEstimator:
+    """Mahony orientation filter, integrating with the controller own timestamps,
+    and learning the gyroscope bias while the controller is at rest
+    """
+    def __init__(self, kp: float = DEFAULT_KP):
+        self.kp = kp
+        self.q0, self.q1, self.q2, self.q3 = 1.0, 0.0, 0.0, 0.0
+        self.gyro_bias = [0.0, 0.0, 0.0]
+        self.gyro_mean = [0.0, 0.0, 0.0]
+        self.corrected_gyroscope = (0, 0, 0)
+        self.last_time = None
+        self.rest_duration = 0.0
+        self.at_rest = False
+
+    @property
+    def quaternion(self):
+        """Orientation as (w, x, y, z), in the controller sensors frame"""
+        return self.q0, self.q1, self.q2, self.q3
+
+    def reset(self):
+        self.q0, self.q1, self.q2, self.q3 = 1.0, 0.0, 0.0, 0.0
+        self.last_time = None
+        self.rest_duration = 0.0
+
+    def update_batch(self, samples):
+        """Update with several (time, accelerometer, gyroscope) samples, oldest first"""
+        for time, accelerometer, gyroscope in samples:
+            self.update(time, accelerometer, gyroscope)
+
+    def update(self, time: int, accelerometer: tuple[int, int, int], gyroscope: tuple[int, int, int]):
+        """Update with raw sensor values, <time> being the controller timestamp"""
+        last_time = self.last_time
+        self.last_time = time
+        dt = ((time - last_time) & 0xFFFFFFFF) * TIME_SECONDS_PER_TICK if last_time is not None else 0
+
+        gx, gy, gz = gyroscope
+        ax, ay, az = accelerometer[0] * ACCEL_G_PER_LSB, accelerometer[1] * ACCEL_G_PER_LSB, accelerometer[2] * ACCEL_G_PER_LSB
+        accel_norm = math.sqrt(ax * ax + ay * ay + az * az)
+
+        # Gyroscope bias, learned while at rest
+        mean = self.gyro_mean
+        mean[0] += (gx - mean[0]) * GYRO_MEAN_FACTOR
+        mean[1] += (gy - mean[1]) * GYRO_MEAN_FACTOR
+        mean[2] += (gz - mean[2]) * GYRO_MEAN_FACTOR
+        if (abs(accel_norm - 1) < REST_ACCEL_TOLERANCE and
+                abs(gx - mean[0]) < REST_GYRO_TOLERANCE and abs(gy - mean[1]) < REST_GYRO_TOLERANCE and abs(gz - mean[2]) < REST_GYRO_TOLERANCE and
+                abs(mean[0]) < REST_GYRO_MAX and abs(mean[1]) < REST_GYRO_MAX and abs(mean[2]) < REST_GYRO_MAX):
+            self.rest_duration += dt
+        else:
+            self.rest_duration = 0.0
+        self.at_rest = self.rest_duration >= REST_MIN_DURATION
+        bias = self.gyro_bias
+        if self.at_rest:
+            bias[0] += (gx - bias[0]) * BIAS_LEARNING_FACTOR
+            bias[1] += (gy - bias[1]) * BIAS_LEARNING_FACTOR
+            bias[2] += (gz - bias[2]) * BIAS_LEARNING_FACTOR
+
+        gx -= bias[0]
+        gy -= bias[1]
+        gz -= bias[2]
+        self.corrected_gyroscope = round(gx), round(gy), round(gz)
+
+        if dt <= 0 or dt > MAX_SAMPLE_INTERVAL:
+            return
+
+        gx *= GYRO_RAD_PER_LSB
+        gy *= GYRO_RAD_PER_LSB
+        gz *= GYRO_RAD_PER_LSB
+        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
+
+        # Correct the rotation rate with the error between measured and estimated gravity,
+        # only when the accelerometer mostly measures gravity
+        if 0.5 < accel_norm < 1.5:
+            ax /= accel_norm
+            ay /= accel_norm
+            az /= accel_norm
+            vx = 2 * (q1 * q3 - q0 * q2)
+            vy = 2 * (q0 * q1 + q2 * q3)
+            vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+            gx += self.kp * (ay * vz - az * vy)
+            gy += self.kp * (az * vx - ax * vz)
+            gz += self.kp * (ax * vy - ay * vx)
+
+        half_dt = 0.5 * dt
+        gx *= half_dt
+        gy *= half_dt
+        gz *= half_dt
+        q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                          q1 + q0 * gx + q2 * gz - q3 * gy,
+                          q2 + q0 * gy - q1 * gz + q3 * gx,
+                          q3 + q0 * gz + q1 * gy - q2 * gx)
+        norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q0, self.q1, self.q2, self.q3 = q0 * norm, q1 * norm, q2 * norm, q3 * norm
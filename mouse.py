@@ -0,0 +1,110 @@
+"""Mouse output of joycons used as a mouse
+"""
+import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from utils import signed_looping_difference_16bit
+
+# Same values as win32con
+MOUSEEVENTF_MOVE = 0x0001
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+MOUSEEVENTF_RIGHTDOWN = 0x0008
+MOUSEEVENTF_RIGHTUP = 0x0010
+MOUSEEVENTF_MIDDLEDOWN = 0x0020
+MOUSEEVENTF_MIDDLEUP = 0x0040
+MOUSEEVENTF_WHEEL = 0x0800
+
+# Minimum stick value to scroll
+SCROLL_THRESHOLD = 0.2
+SCROLL_SPEED = 60
+
+@dataclass
+class MouseState:
+    x: int
+    y: int
+    lb: bool
+    mb: bool
+    rb: bool
+
+class MouseSink(ABC):
+    """Receives the mouse events of a report, all at once"""
+    @abstractmethod
+    def send(self, dx: int, dy: int, button_flags: int, wheel: int):
+        """Sends the movement, button flags (MOUSEEVENTF_*) and wheel of a report"""
+
+class Win32MouseSink(MouseSink):
+    """Injects mouse events with a single mouse_event call per report"""
+    def __init__(self):
+        import win32api
+        self.mouse_event = win32api.mouse_event
+
+    def send(self, dx: int, dy: int, button_flags: int, wheel: int):
+        flags = button_flags
+        if dx or dy:
+            flags |= MOUSEEVENTF_MOVE
+        if wheel:
+            flags |= MOUSEEVENTF_WHEEL
+        if flags:
+            self.mouse_event(flags, dx, dy, wheel, 0)
+
+class MemoryMouseSink(MouseSink):
+    """Keeps mouse events in memory, for tests and benchmarks"""
+    def __init__(self):
+        self.events: list[tuple[int, int, int, int]] = []
+        self.x = 0
+        self.y = 0
+
+    def send(self, dx: int, dy: int, button_flags: int, wheel: int):
+        if dx or dy or button_flags or wheel:
+            self.events.append((dx, dy, button_flags, wheel))
+            self.x += dx
+            self.y += dy
+
+def create_default_mouse_sink():
+    return Win32MouseSink() if sys.platform == "win32" else MemoryMouseSink()
+
+def button_transition_flags(state: bool, prev_state: bool, down_flag: int):
+    if state and not prev_state:
+        return down_flag
+    if not state and prev_state:
+        # up flag is always the next bit
+        return down_flag << 1
+    return 0
+
+class MouseOutput:
+    """Converts the successive mouse states of a controller into relative mouse events.
+    The fractional part of movements is kept so that slow movements are not lost
+    """
+    def __init__(self, sink: MouseSink):
+        self.sink = sink
+        self.previous_state: MouseState = None
+        self.remainder_x = 0.0
+        self.remainder_y = 0.0
+
+    def reset(self):
+        """To be called when the controller stops being used as a mouse"""
+        self.previous_state = None
+        self.remainder_x = 0.0
+        self.remainder_y = 0.0
+
+    def update(self, state: MouseState, scroll_value: float, sensitivity: float, scroll_sensitivity: float):
+        previous_state = self.previous_state
+        self.previous_state = state
+        if previous_state is None:
+            return
+
+        move_x = signed_looping_difference_16bit(previous_state.x, state.x) * sensitivity + self.remainder_x
+        move_y = signed_looping_difference_16bit(previous_state.y, state.y) * sensitivity + self.remainder_y
+        dx = int(move_x)
+        dy = int(move_y)
+        self.remainder_x = move_x - dx
+        self.remainder_y = move_y - dy
+
+        button_flags = (button_transition_flags(state.lb, previous_state.lb, MOUSEEVENTF_LEFTDOWN) |
+                        button_transition_flags(state.mb, previous_state.mb, MOUSEEVENTF_MIDDLEDOWN) |
+                        button_transition_flags(state.rb, previous_state.rb, MOUSEEVENTF_RIGHTDOWN))
+
+        wheel = int(scroll_value * SCROLL_SPEED * scroll_sensitivity) if abs(scroll_value) > SCROLL_THRESHOLD else 0
+
+        self.sink.send(dx, dy, button_flags, wheel)
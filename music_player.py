@@ -1,22 +1,34 @@
-import usb.core
-import usb.util
 import sys
-import hid
-import asyncio, threading
-from utils import decodeu, reverse_bits, get_stick_xy, decodes
+import threading
+from utils import decodeu
 import time
 import traceback
-from decimal import Decimal, ROUND_HALF_EVEN
 import json
-import pretty_midi
-import datetime
-import math
+import hashlib
+import os
+import numpy as np
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from controller import StickCalibrationData, VibrationData
+from metrics import LatencyHistogram
+from procon2_usb import find_usb_device
+from vibration import VIBRATION_KEEPALIVE_INTERVAL, frequencies_to_codes, encode_samples
 
 VENDOR_ID = 0x057E 
 PRODUCT_ID = 0x2069
 USB_INTERFACE_NUMBER = 1
 
+HAPTIC_REPORT_ID = 0x02
+HAPTIC_FRAME_SIZE = 17
+
+# Compiled songs are cached in this directory
+MUSIC_CACHE_DIR = "music_cache"
+# To be incremented when the compiled format or the compilation changes
+MUSIC_CACHE_VERSION = 4
+
+# The scheduler sleeps until this many seconds before a frame deadline, then waits actively
+SCHEDULER_SPIN_MARGIN = 0.002
+
 # Commands and subcommands
 COMMAND_LEDS = 0x09
 SUBCOMMAND_LEDS_SET_PLAYER = 0x07
@@ -66,273 +78,583 @@ LED_PATTERN = {
     8: 0x06,
 }
 
-print('Finding NS2 Pro Controller...')
-dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
-
-if dev is None:
-    print("Device not found")
-    sys.exit(1)
-
-print('Device found')
-
-try:
-    dev.set_configuration()
-    usb.util.claim_interface(dev, USB_INTERFACE_NUMBER)
-except usb.core.USBError as e:
-    # リソースがビジーな場合は、すでに設定されている可能性がある
-    if e.errno == 16: # Resource Busy
-        print("Interface Busy")
-    else:
-        print(f"Failed to init device: {e}")
-        sys.exit(1)
-
-# 3. Bulk転送用のエンドポイントを検索
-cfg = dev.get_active_configuration()
-intf = cfg[(USB_INTERFACE_NUMBER, 0)]
-
-# OUT (PC -> デバイス) のBulkエンドポイントを探す
-ep_out = usb.util.find_descriptor(
-    intf,
-    custom_match=lambda e:
-        usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT and
-        usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
-)
-
-# IN (デバイス -> PC) のBulkエンドポイントを探す
-ep_in = usb.util.find_descriptor(
-    intf,
-    custom_match=lambda e:
-        usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN and
-        usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
-)
-
-def set_leds(player_number: int):
-    """Set the player indicator led to the specified <player_number>"""
-    if player_number > 8:
-        player_number = 8
-
-    value = LED_PATTERN[player_number]
-        
-    # crash if less than 4 bytes of data, even though only one byte seems significant
-    data = value.to_bytes().ljust(4, b'\0')
-    write_command(COMMAND_LEDS, SUBCOMMAND_LEDS_SET_PLAYER, data)
-
-def write_command(command_id: int, subcommand_id: int, command_data = b''):
-    """Generic write command method"""
-    command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
-    bytes_written = ep_out.write(command_buffer)
-    response_buffer = dev.read(ep_in.bEndpointAddress, 32, timeout=500)
-    if len(response_buffer) < 8 or response_buffer[0] != command_id or response_buffer[1] != 0x01:
-        raise Exception(f"Unexpected response : {response_buffer}")
-    
-    return response_buffer[8:]
-
-def enableFeatures(feature_flags: int):
-    """Enable or disable features according to <feature_flags>"""
-    write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_INIT, feature_flags.to_bytes().ljust(4, b'\0'))
-    write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_ENABLE, feature_flags.to_bytes().ljust(4, b'\0'))
-
-if ep_out is None or ep_in is None:
-    print("Endpoint not found")
-    sys.exit(1)
-
-def read_memory(length: int, address: int):
-    """Returns the requested <length> bytes of data located at <address>"""
-    if length > 0x4F:
-        raise Exception("Maximum read size is 0x4F bytes")
-    data = write_command(COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, length.to_bytes() + b'\x7e\0\0' + address.to_bytes(length=4,byteorder='little'))
-    # Ensure the response is the data we requested
-    if (data[0] != length or decodeu(data[4:8]) != address):
-        raise Exception(f"Unexpected response from read commmand : {data}")
-    return data[8:]
-
-def read_calibration_data():
-    """Returns a tuple with calibration data of left and right stick (if present)"""
-    calibration_data_1 = read_memory(0x0b, CALIBRATION_USER_JOYSTICK_1)
-    if (decodeu(calibration_data_1[:3]) == 0xFFFFFF):
-        calibration_data_1 = read_memory(0x0b, CALIBRATION_JOYSTICK_1)
-    calibration_data_2 = read_memory(0x0b, CALIBRATION_USER_JOYSTICK_2)
-    if (decodeu(calibration_data_2[:3]) == 0xFFFFFF):
-        calibration_data_2 = read_memory(0x0b, CALIBRATION_JOYSTICK_2)
-    return StickCalibrationData(calibration_data_1), StickCalibrationData(calibration_data_2)
-
-next_vibration_event: asyncio.Event = None
-vibration_packet_id = 0
-device = None
-
-def set_vibration(vibration: VibrationData):
-    global vibration_packet_id
-    """Set vibration data"""
-    payload = (b'\x02' + (0x50 + (vibration_packet_id & 0x0F)).to_bytes() + vibration.get_bytes()).ljust(17, b'\0')
-    if device:
-        # print(payload.hex(" "))
+class MusicController:
+    """A Pro Controller 2 connected by USB, initialized through its bulk endpoints and playing vibrations through its hid device.
+    <usb_device> can be None for a fake controller
+    """
+    def __init__(self, hid_device, usb_device = None):
+        self.hid_device = hid_device
+        self.usb_device = usb_device
+        self.ep_out = None
+        self.ep_in = None
+        self.vibration_packet_id = 0
+
+    @classmethod
+    def find_all(cls):
+        """Returns all connected controllers, initialized"""
+        # Only needed for real controllers, the fake ones play without pyusb and hidapi
+        import hid
+        import usb.core
+        print('Finding NS2 Pro Controller...')
+        usb_devices = list(usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID))
+        hid_infos = hid.enumerate(VENDOR_ID, PRODUCT_ID)
+        if not usb_devices or not hid_infos:
+            raise Exception("Device not found")
+        print(f'{len(usb_devices)} device(s) found')
+
+        controllers = []
+        # Each hid device is paired with the pyusb device of the same controller, LEDs and haptics would otherwise go to different pads
+        for index, hid_info in enumerate(hid_infos):
+            try:
+                usb_device = find_usb_device(hid_info, usb_devices, len(hid_infos) - index)
+            except Exception as e:
+                print(f"{e}, ignoring it")
+                continue
+            usb_devices.remove(usb_device)
+            hid_device = hid.device()
+            hid_device.open_path(hid_info["path"])
+            controller = cls(hid_device, usb_device)
+            controller.init_usb()
+            controller.write_command(COMMAND_USB, SUBCOMMAND_INIT, bytes.fromhex("01 00 FF FF FF FF FF FF"))
+            # controller.write_command(COMMAND_USB, SUBCOMMAND_REPORT_TYPE, bytes.fromhex("05 00 00 00"))
+            controller.enableFeatures(FEATUER_VIBRATION)
+            print(f"Opened HID Device: {hid_device.get_manufacturer_string()} {hid_device.get_product_string()}")
+            hid_device.set_nonblocking(1)
+            controllers.append(controller)
+        for usb_device in usb_devices:
+            print(f"No HID device found for the USB device {usb_device.bus}:{usb_device.address}, ignoring it")
+        if not controllers:
+            raise Exception("No device could be opened")
+        return controllers
+
+    def init_usb(self):
+        """Claim the interface of the controller and find its bulk endpoints"""
+        import usb.core
+        import usb.util
+        dev = self.usb_device
+        try:
+            dev.set_configuration()
+            usb.util.claim_interface(dev, USB_INTERFACE_NUMBER)
+        except usb.core.USBError as e:
+            # リソースがビジーな場合は、すでに設定されている可能性がある
+            if e.errno == 16: # Resource Busy
+                print("Interface Busy")
+            else:
+                raise Exception(f"Failed to init device: {e}")
+
+        # 3. Bulk転送用のエンドポイントを検索
+        cfg = dev.get_active_configuration()
+        intf = cfg[(USB_INTERFACE_NUMBER, 0)]
+
+        # OUT (PC -> デバイス) のBulkエンドポイントを探す
+        self.ep_out = usb.util.find_descriptor(
+            intf,
+            custom_match=lambda e:
+                usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT and
+                usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
+        )
+
+        # IN (デバイス -> PC) のBulkエンドポイントを探す
+        self.ep_in = usb.util.find_descriptor(
+            intf,
+            custom_match=lambda e:
+                usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN and
+                usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
+        )
+
+        if self.ep_out is None or self.ep_in is None:
+            raise Exception("Endpoint not found")
+
+    def set_leds(self, player_number: int):
+        """Set the player indicator led to the specified <player_number>"""
+        if player_number > 8:
+            player_number = 8
+
+        self.set_led_value(LED_PATTERN[player_number])
+
+    def set_led_value(self, value: int):
+        """Set the raw value of the player leds"""
+        if self.usb_device is not None:
+            # crash if less than 4 bytes of data, even though only one byte seems significant
+            self.write_command(COMMAND_LEDS, SUBCOMMAND_LEDS_SET_PLAYER, value.to_bytes().ljust(4, b'\0'))
+
+    def write_command(self, command_id: int, subcommand_id: int, command_data = b''):
+        """Generic write command method"""
+        command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
+        self.ep_out.write(command_buffer)
+        response_buffer = self.usb_device.read(self.ep_in.bEndpointAddress, 32, timeout=500)
+        if len(response_buffer) < 8 or response_buffer[0] != command_id or response_buffer[1] != 0x01:
+            raise Exception(f"Unexpected response : {response_buffer}")
+
+        return response_buffer[8:]
+
+    def enableFeatures(self, feature_flags: int):
+        """Enable or disable features according to <feature_flags>"""
+        self.write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_INIT, feature_flags.to_bytes().ljust(4, b'\0'))
+        self.write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_ENABLE, feature_flags.to_bytes().ljust(4, b'\0'))
+
+    def read_memory(self, length: int, address: int):
+        """Returns the requested <length> bytes of data located at <address>"""
+        if length > 0x4F:
+            raise Exception("Maximum read size is 0x4F bytes")
+        data = self.write_command(COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, length.to_bytes() + b'\x7e\0\0' + address.to_bytes(length=4,byteorder='little'))
+        # Ensure the response is the data we requested
+        if (data[0] != length or decodeu(data[4:8]) != address):
+            raise Exception(f"Unexpected response from read commmand : {data}")
+        return data[8:]
+
+    def read_calibration_data(self):
+        """Returns a tuple with calibration data of left and right stick (if present)"""
+        calibration_data_1 = self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_1)
+        if (decodeu(calibration_data_1[:3]) == 0xFFFFFF):
+            calibration_data_1 = self.read_memory(0x0b, CALIBRATION_JOYSTICK_1)
+        calibration_data_2 = self.read_memory(0x0b, CALIBRATION_USER_JOYSTICK_2)
+        if (decodeu(calibration_data_2[:3]) == 0xFFFFFF):
+            calibration_data_2 = self.read_memory(0x0b, CALIBRATION_JOYSTICK_2)
+        return StickCalibrationData(calibration_data_1), StickCalibrationData(calibration_data_2)
+
+    def send_frame(self, frame: bytes):
+        """Send a vibration frame, its packet id byte is set here"""
+        payload = bytearray(frame)
+        payload[1] = 0x50 + (self.vibration_packet_id & 0x0F)
         try:
-            device.write(payload)
+            self.hid_device.write(payload)
         except Exception:
             traceback.print_exc()
-    vibration_packet_id += 1
-    if vibration_packet_id > 9:
-        vibration_packet_id = 0
-
-A = 403.1279
-B = 0.00718869
-
-def stop_vibration():
-    vib = VibrationData()
-    vib.hf_amp = 0
-    vib.lf_amp = 0
-    set_vibration(vib)
-
-sound =  [
-    [261, 523, 1], # C5 
-    [293, 493, 1], # D5 
-    [329, 440, 1], # E5 
-    [349, 391, 1], # F5 
-    [391, 349, 1], # G5 
-    [440, 329, 1], # A6 
-    [493, 293, 1], # B6 
-    [523, 261, 1], # C6 
-]
-
-def freq_to_code(freq):
-    """周波数(Hz)からコード値を計算"""
-    return int(math.log(freq / A) / B)
+        self.vibration_packet_id += 1
+        if self.vibration_packet_id > 9:
+            self.vibration_packet_id = 0
+
+    def set_vibration(self, vibration: VibrationData):
+        """Set vibration data"""
+        self.send_frame((HAPTIC_REPORT_ID.to_bytes() + b'\0' + vibration.get_bytes()).ljust(HAPTIC_FRAME_SIZE, b'\0'))
+
+    def stop_vibration(self):
+        vib = VibrationData()
+        vib.hf_amp = 0
+        vib.lf_amp = 0
+        self.set_vibration(vib)
+
+    def close(self):
+        self.hid_device.close()
+        if self.usb_device is not None:
+            import usb.util
+            usb.util.release_interface(self.usb_device, USB_INTERFACE_NUMBER)
+            usb.util.dispose_resources(self.usb_device)
 
 def midi_note_to_freq(note_number):
     """MIDIノート番号→周波数(Hz)"""
     return 440.0 * (2 ** ((note_number - 69) / 12))
 
-def calculate_frequency(key):
-    freq = (2**((key-69)/12))*440
-    freq_int = int(Decimal(str(freq)).quantize(Decimal('1'), rounding=ROUND_HALF_EVEN))
-    return freq_int
+@dataclass
+class SongTimeline:
+    """Precomputed vibration frames of a song, for each controller.
+    frames[i, c] (packet id byte left to 0) is to be sent to controller c <times[i]> seconds after the start,
+    while <note_counts[i, c]> of its tones are playing
+    """
+    times: np.ndarray
+    frames: np.ndarray
+    note_counts: np.ndarray
+
+    @property
+    def controller_count(self):
+        return self.frames.shape[1]
+
+def load_notes(song_path: str, instruments: list[int]):
+    """Parse the MIDI file once, returns start times, end times, pitches and priorities of the notes of <instruments>, sorted by start time.
+    Notes of the instruments listed first have priority, then the loudest notes
+    """
+    # Only needed when the song is not in the cache
+    import pretty_midi
+    midi = pretty_midi.PrettyMIDI(song_path)
+    notes = [(rank, note) for rank, i in enumerate(instruments) for note in midi.instruments[i].notes]
+    starts = np.array([note.start for _, note in notes], dtype=np.float64)
+    ends = np.array([note.end for _, note in notes], dtype=np.float64)
+    pitches = np.array([note.pitch for _, note in notes], dtype=np.float64)
+    priorities = np.array([(len(instruments) - rank) * 128 + note.velocity for rank, note in notes], dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    return starts[order], ends[order], pitches[order], priorities[order]
+
+def pitches_to_codes(pitches: np.ndarray, pitch_mult: float):
+    """Vibration frequency codes of MIDI note numbers, same as frequency_to_code(round(midi_note_to_freq(pitch)) * pitch_mult)"""
+    return frequencies_to_codes(np.rint(midi_note_to_freq(pitches)) * pitch_mult)
+
+class VoiceAllocator:
+    """Assigns playing notes to the tones of the controllers, tone v being the low (even v) or high (odd v) frequency tone of controller v // 2.
+    When all tones are used, a new note steals the tone of the playing note with the lowest priority, the oldest one for equal priorities,
+    unless that note has a higher priority. Notes without a tone get one back as soon as one is free.
+    Each note start or end is processed in O(voices + waiting notes)
+    """
+    def __init__(self, voice_count: int, priorities: np.ndarray):
+        self.voices = [-1] * voice_count
+        self.controller_loads = [0] * ((voice_count + 1) // 2)
+        self.priorities = priorities
+        # Playing notes without a tone
+        self.waiting: dict[int, None] = {}
+        self.stolen_count = 0
+        self.voiced_notes: set[int] = set()
+
+    def assign(self, voice: int, note: int):
+        self.voices[voice] = note
+        self.controller_loads[voice // 2] += 1
+        self.voiced_notes.add(note)
+
+    def release(self, voice: int):
+        self.voices[voice] = -1
+        self.controller_loads[voice // 2] -= 1
+
+    def free_voice(self):
+        """Returns a free tone of the least used controller, None if all are used"""
+        loads = self.controller_loads
+        best = None
+        for voice, note in enumerate(self.voices):
+            if note < 0 and (best is None or loads[voice // 2] < loads[best // 2]):
+                best = voice
+        return best
+
+    def note_on(self, note: int):
+        voice = self.free_voice()
+        if voice is None:
+            priorities = self.priorities
+            # Notes are processed in start order, so a lower note index is an older note
+            voice = min(range(len(self.voices)), key=lambda v: (priorities[self.voices[v]], self.voices[v]), default=None)
+            if voice is None or priorities[self.voices[voice]] > priorities[note]:
+                self.waiting[note] = None
+                return
+            self.waiting[self.voices[voice]] = None
+            self.release(voice)
+            self.stolen_count += 1
+        self.assign(voice, note)
+
+    def note_off(self, note: int):
+        if note in self.waiting:
+            del self.waiting[note]
+            return
+        if note not in self.voiced_notes:
+            # Empty note, never started
+            return
+        voice = self.voices.index(note)
+        self.release(voice)
+        if self.waiting:
+            # The best waiting note, the newest for equal priorities
+            priorities = self.priorities
+            waiting_note = max(self.waiting, key=lambda n: (priorities[n], n))
+            del self.waiting[waiting_note]
+            self.assign(voice, waiting_note)
+
+def compile_song(conf: dict, controller_count: int = 1):
+    """Compute the vibration frames of the song described by <conf>, for <controller_count> controllers.
+    A frame is generated each time notes start or end, using up to "sound_count" tones, 2 per controller
+    """
+    starts, ends, pitches, priorities = load_notes(conf["song"], conf["instruments"])
+    codes = pitches_to_codes(pitches, conf["pitch_mult"])
+    voice_count = min(conf["sound_count"], 2 * controller_count)
+    allocator = VoiceAllocator(voice_count, priorities.tolist())
+
+    # Note ends are processed before note starts happening at the same time
+    event_times = np.concatenate((ends, starts))
+    event_notes = np.concatenate((np.arange(len(ends)), np.arange(len(starts))))
+    event_is_start = np.concatenate((np.zeros(len(ends), dtype=bool), np.ones(len(starts), dtype=bool)))
+    order = np.lexsort((event_is_start, event_times))
+
+    times = []
+    voices = []
+    for t, note, is_start in zip(event_times[order].tolist(), event_notes[order].tolist(), event_is_start[order].tolist()):
+        if is_start:
+            if ends[note] > starts[note]:
+                allocator.note_on(note)
+        else:
+            allocator.note_off(note)
+        if times and times[-1] == t:
+            # Several events at the same time, keep the last state only
+            voices[-1] = list(allocator.voices)
+        else:
+            times.append(t)
+            voices.append(list(allocator.voices))
+
+    note_count = int(np.count_nonzero(ends > starts))
+    print(f"{note_count} notes, {allocator.stolen_count} tones stolen, {note_count - len(allocator.voiced_notes)} notes never played")
+
+    voices_array = np.full((len(times), 2 * controller_count), -1, dtype=np.int64)
+    if voice_count:
+        voices_array[:, :voice_count] = voices
+    # One (low, high) tone pair per controller
+    tones = voices_array.reshape(-1, 2)
+    lf_notes, hf_notes = tones[:, 0], tones[:, 1]
+    # Silent tones get the same values as stop_vibration
+    lf_freq = np.where(lf_notes >= 0, codes[lf_notes], VibrationData.lf_freq)
+    hf_freq = np.where(hf_notes >= 0, codes[hf_notes], VibrationData.hf_freq)
+    samples = encode_samples(
+        lf_freq, (lf_notes >= 0) & (lf_freq >= 0), np.where(lf_notes >= 0, conf["amp"], 0),
+        hf_freq, (hf_notes >= 0) & (hf_freq >= 0), np.where(hf_notes >= 0, conf["amp"], 0))
+
+    frames = np.zeros((len(times), controller_count, HAPTIC_FRAME_SIZE), dtype=np.uint8)
+    frames[:, :, 0] = HAPTIC_REPORT_ID
+    frames[:, :, 2:7] = samples.reshape(len(times), controller_count, 5)
+    note_counts = (tones >= 0).sum(axis=1).reshape(len(times), controller_count)
+    return SongTimeline(np.array(times, dtype=np.float64), frames, note_counts)
+
+def get_song_cache_key(conf: dict, controller_count: int):
+    """Hash of the song file and of the config values used to compile it"""
+    h = hashlib.sha256()
+    with open(conf["song"], "rb") as f:
+        h.update(f.read())
+    compile_conf = {key: conf[key] for key in ("instruments", "pitch_mult", "amp", "sound_count")}
+    h.update(json.dumps({"version": MUSIC_CACHE_VERSION, "controller_count": controller_count, **compile_conf}, sort_keys=True).encode())
+    return h.hexdigest()
+
+def load_song(conf: dict, controller_count: int = 1):
+    """Returns the compiled song, from the cache if it was already compiled with the same config"""
+    cache_path = os.path.join(MUSIC_CACHE_DIR, get_song_cache_key(conf, controller_count) + ".npz")
+    try:
+        with np.load(cache_path) as cached:
+            return SongTimeline(cached["times"], cached["frames"], cached["note_counts"])
+    except FileNotFoundError:
+        pass
+    except Exception:
+        traceback.print_exc()
 
-try:
+    timeline = compile_song(conf, controller_count)
+    try:
+        os.makedirs(MUSIC_CACHE_DIR, exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, times=timeline.times, frames=timeline.frames, note_counts=timeline.note_counts)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        traceback.print_exc()
+    return timeline
+
+class FakeHidDevice:
+    """Stands for the hid device of the controller, records the time of each write to measure timing without hardware"""
+    def __init__(self, write_latency: float = 0, clock = time.perf_counter):
+        self.write_latency = write_latency
+        self.clock = clock
+        self.writes: list[tuple[float, bytes]] = []
+
+    def write(self, data):
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        self.writes.append((self.clock(), bytes(data)))
+        return len(data)
+
+    def close(self):
+        pass
+
+class LedOutput:
+    """Sets the player leds of controllers from a thread, their commands wait for a response and would delay frames.
+    Only the latest value of each controller is sent
+    """
+    def __init__(self, controllers: list[MusicController]):
+        self.controllers = controllers
+        self.condition = threading.Condition()
+        self.pending: dict[int, int] = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Music leds", daemon=True)
+        self.thread.start()
+
+    def set(self, index: int, value: int):
+        with self.condition:
+            self.pending[index] = value
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                pending = self.pending
+                self.pending = {}
+            for index, value in pending.items():
+                try:
+                    self.controllers[index].set_led_value(value)
+                except Exception:
+                    traceback.print_exc()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+class MusicOutput:
+    """Sends the frames of each controller when they change, writing to the controllers concurrently so that chords land together.
+    Frames of controllers playing a note are sent again every keepalive interval, for the motors to keep vibrating
+    """
+    def __init__(self, controllers: list[MusicController]):
+        self.controllers = controllers
+        self.executor = ThreadPoolExecutor(len(controllers)) if len(controllers) > 1 else None
+        self.led_output = LedOutput(controllers)
+        self.last_frames: list[bytes] = [None] * len(controllers)
+        self.last_note_counts: list[int] = [None] * len(controllers)
+        self.last_write_times: list[float] = [0] * len(controllers)
+        self.writes = 0
+        self.keepalive_writes = 0
+        self.led_updates = 0
+
+    def update_controller(self, controller: MusicController, frame: bytes):
+        controller.send_frame(frame)
+
+    def send(self, frames: np.ndarray, note_counts: list[int], now: float):
+        """Send the <frames> of a time, one per controller"""
+        updates = []
+        for i, controller in enumerate(self.controllers):
+            frame = frames[i].tobytes()
+            if frame != self.last_frames[i]:
+                self.last_frames[i] = frame
+                self.last_write_times[i] = now
+                self.writes += 1
+                updates.append((controller, frame))
+            note_count = note_counts[i]
+            if note_count != self.last_note_counts[i]:
+                self.last_note_counts[i] = note_count
+                self.led_updates += 1
+                self.led_output.set(i, note_count)
+        self.write_updates(updates)
+
+    def next_keepalive_time(self, interval: float):
+        """Returns when the frame of a controller playing a note has to be sent again, None if no note is played"""
+        times = [t for t, count in zip(self.last_write_times, self.last_note_counts) if count]
+        return min(times) + interval if times else None
+
+    def keepalive(self, now: float, interval: float):
+        """Send again the frames of controllers playing a note that were not written for <interval>"""
+        updates = []
+        for i, controller in enumerate(self.controllers):
+            if self.last_note_counts[i] and now - self.last_write_times[i] >= interval:
+                self.last_write_times[i] = now
+                self.keepalive_writes += 1
+                updates.append((controller, self.last_frames[i]))
+        self.write_updates(updates)
+
+    def write_updates(self, updates: list[tuple[MusicController, bytes]]):
+        if len(updates) == 1 or self.executor is None:
+            for update in updates:
+                self.update_controller(*update)
+        elif updates:
+            for future in [self.executor.submit(self.update_controller, *update) for update in updates]:
+                future.result()
+
+    def stop(self):
+        self.led_output.stop()
+        for controller in self.controllers:
+            controller.stop_vibration()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+class FrameScheduler:
+    """Sends the frames of a timeline at their deadline.
+    Deadlines are all relative to the same monotonic start time so that delays never accumulate, and when late,
+    frames already replaced by the next one are skipped. While waiting, notes being played are kept vibrating
+    """
+    def __init__(self, output: MusicOutput, clock = time.perf_counter, sleep = time.sleep, spin_margin: float = SCHEDULER_SPIN_MARGIN,
+                 keepalive_interval: float = VIBRATION_KEEPALIVE_INTERVAL):
+        self.output = output
+        self.clock = clock
+        self.sleep = sleep
+        self.spin_margin = spin_margin
+        self.keepalive_interval = keepalive_interval
+        # Time between the deadline of a frame and the end of its write
+        self.onset_errors = LatencyHistogram()
+        self.sent_frames = 0
+        self.skipped_frames = 0
+
+    def wait_until(self, deadline: float):
+        """Wait until <deadline>, sending keepalives in the meantime"""
+        while True:
+            keepalive_time = self.output.next_keepalive_time(self.keepalive_interval)
+            # A keepalive right before the deadline would delay the frame, it is sent after it
+            if keepalive_time is None or keepalive_time >= deadline - self.spin_margin:
+                break
+            # Keepalives don't need the precision of frames, no active wait
+            remaining = keepalive_time - self.clock()
+            if remaining > 0:
+                self.sleep(remaining)
+            self.output.keepalive(self.clock(), self.keepalive_interval)
+        while True:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return
+            self.sleep(remaining - self.spin_margin if remaining > self.spin_margin else 0)
+
+    def run(self, timeline: SongTimeline):
+        times = timeline.times.tolist()
+        note_counts = timeline.note_counts.tolist()
+        frames = timeline.frames
+        frame_count = len(times)
+        start_time = self.clock()
+        for i in range(frame_count):
+            if i + 1 < frame_count and start_time + times[i + 1] <= self.clock():
+                self.skipped_frames += 1
+                continue
+
+            deadline = start_time + times[i]
+            self.wait_until(deadline)
+            self.output.send(frames[i], note_counts[i], self.clock())
+            self.onset_errors.add(self.clock() - deadline)
+            self.sent_frames += 1
+
+    def format_summary(self):
+        s = self.onset_errors.summary()
+        text = f"{self.sent_frames} frames sent, {self.skipped_frames} skipped, {self.output.writes} writes, {self.output.keepalive_writes} keepalives, {self.output.led_updates} led updates"
+        if s["count"]:
+            text += f", onset error p50={s['p50'] * 1000:.3f}ms p95={s['p95'] * 1000:.3f}ms p99={s['p99'] * 1000:.3f}ms max={s['max'] * 1000:.3f}ms"
+        return text
+
+def load_config(controller_count: int):
     with open("config.json", "r") as f:
         conf = json.load(f)
     print("Config loaded")
 
-    print("Initializing...")
-    write_command(COMMAND_USB, SUBCOMMAND_INIT, bytes.fromhex("01 00 FF FF FF FF FF FF"))
-    # write_command(COMMAND_USB, SUBCOMMAND_REPORT_TYPE, bytes.fromhex("05 00 00 00"))
-
-    #SET LED
-    enableFeatures(FEATUER_VIBRATION)
-    print("Initialized.")
-    device = hid.device()
-    device.open(VENDOR_ID, PRODUCT_ID)
-
-    print(f"Opened HID Device: {device.get_manufacturer_string()} {device.get_product_string()}")
-    print("Press Ctrl+C to stop")
-    device.set_nonblocking(1)
-
-    playingNotes = []
-    noteQueue = []
-    insts = conf["instruments"]
-    print(insts)
-    
-    try:
-        print("Loading Sound...")
-        for i in insts:
-            inst = pretty_midi.PrettyMIDI(conf["song"]).instruments[i]
-            for note in inst.notes:
-                noteQueue.append([note.start, note.end, freq_to_code(calculate_frequency(note.pitch) * conf["pitch_mult"])])
-
-        noteQueue.sort(key=lambda x: x[0])
+    print("Loading Sound...")
+    load_start = time.perf_counter()
+    timeline = load_song(conf, controller_count)
+    print(f"{len(timeline.times)} frames loaded in {(time.perf_counter() - load_start) * 1000:.1f}ms")
+    return conf, timeline
 
+def play(timeline: SongTimeline, controllers: list[MusicController]):
+    output = MusicOutput(controllers)
+    scheduler = FrameScheduler(output)
+    try:
         print("Play:")
-        startTime = datetime.datetime.now()
-        while len(noteQueue) > 0 or len(playingNotes) > 0:
-            now = datetime.datetime.now()
-            t = (now - startTime).total_seconds()
-
-            while True:
-                if len(noteQueue) <= 0 or noteQueue[0][0] > t:
-                    break
-                playingNotes.append(noteQueue[0])
-                noteQueue.pop(0)
-
-            # Process Queue
-            if len(playingNotes) <= 0:
-                # stop_vibration()
-                pass
-
-            for note in range(0, len(playingNotes), 2):
-                if note + 1 >= conf["sound_count"]:
-                    break
-
-                vib = VibrationData()
-                vib.lf_amp = conf["amp"]
-                vib.lf_freq = playingNotes[note][2]
-                vib.lf_en_tone = vib.lf_freq >= 0
-
-                if len(playingNotes) > note + 1 and note + 1 < conf["sound_count"]:
-                    vib.hf_amp = conf["amp"]
-                    vib.hf_freq = playingNotes[note + 1][2]
-                    vib.hf_en_tone = vib.hf_freq >= 0
-
-                set_vibration(vib)
-            
-            print(playingNotes)
-
-            data = len(playingNotes).to_bytes().ljust(4, b'\0')
-            write_command(COMMAND_LEDS, SUBCOMMAND_LEDS_SET_PLAYER, data)
-
-            if len(playingNotes) > 0:
-                while True:
-                    if len(playingNotes) <= 0 or playingNotes[0][1] > t:
-                        break
-                    playingNotes.pop(0)
-
-            # time.sleep(0.01)
-
+        scheduler.run(timeline)
     except KeyboardInterrupt:
         print("Interrupt")
     except Exception:
         traceback.print_exc()
     finally:
         print("Finished.")
-        stop_vibration()
-
-except usb.core.USBError as e:
-    print(f"Error while transfer: {e}")
-finally:
-    usb.util.release_interface(dev, USB_INTERFACE_NUMBER)
-    usb.util.dispose_resources(dev)
-
-
-# end_ms_last = 0
-# for note in notes:
-#     start_ms = note.start
-#     end_ms = note.end
-#     duration_ms = note.end - note.start
-#     rest_duration_ms = start_ms - end_ms_last
-#     # print(rest_duration_ms)
-#     # print(note.pitch)
-#     if inst.is_drum:
-#         pass
-#         # print("Drum Detected")
-#         # output += f'["drum", {note.pitch}],["rest", {duration_ms}],'
-#     else:
-#         freq = calculate_frequency(note.pitch)
-#         if rest_duration_ms and rest_duration_ms > 0:
-#             stop_vibration()
-#             print("Rest: " + str(rest_duration_ms))
-#             time.sleep(rest_duration_ms)
-#         # print(duration_ms)
-#         vib = VibrationData()
-#         vib.lf_amp = 100
-#         # vib.hf_amp = 200
-#         vib.lf_freq = freq_to_code(freq)
-#         vib.lf_en_tone = vib.lf_freq >= 0
-#         # vib.hf_freq = freq_to_code(s[1])
-#         # vib.hf_en_tone = vib.hf_freq >= 0
-#         # print(vib.lf_freq)
-#         # vib.lf_freq = s[0]
-#         # vib.hf_freq = s[0]
-#         # stop_vibration()
-#         # time.sleep(0.025)
-#         print("Play: " + str(duration_ms))
-#         send_vibration(vib)
-#         time.sleep(duration_ms)
-#     end_ms_last = end_ms
\ No newline at end of file
+        output.stop()
+        print(scheduler.format_summary())
+
+def main(args: list[str]):
+    """Usage: music_player.py [--fake [controller count]], --fake plays to fake devices instead of the USB controllers"""
+    # Transfer errors to report, only real controllers raise them
+    usb_errors = ()
+    if "--fake" in args:
+        index = args.index("--fake")
+        controller_count = int(args[index + 1]) if len(args) > index + 1 else 1
+        controllers = [MusicController(FakeHidDevice()) for _ in range(controller_count)]
+    else:
+        import usb.core
+        usb_errors = (usb.core.USBError,)
+        try:
+            controllers = MusicController.find_all()
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+
+    try:
+        conf, timeline = load_config(len(controllers))
+        print("Press Ctrl+C to stop")
+        play(timeline, controllers)
+    except usb_errors as e:
+        print(f"Error while transfer: {e}")
+    finally:
+        for controller in controllers:
+            controller.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,294 +1,579 @@
-import usb.core
-import usb.util
+"""Pro Controllers 2 connected by USB, fed to the same virtual controllers as bluetooth controllers
+
+Commands are sent through the bulk endpoints of the controller (pyusb), input reports are read and vibrations written
+through its hid device (hidapi). Each controller has a reader thread blocking on hid reads.
+"""
+import asyncio
+import logging
+import os
+import re
 import sys
-import platform
-import hid
-import asyncio, threading
-from utils import decodeu, reverse_bits, get_stick_xy, decodes
+import threading
 import time
-import vgamepad
-import vgamepad.win.vigem_commons as vcom
-from controller import ControllerInputData, StickCalibrationData, VibrationData
-from virtual_controller import VirtualController
-from config import CONFIG
-
-VENDOR_ID = 0x057E 
+from abc import ABC, abstractmethod
+from controller import (Controller, ControllerDevice, VibrationData, INPUT_REPORT_STRUCT, NINTENDO_VENDOR_ID, PRO_CONTROLLER2_PID,
+                        ADDRESS_CONTROLLER_INFO, CALIBRATION_JOYSTICK_1, CALIBRATION_JOYSTICK_2,
+                        COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, FEATURE_MOTION)
+from config import ConfigWatcher, get_config_file_path
+from metrics import LatencyHistogram
+from utils import decodeu
+from vibration import VIBRATION_KEEPALIVE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+VENDOR_ID = 0x057E
 PRODUCT_ID = 0x2069
 USB_INTERFACE_NUMBER = 1
 
-# Commands and subcommands
-COMMAND_LEDS = 0x09
-SUBCOMMAND_LEDS_SET_PLAYER = 0x07
-
+# USB only commands and subcommands
 COMMAND_USB = 0x03
 SUBCOMMAND_REPORT_TYPE = 0x0A
 SUBCOMMAND_INIT = 0x0D
 SUBCOMMAND_HAPTIC = 0x0A
 
-COMMAND_MEMORY = 0x02
-SUBCOMMAND_MEMORY_READ = 0x04
-
-COMMAND_VIBRATION = 0x0A
-SUBCOMMAND_VIBRATION_PLAY_PRESET = 0x02
+FEATUER_VIBRATION = 0x20
 
-COMMAND_PAIR = 0x15
-SUBCOMMAND_PAIR_SET_MAC = 0x01
-SUBCOMMAND_PAIR_LTK1 = 0x04
-SUBCOMMAND_PAIR_LTK2 = 0x02
-SUBCOMMAND_PAIR_FINISH = 0x03
+INPUT_REPORT_SIZE = 64
+VIBRATION_REPORT_ID = 0x02
+
+# Milliseconds a reader thread waits for a report before checking if it has to stop
+READ_TIMEOUT_MS = 100
+# Seconds between two enumerations of the plugged controllers
+HOTPLUG_INTERVAL = 1
+
+class UsbConnection(ABC):
+    """Blocking access to a controller, commands can be sent from any thread"""
+    @abstractmethod
+    def write_command(self, command_id: int, subcommand_id: int, command_data = b''):
+        """Returns the response data, without its 8 bytes header"""
+
+    @abstractmethod
+    def read_report(self, timeout_ms: int):
+        """Returns the next input report (with its report id), or empty bytes after <timeout_ms>.
+        Raises an exception if the controller is unplugged
+        """
+
+    @abstractmethod
+    def write_report(self, data: bytes):
+        """Writes an output report, <data> starting with its report id"""
+
+    def close(self):
+        pass
+
+class UsbBackend(ABC):
+    """Finds and opens controllers"""
+    @abstractmethod
+    def enumerate(self) -> dict[str, str]:
+        """Returns the serial number of the plugged controllers, by key"""
+
+    @abstractmethod
+    def open(self, key: str) -> UsbConnection:
+        """Opens the controller <key> from enumerate"""
+
+class HidUsbConnection(UsbConnection):
+    def __init__(self, usb_device, hid_device, on_close = None):
+        import usb.core
+        import usb.util
+        self.usb_device = usb_device
+        self.hid_device = hid_device
+        self.on_close = on_close
+        self.command_lock = threading.Lock()
+        try:
+            usb_device.set_configuration()
+            usb.util.claim_interface(usb_device, USB_INTERFACE_NUMBER)
+        except usb.core.USBError as e:
+            # リソースがビジーな場合は、すでに設定されている可能性がある
+            if e.errno == 16: # Resource Busy
+                logger.info("Interface Busy")
+            else:
+                raise Exception(f"Failed to init device: {e}")
+
+        # 3. Bulk転送用のエンドポイントを検索
+        cfg = usb_device.get_active_configuration()
+        intf = cfg[(USB_INTERFACE_NUMBER, 0)]
+
+        # OUT (PC -> デバイス) のBulkエンドポイントを探す
+        self.ep_out = usb.util.find_descriptor(
+            intf,
+            custom_match=lambda e:
+                usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT and
+                usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
+        )
+
+        # IN (デバイス -> PC) のBulkエンドポイントを探す
+        self.ep_in = usb.util.find_descriptor(
+            intf,
+            custom_match=lambda e:
+                usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN and
+                usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
+        )
+
+        if self.ep_out is None or self.ep_in is None:
+            raise Exception("Endpoint not found")
+
+    def write_command(self, command_id: int, subcommand_id: int, command_data = b''):
+        command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
+        with self.command_lock:
+            self.ep_out.write(command_buffer)
+            response_buffer = self.usb_device.read(self.ep_in.bEndpointAddress, 32, timeout=500)
+        if len(response_buffer) < 8 or response_buffer[0] != command_id or response_buffer[1] != 0x01:
+            raise Exception(f"Unexpected response : {response_buffer}")
+        return bytes(response_buffer[8:])
+
+    def read_report(self, timeout_ms: int):
+        return bytes(self.hid_device.read(INPUT_REPORT_SIZE, timeout_ms))
+
+    def write_report(self, data: bytes):
+        self.hid_device.write(data)
+
+    def close(self):
+        import usb.util
+        self.hid_device.close()
+        try:
+            usb.util.release_interface(self.usb_device, USB_INTERFACE_NUMBER)
+        except Exception:
+            logger.debug("Unable to release the interface", exc_info=True)
+        usb.util.dispose_resources(self.usb_device)
+        if self.on_close is not None:
+            self.on_close()
+
+def get_hid_location(path: bytes):
+    """Returns the USB location of the controller of a hid device path, ("address", bus, address) or ("port", bus, port numbers).
+    None if the path doesn't tell, only the libusb and Linux hidraw backends of hidapi give it
+    """
+    path = path.decode(errors="replace")
+    # libusb backend : bus:address:interface
+    match = re.fullmatch(r"([0-9a-fA-F]{4}):([0-9a-fA-F]{4}):([0-9a-fA-F]{2})", path)
+    if match:
+        return "address", int(match[1], 16), int(match[2], 16)
+    # hidraw backend : the sysfs path of the device contains bus-port.port:configuration.interface
+    if sys.platform == "linux" and path.startswith("/dev/hidraw"):
+        sysfs_path = os.path.realpath(f"/sys/class/hidraw/{os.path.basename(path)}/device")
+        for part in reversed(sysfs_path.split("/")):
+            match = re.fullmatch(r"(\d+)-([\d.]+):\d+\.\d+", part)
+            if match:
+                return "port", int(match[1]), tuple(int(p) for p in match[2].split("."))
+    return None
+
+def get_usb_serial_number(usb_device):
+    try:
+        return usb_device.serial_number
+    except Exception:
+        # No permission to read the string descriptors
+        return None
+
+def find_usb_device(hid_info: dict, usb_devices: list, hid_count: int):
+    """Returns the pyusb device among <usb_devices> of the controller of <hid_info> (from hid.enumerate), matched by serial number,
+    by USB location, or because it is the only controller left (<hid_count> hid devices for the <usb_devices>).
+    Raises an exception rather than guessing, the controller would otherwise get the commands and calibration of another one
+    """
+    serial_number = hid_info.get("serial_number")
+    if serial_number:
+        matches = [d for d in usb_devices if get_usb_serial_number(d) == serial_number]
+        if len(matches) == 1:
+            return matches[0]
+    location = get_hid_location(hid_info["path"])
+    if location is not None:
+        if location[0] == "address":
+            matches = [d for d in usb_devices if (d.bus, d.address) == location[1:]]
+        else:
+            matches = [d for d in usb_devices if d.bus == location[1] and tuple(d.port_numbers or ()) == location[2]]
+        if len(matches) == 1:
+            return matches[0]
+    # Unless both serial numbers could be read and differ
+    if len(usb_devices) == 1 and hid_count == 1 and not (serial_number and get_usb_serial_number(usb_devices[0]) not in (None, serial_number)):
+        return usb_devices[0]
+    raise Exception(f"Unable to find the USB device of {hid_info['path']} (serial number {serial_number!r}) among {len(usb_devices)} devices")
+
+class HidUsbBackend(UsbBackend):
+    """Controllers are enumerated with hidapi, then matched with their pyusb device, see find_usb_device"""
+    def __init__(self):
+        import hid
+        import usb.core
+        self.hid = hid
+        self.usb_core = usb.core
+        # (bus, address) of the opened pyusb devices, by key
+        self.opened_usb_devices: dict[str, tuple[int, int]] = {}
+
+    def enumerate(self):
+        return {info["path"].decode(): info["serial_number"] for info in self.hid.enumerate(VENDOR_ID, PRODUCT_ID)}
+
+    def open(self, key: str):
+        hid_infos = [info for info in self.hid.enumerate(VENDOR_ID, PRODUCT_ID) if info["path"].decode() not in self.opened_usb_devices]
+        hid_info = next((info for info in hid_infos if info["path"].decode() == key), None)
+        if hid_info is None:
+            raise Exception("HID device not found")
+        opened = set(self.opened_usb_devices.values())
+        usb_devices = [d for d in self.usb_core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID) if (d.bus, d.address) not in opened]
+        usb_device = find_usb_device(hid_info, usb_devices, len(hid_infos))
+        hid_device = self.hid.device()
+        hid_device.open_path(key.encode())
+        try:
+            connection = HidUsbConnection(usb_device, hid_device, lambda: self.opened_usb_devices.pop(key, None))
+        except Exception:
+            import usb.util
+            hid_device.close()
+            # Releases the interface if it was claimed
+            usb.util.dispose_resources(usb_device)
+            raise
+        self.opened_usb_devices[key] = usb_device.bus, usb_device.address
+        return connection
+
+class FakeUsbConnection(UsbConnection):
+    """Simulated Pro Controller 2, answering commands and sending an input report every <report_interval> seconds"""
+    def __init__(self, serial_number: str, report_interval: float):
+        self.serial_number = serial_number
+        self.report_interval = report_interval
+        self.unplugged = threading.Event()
+        self.next_report_time = time.perf_counter()
+        self.report_time = 0
+        self.commands: list[tuple[int, int, bytes]] = []
+        self.written_reports: list[tuple[float, bytes]] = []
+        self.reports_sent = 0
+
+    def memory(self, address: int, length: int):
+        if address == ADDRESS_CONTROLLER_INFO:
+            data = b"\0\0" + self.serial_number.encode().ljust(14, b"\0")[:14] + b"\0\0" + NINTENDO_VENDOR_ID.to_bytes(2, "little") + PRO_CONTROLLER2_PID.to_bytes(2, "little")
+        elif address in (CALIBRATION_JOYSTICK_1, CALIBRATION_JOYSTICK_2):
+            # center, max, min, as 12 bits x and y
+            data = b"".join((x | (y << 12)).to_bytes(3, "little") for x, y in ((0x800, 0x800), (0x600, 0x600), (0x600, 0x600)))
+        else:
+            data = b""
+        return data.ljust(length, b"\xFF")
+
+    def write_command(self, command_id: int, subcommand_id: int, command_data = b''):
+        if self.unplugged.is_set():
+            raise Exception("Device unplugged")
+        self.commands.append((command_id, subcommand_id, command_data))
+        if command_id == COMMAND_MEMORY and subcommand_id == SUBCOMMAND_MEMORY_READ:
+            length = command_data[0]
+            address = decodeu(command_data[4:8])
+            return command_data[:8] + self.memory(address, length)
+        return b""
+
+    def create_report(self):
+        # Time counter in microseconds, sticks centered, at rest
+        self.report_time = (self.report_time + round(self.report_interval * 1000000)) & 0xFFFFFFFF
+        report = INPUT_REPORT_STRUCT.pack(self.report_time, 0, 0x800 | (0x800 << 12) & 0xFFFF, 0x80, 0x800 | (0x800 << 12) & 0xFFFF, 0x80,
+                                          0, 0, 0, 0, 0, 0, 0, 3800, 0, 0, 0, 0, 4096, 0, 0, 0)
+        return (b"\x09" + report).ljust(INPUT_REPORT_SIZE, b"\0")
+
+    def read_report(self, timeout_ms: int):
+        delay = self.next_report_time - time.perf_counter()
+        if delay > 0:
+            if delay > timeout_ms / 1000:
+                if self.unplugged.wait(timeout_ms / 1000):
+                    raise Exception("Device unplugged")
+                return b""
+            if self.unplugged.wait(delay):
+                raise Exception("Device unplugged")
+        elif self.unplugged.is_set():
+            raise Exception("Device unplugged")
+        self.next_report_time = max(self.next_report_time + self.report_interval, time.perf_counter() - self.report_interval)
+        self.reports_sent += 1
+        return self.create_report()
+
+    def write_report(self, data: bytes):
+        if self.unplugged.is_set():
+            raise Exception("Device unplugged")
+        self.written_reports.append((time.perf_counter(), bytes(data)))
+
+class FakeUsbBackend(UsbBackend):
+    """Simulated controllers, which can be plugged and unplugged at any time, for tests and benchmarks"""
+    def __init__(self, report_interval: float = 0.004):
+        self.report_interval = report_interval
+        self.connections: dict[str, FakeUsbConnection] = {}
+        self.plugged_count = 0
+
+    def plug(self):
+        """Returns the key of the new controller"""
+        self.plugged_count += 1
+        key = f"fake{self.plugged_count}"
+        self.connections[key] = FakeUsbConnection(f"FAKE{self.plugged_count:010}", self.report_interval)
+        return key
+
+    def unplug(self, key: str):
+        self.connections.pop(key).unplugged.set()
+
+    def enumerate(self):
+        return {key: connection.serial_number for key, connection in self.connections.items()}
+
+    def open(self, key: str):
+        return self.connections[key]
+
+class HapticsOutputQueue:
+    """Latest vibration of a controller, written by a dedicated thread.
+    It is written as soon as it changes, then again every <keepalive_interval> while the motors are on, and not at all once they are off
+    """
+    def __init__(self, write_report, keepalive_interval: float = VIBRATION_KEEPALIVE_INTERVAL, name: str = "USB haptics"):
+        self.write_report = write_report
+        self.keepalive_interval = keepalive_interval
+        self.condition = threading.Condition()
+        self.sample: bytes = None
+        self.idle = True
+        self.changed = False
+        self.running = True
+        self.packet_id = 0
+        self.start_time = time.perf_counter()
+        self.last_write_time = 0
+        self.writes = 0
+        self.keepalive_writes = 0
+        self.coalesced = 0
+        self.failed_writes = 0
+        self.write_latency = LatencyHistogram()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, vibration: VibrationData):
+        """Can be called from any thread, unchanged vibrations are ignored"""
+        sample = vibration.get_bytes()
+        with self.condition:
+            if sample == self.sample:
+                return
+            if self.changed:
+                # previous vibration was never written
+                self.coalesced += 1
+            self.sample = sample
+            self.idle = vibration.lf_amp == 0 and vibration.hf_amp == 0
+            self.changed = True
+            self.condition.notify()
+
+    def run(self):
+        condition = self.condition
+        while True:
+            with condition:
+                while self.running and not self.changed:
+                    if self.idle:
+                        condition.wait()
+                        continue
+                    remaining = self.last_write_time + self.keepalive_interval - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    condition.wait(remaining)
+                if not self.running:
+                    return
+                sample = self.sample
+                keepalive = not self.changed
+                self.changed = False
+            self.write(sample, keepalive)
+
+    def write(self, sample: bytes, keepalive: bool):
+        payload = (VIBRATION_REPORT_ID.to_bytes() + (0x50 + (self.packet_id & 0x0F)).to_bytes() + sample).ljust(17, b'\0')
+        self.packet_id += 1
+        start_time = time.perf_counter()
+        try:
+            self.write_report(payload)
+        except Exception:
+            self.failed_writes += 1
+            logger.debug("Unable to write vibration", exc_info=True)
+        self.last_write_time = time.perf_counter()
+        self.write_latency.add(self.last_write_time - start_time)
+        self.writes += 1
+        if keepalive:
+            self.keepalive_writes += 1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def summary(self):
+        duration = time.perf_counter() - self.start_time
+        return {
+            "writes": self.writes,
+            "keepalive_writes": self.keepalive_writes,
+            "coalesced": self.coalesced,
+            "failed_writes": self.failed_writes,
+            "write_rate": self.writes / duration if duration > 0 else 0,
+            "write_latency": self.write_latency.summary(),
+        }
+
+    def format_summary(self):
+        s = self.summary()
+        text = f"{s['writes']} vibration writes ({s['write_rate']:.1f}/s), {s['keepalive_writes']} keepalives, {s['coalesced']} coalesced, {s['failed_writes']} failed"
+        latency = s["write_latency"]
+        if latency["count"]:
+            text += f", write latency p50={latency['p50'] * 1000:.3f}ms p99={latency['p99'] * 1000:.3f}ms max={latency['max'] * 1000:.3f}ms"
+        return text
+
+class UsbController(Controller):
+    """Controller connected by USB, its reports go through the same processing as bluetooth controllers"""
+    def __init__(self, key: str, connection: UsbConnection):
+        super().__init__(ControllerDevice(f"USB {key}"))
+        self.key = key
+        self.connection = connection
+        self.loop: asyncio.AbstractEventLoop = None
+        self.reader_thread: threading.Thread = None
+        self.haptics: HapticsOutputQueue = None
+        self.running = False
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.connect_start_time = time.perf_counter()
+        self.init_timings = {}
+        await self.write_command(COMMAND_USB, SUBCOMMAND_INIT, bytes.fromhex("01 00 FF FF FF FF FF FF"))
+        await self.write_command(COMMAND_USB, SUBCOMMAND_REPORT_TYPE, bytes.fromhex("05 00 00 00"))
+        self.apply_controller_data(await self.read_controller_data())
+        await self.enableFeatures(FEATURE_MOTION | FEATUER_VIBRATION)
+        self.init_timings["initialize"] = time.perf_counter() - self.connect_start_time
+
+        self.running = True
+        self.haptics = HapticsOutputQueue(self.connection.write_report, name=f"USB haptics {self.key}")
+        self.reader_thread = threading.Thread(target=self.read_reports, name=f"USB reader {self.key}", daemon=True)
+        self.reader_thread.start()
+        logger.info(f"Initialized {self} in {self.init_timings['initialize']:.3f}s")
+
+    def read_reports(self):
+        """Reader thread, hands the reports over to the event loop"""
+        connection = self.connection
+        call_soon_threadsafe = self.loop.call_soon_threadsafe
+        try:
+            while self.running:
+                data = connection.read_report(READ_TIMEOUT_MS)
+                if data:
+                    call_soon_threadsafe(self.input_report_received, data[1:], time.perf_counter())
+        except Exception:
+            if self.running:
+                logger.debug(f"Unable to read from {self}", exc_info=True)
+                self.running = False
+                try:
+                    call_soon_threadsafe(self.connection_lost)
+                except RuntimeError:
+                    # Loop already closed
+                    pass
+
+    def connection_lost(self):
+        if self.disconnected_callback is not None:
+            asyncio.create_task(self.disconnected_callback(self))
+
+    def is_connected(self):
+        return self.running
+
+    async def disconnect(self):
+        """Also closes the connection of a controller that failed to connect"""
+        self.running = False
+        loop = asyncio.get_running_loop()
+        if self.reader_thread is not None:
+            await loop.run_in_executor(None, self.reader_thread.join)
+            self.reader_thread = None
+        if self.haptics is not None:
+            await loop.run_in_executor(None, self.haptics.stop)
+        await loop.run_in_executor(None, self.connection.close)
+
+    async def write_command(self, command_id: int, subcommand_id: int, command_data = b'', timeout: float = None, match = None):
+        """Blocking commands are sent from the executor, and each USB command waits for its own response"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.connection.write_command, command_id, subcommand_id, command_data)
+
+    async def set_vibration(self, vibration: VibrationData):
+        """Queued, the haptics thread does the writes"""
+        self.haptics.put(vibration)
+
+class UsbTransport:
+    """Connects the controllers as they are plugged in, and removes them when unplugged.
+    <controller_added> and <controller_removed> are coroutine functions called with the controller
+    """
+    def __init__(self, backend: UsbBackend, controller_added, controller_removed):
+        self.backend = backend
+        self.controller_added = controller_added
+        self.controller_removed = controller_removed
+        self.controllers: dict[str, UsbController] = {}
+        # Controllers being connected, or that failed to, until they are unplugged
+        self.pending_keys: set[str] = set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            plugged = await loop.run_in_executor(None, self.backend.enumerate)
+            self.pending_keys &= plugged.keys()
+            for key in plugged.keys() - self.controllers.keys() - self.pending_keys:
+                self.pending_keys.add(key)
+                loop.create_task(self.add_controller(key))
+            for key in self.controllers.keys() - plugged.keys():
+                await self.remove_controller(self.controllers[key])
+            await asyncio.sleep(HOTPLUG_INTERVAL)
+
+    async def add_controller(self, key: str):
+        loop = asyncio.get_running_loop()
+        try:
+            connection = await loop.run_in_executor(None, self.backend.open, key)
+        except Exception:
+            logger.exception(f"Unable to open USB device {key}")
+            return
+        controller = None
+        try:
+            controller = UsbController(key, connection)
+            controller.disconnected_callback = self.remove_controller
+            await controller.connect()
+        except Exception:
+            logger.exception(f"Unable to initialize USB device {key}")
+            try:
+                if controller is not None:
+                    await controller.disconnect()
+                else:
+                    await loop.run_in_executor(None, connection.close)
+            except Exception:
+                logger.debug(f"Unable to close USB device {key}", exc_info=True)
+            return
+        self.pending_keys.discard(key)
+        self.controllers[key] = controller
+        await self.controller_added(controller)
+
+    async def remove_controller(self, controller: UsbController):
+        if self.controllers.get(controller.key) is not controller:
+            return
+        logger.info(f"Controller unplugged {controller}")
+        del self.controllers[controller.key]
+        await self.controller_removed(controller)
+        await controller.disconnect()
+
+    async def close(self):
+        for controller in list(self.controllers.values()):
+            await controller.disconnect()
+        self.controllers.clear()
+
+async def run_usb_transport(backend: UsbBackend):
+    from virtual_controller import assign_virtual_controller, MAX_VIRTUAL_CONTROLLERS
+    virtual_controllers = [None] * MAX_VIRTUAL_CONTROLLERS
+
+    async def controller_added(controller: UsbController):
+        virtual_controller = assign_virtual_controller(virtual_controllers, controller)
+        await virtual_controller.init_added_controller(controller)
+        logger.info(virtual_controllers)
+
+    async def controller_removed(controller: UsbController):
+        for i, vc in enumerate(virtual_controllers[:]):
+            if vc is not None and await vc.remove_controller(controller):
+                virtual_controllers[i] = None
+        logger.info(virtual_controllers)
+
+    transport = UsbTransport(backend, controller_added, controller_removed)
+    config_watcher = ConfigWatcher(get_config_file_path())
+    config_watcher.start()
+    try:
+        await transport.run()
+    finally:
+        config_watcher.stop()
+        for controller in transport.controllers.values():
+            logger.info(f"Reports of {controller} : {controller.report_stats.format_summary()}")
+            logger.info(f"Haptics of {controller} : {controller.haptics.format_summary()}")
+        await transport.close()
+
+def main(args: list[str]):
+    """Usage: procon2_usb.py [--fake [controller count]], --fake uses simulated controllers"""
+    if "--fake" in args:
+        index = args.index("--fake")
+        backend = FakeUsbBackend()
+        for _ in range(int(args[index + 1]) if len(args) > index + 1 else 1):
+            backend.plug()
+    else:
+        backend = HidUsbBackend()
 
-COMMAND_FEATURE = 0x0c
-SUBCOMMAND_FEATURE_INIT = 0x02
-SUBCOMMAND_FEATURE_ENABLE = 0x04
+    print("Waiting for NS2 Pro Controllers, press Ctrl+C to stop")
+    try:
+        asyncio.run(run_usb_transport(backend))
+    except KeyboardInterrupt:
+        print("Interupted")
 
-FEATURE_MOTION = 0x04
-FEATUER_VIBRATION = 0x20
-FEATURE_MOUSE = 0x10
-FEATURE_MAGNOMETER = 0x80
-
-# Addresses in controller memory
-ADDRESS_CONTROLLER_INFO = 0x00013000
-CALIBRATION_JOYSTICK_1 = 0x0130A8
-CALIBRATION_JOYSTICK_2 = 0x0130E8
-CALIBRATION_USER_JOYSTICK_1 = 0x1fc042
-CALIBRATION_USER_JOYSTICK_2 = 0x1fc062
-
-#Repoduce switch led patterns for up to 8 players https://en-americas-support.nintendo.com/app/answers/detail/a_id/22424
-LED_PATTERN = {
-    1: 0x01,
-    2: 0x03,
-    3: 0x07,
-    4: 0x0F,
-    5: 0x09,
-    6: 0x05,
-    7: 0x0D,
-    8: 0x06,
-}
-
-print('Finding NS2 Pro Controller...')
-dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
-
-if dev is None:
-    print("Device not found")
-    sys.exit(1)
-
-print('Device found')
-
-try:
-    dev.set_configuration()
-    usb.util.claim_interface(dev, USB_INTERFACE_NUMBER)
-except usb.core.USBError as e:
-    # リソースがビジーな場合は、すでに設定されている可能性がある
-    if e.errno == 16: # Resource Busy
-        print("Interface Busy")
-    else:
-        print(f"Failed to init device: {e}")
-        sys.exit(1)
-
-# 3. Bulk転送用のエンドポイントを検索
-cfg = dev.get_active_configuration()
-intf = cfg[(USB_INTERFACE_NUMBER, 0)]
-
-# OUT (PC -> デバイス) のBulkエンドポイントを探す
-ep_out = usb.util.find_descriptor(
-    intf,
-    custom_match=lambda e:
-        usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT and
-        usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
-)
-
-# IN (デバイス -> PC) のBulkエンドポイントを探す
-ep_in = usb.util.find_descriptor(
-    intf,
-    custom_match=lambda e:
-        usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN and
-        usb.util.endpoint_type(e.bmAttributes) == usb.util.ENDPOINT_TYPE_BULK
-)
-
-def set_leds(player_number: int):
-    """Set the player indicator led to the specified <player_number>"""
-    if player_number > 8:
-        player_number = 8
-
-    value = LED_PATTERN[player_number]
-        
-    # crash if less than 4 bytes of data, even though only one byte seems significant
-    data = value.to_bytes().ljust(4, b'\0')
-    write_command(COMMAND_LEDS, SUBCOMMAND_LEDS_SET_PLAYER, data)
-
-def write_command(command_id: int, subcommand_id: int, command_data = b''):
-    """Generic write command method"""
-    command_buffer = command_id.to_bytes() + b"\x91\x01" + subcommand_id.to_bytes() + b"\x00" + len(command_data).to_bytes() + b"\x00\x00" + command_data
-    bytes_written = ep_out.write(command_buffer)
-    response_buffer = dev.read(ep_in.bEndpointAddress, 32, timeout=500)
-    if len(response_buffer) < 8 or response_buffer[0] != command_id or response_buffer[1] != 0x01:
-        raise Exception(f"Unexpected response : {response_buffer}")
-    
-    return response_buffer[8:]
-
-def enableFeatures(feature_flags: int):
-    """Enable or disable features according to <feature_flags>"""
-    write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_INIT, feature_flags.to_bytes().ljust(4, b'\0'))
-    write_command(COMMAND_FEATURE, SUBCOMMAND_FEATURE_ENABLE, feature_flags.to_bytes().ljust(4, b'\0'))
-
-if ep_out is None or ep_in is None:
-    print("Endpoint not found")
-    sys.exit(1)
-
-def read_memory(length: int, address: int):
-    """Returns the requested <length> bytes of data located at <address>"""
-    if length > 0x4F:
-        raise Exception("Maximum read size is 0x4F bytes")
-    data = write_command(COMMAND_MEMORY, SUBCOMMAND_MEMORY_READ, length.to_bytes() + b'\x7e\0\0' + address.to_bytes(length=4,byteorder='little'))
-    # Ensure the response is the data we requested
-    if (data[0] != length or decodeu(data[4:8]) != address):
-        raise Exception(f"Unexpected response from read commmand : {data}")
-    return data[8:]
-
-def read_calibration_data():
-    """Returns a tuple with calibration data of left and right stick (if present)"""
-    calibration_data_1 = read_memory(0x0b, CALIBRATION_USER_JOYSTICK_1)
-    if (decodeu(calibration_data_1[:3]) == 0xFFFFFF):
-        calibration_data_1 = read_memory(0x0b, CALIBRATION_JOYSTICK_1)
-    calibration_data_2 = read_memory(0x0b, CALIBRATION_USER_JOYSTICK_2)
-    if (decodeu(calibration_data_2[:3]) == 0xFFFFFF):
-        calibration_data_2 = read_memory(0x0b, CALIBRATION_JOYSTICK_2)
-    return StickCalibrationData(calibration_data_1), StickCalibrationData(calibration_data_2)
-
-vibration_packet_id = 0
-device = None
-vibration = VibrationData()
-
-async def set_vibration(vibration: VibrationData):
-    global vibration_packet_id
-    """Set vibration data"""
-    payload = (b'\x02' + (0x50 + (vibration_packet_id & 0x0F)).to_bytes() + vibration.get_bytes()).ljust(17, b'\0')
-    if device:
-        # print(payload.hex(" "))
-        device.write(payload)
-    vibration_packet_id += 1
-
-# 振動処理を専門に行う非同期ワーカー
-async def vibration_worker():
-    global vibration
-    print("Vibration worker started.")
-    
-    while True:
-        await set_vibration(vibration)
-        await asyncio.sleep(0.005)
-
-# ワーカースレッドでイベントループを実行する関数
-def run_vibration_loop_in_thread(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-
-def vibration_callback(client, target, large_motor, small_motor, led_number, user_data):
-    global vibration
-    """vibration_workerにデータを渡すことだけを行う軽量なコールバック"""
-    vibrationData = VibrationData()
-    vibrationData.lf_amp = int(800 * large_motor / 255) if large_motor > 0 else 0
-    vibrationData.hf_amp = int(800 * small_motor / 255) if small_motor > 0 else 0
-    
-    # キューに古いデータがあればクリアし、新しいデータを追加
-    vibration = vibrationData
-
-worker_loop = None
-worker_thread = None
-try:
-    print("Initializing...")
-    write_command(COMMAND_USB, SUBCOMMAND_INIT, bytes.fromhex("01 00 FF FF FF FF FF FF"))
-    write_command(COMMAND_USB, SUBCOMMAND_REPORT_TYPE, bytes.fromhex("05 00 00 00"))
-    # write_command(COMMAND_PAIR, SUBCOMMAND_PAIR_SET_MAC, bytes.fromhex("00 02 FF FF FF FF FF FF FF FF FF FF FF FF"))
-    # ltk1 = bytes([0x00, 0xea, 0xbd, 0x47, 0x13, 0x89, 0x35, 0x42, 0xc6, 0x79, 0xee, 0x07, 0xf2, 0x53, 0x2c, 0x6c, 0x31])
-    # write_command(COMMAND_PAIR, SUBCOMMAND_PAIR_LTK1, ltk1)
-    # ltk2 = bytes([0x00, 0x40, 0xb0, 0x8a, 0x5f, 0xcd, 0x1f, 0x9b, 0x41, 0x12, 0x5c, 0xac, 0xc6, 0x3f, 0x38, 0xa0, 0x73])
-    # write_command(COMMAND_PAIR, SUBCOMMAND_PAIR_LTK2, ltk2)
-    # write_command(COMMAND_PAIR, SUBCOMMAND_PAIR_FINISH, b"\0")
-    # write_command(COMMAND_USB, SUBCOMMAND_HAPTIC, bytes.fromhex("09 00 00 00"))
-    #SET LED
-    set_leds(1)
-    enableFeatures(FEATURE_MOTION)
-    enableFeatures(FEATUER_VIBRATION)
-    print("Initialized.")
-    print("Reading stick calibration data...")
-    stick_calibration, second_stick_calibration = read_calibration_data()
-    device = hid.device()
-    device.open(VENDOR_ID, PRODUCT_ID)
-
-    controller = vgamepad.VDS4Gamepad()
-    controller.register_notification(callback_function=vibration_callback)
-    print("VGamepad Init")
-
-    worker_loop = asyncio.new_event_loop()
-    worker_thread = threading.Thread(
-        target=run_vibration_loop_in_thread,
-        args=(worker_loop,),
-        daemon=True
-    )
-    worker_thread.start()
-    # vibration_workerコルーチンをイベントループで実行するようにスケジュール
-    asyncio.run_coroutine_threadsafe(vibration_worker(), worker_loop)
-
-    report = vcom.DS4_SUB_REPORT_EX()
-
-    print(f"Opened HID Device: {device.get_manufacturer_string()} {device.get_product_string()}")
-    print("Press Ctrl+C to stop")
-    device.set_nonblocking(1)
-    while True:
-        data = device.read(64)
-        if data:
-            # print(f"Raw data: {bytes(data)[0:].hex(' ')}")
-            # print(f"X: {bytes(data)[0x16:0x18].hex(' ')} Y: {bytes(data)[0x1A:0x1C].hex(' ')}  Z: {bytes(data)[0x1E:0x20].hex(' ')}")
-            inputData = ControllerInputData(bytes(data)[1:], stick_calibration, second_stick_calibration)
-            # buttons = decodeu(data[3:6])
-            buttons = inputData.buttons
-            # print(buttons)
-            buttonsConfig = CONFIG.procon_config
-
-            # y, x, z = decodes(bytes(data)[0x16:0x18]), decodes(bytes(data)[0x1A:0x1C]), decodes(bytes(data)[0x1E:0x20])
-            # print(f"X: {x}, Y: {y}, Z: {z}")
-
-            report.wButtons, report.bSpecial, dpad_direction, left_trigger, right_trigger = buttonsConfig.convert_buttons(buttons)
-            vcom.DS4_SET_DPAD(report, dpad_direction)
-            report.bTriggerL = 255 if left_trigger else 0
-            report.bTriggerR = 255 if right_trigger else 0
-
-            report.bThumbRX = 128 + round(inputData.right_stick[0] * 127)
-            report.bThumbRY = 128 + round(-inputData.right_stick[1] * 127)
-
-            report.bThumbLX = 128 + round(inputData.left_stick[0] * 127)
-            report.bThumbLY = 128 + round(-inputData.left_stick[1] * 127)
-            
-            # # Motion Controls 
-            report.wAccelX = inputData.accelerometer[0] * 2
-            report.wAccelY = inputData.accelerometer[2] * 2
-            report.wAccelZ = -inputData.accelerometer[1] * 2
-            report.wGyroX = inputData.gyroscope[0]
-            report.wGyroY = inputData.gyroscope[2]
-            report.wGyroZ = -inputData.gyroscope[1]
-
-            ex = vcom.DS4_REPORT_EX(Report=report)
-            controller.update_extended_report(ex)
-
-except usb.core.USBError as e:
-    print(f"Error while transfer: {e}")
-except KeyboardInterrupt:
-    print("Interupted")
-finally:
-    if worker_loop and worker_loop.is_running():
-        # イベントループで実行中の全てのタスクをキャンセル
-        tasks = asyncio.all_tasks(loop=worker_loop)
-        for task in tasks:
-            task.cancel()
-        # ループを停止
-        worker_loop.call_soon_threadsafe(worker_loop.stop)
-    
-    # スレッドが終了するのを待つ（必要に応じて）
-    if worker_thread and worker_thread.is_alive():
-        worker_thread.join(timeout=1)
-    print("Vibration worker stopped.")
-
-    if device:
-        device.close()
-    usb.util.release_interface(dev, USB_INTERFACE_NUMBER)
-    usb.util.dispose_resources(dev)
\ No newline at end of file
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+"""Micro-benchmark of the input report decoder.
+
+Compares the previous slice based decoding with ControllerInputData.
+Run from the repository root: python test/bench_input_decoder.py
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from controller import ControllerInputData
+from utils import decodeu, decodes, get_stick_xy
+
+REPORT_COUNT = 100000
+
+def legacy_decode(data: bytes):
+    """Slice based decoding, as done before ControllerInputData used a precompiled struct"""
+    return (
+        decodeu(data[0:4]),
+        decodeu(data[4:8]),
+        get_stick_xy(data[10:13]),
+        get_stick_xy(data[13:16]),
+        (decodeu(data[16:18]), decodeu(data[18:20])),
+        decodeu(data[20:22]),
+        decodeu(data[22:24]),
+        (decodes(data[25:27]), decodes(data[27:29]), decodes(data[29:31])),
+        decodeu(data[31:33]) / 1000,
+        decodeu(data[33:35]) / 100,
+        25 + decodeu(data[46:48]) / 127,
+        (decodes(data[48:50]), decodes(data[50:52]), decodes(data[52:54])),
+        (decodes(data[54:56]), decodes(data[56:58]), decodes(data[58:60])),
+    )
+
+def decode(data: bytes):
+    d = ControllerInputData(data, None, None)
+    return (d.time, d.buttons, d.left_stick, d.right_stick, d.mouse_coords, d.mouse_roughness, d.mouse_distance,
+            d.magnometer, d.battery_voltage, d.battery_current, d.temperature, d.accelerometer, d.gyroscope)
+
+def run():
+    reports = [bytearray(os.urandom(63)) for _ in range(1000)]
+
+    for report in reports:
+        if legacy_decode(report) != decode(report):
+            raise Exception(f"Decoders disagree on {report.hex(' ')}")
+
+    for name, func in (("before (slices)", legacy_decode), ("after (struct)", lambda data: ControllerInputData(data, None, None))):
+        duration = timeit.timeit(lambda: [func(r) for r in reports], number=REPORT_COUNT // len(reports))
+        print(f"{name: <16}: {REPORT_COUNT / duration:>10.0f} reports/s")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,46 @@
+"""Timing accuracy and CPU usage of the music player frame scheduler, with a fake HID device.
+
+Run from the repository root: python test/bench_music_scheduler.py [duration in seconds] [controller count]
+"""
+import os
+import random
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import FakeHidDevice, FrameScheduler, MusicController, MusicOutput, SongTimeline, HAPTIC_FRAME_SIZE, HAPTIC_REPORT_ID
+
+def create_timeline(duration: float, controller_count: int):
+    """Frames every 5 to 250ms, like a dense MIDI file"""
+    times = []
+    t = 0
+    while t < duration:
+        times.append(t)
+        t += random.choice((0.005, 0.01, 0.05, 0.125, 0.25))
+    frames = np.random.randint(0, 4, (len(times), controller_count, HAPTIC_FRAME_SIZE), dtype=np.uint8)
+    frames[:, :, 0] = HAPTIC_REPORT_ID
+    note_counts = np.random.randint(0, 3, (len(times), controller_count), dtype=np.int64)
+    return SongTimeline(np.array(times, dtype=np.float64), frames, note_counts)
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    controller_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    timeline = create_timeline(duration, controller_count)
+    devices = [FakeHidDevice() for _ in range(controller_count)]
+    output = MusicOutput([MusicController(device) for device in devices])
+    scheduler = FrameScheduler(output)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    scheduler.run(timeline)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    output.stop()
+
+    print(f"{len(timeline.times)} frames over {duration}s to {controller_count} controller(s)")
+    print(scheduler.format_summary())
+    print(f"CPU usage {cpu / wall:.1%} ({cpu:.3f}s CPU for {wall:.3f}s)")
+
+if __name__ == "__main__":
+    main()
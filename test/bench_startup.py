@@ -0,0 +1,110 @@
+"""Startup cost of the app, with stubbed bluetooth and virtual controller backends.
+
+Stubs take STUB_IMPORT_DELAY seconds to import, like the real backends, so the import times show which modules still load them.
+Measures the import time of each module from `python -X importtime`, and the wall-clock time from process start to the first bluetooth scan.
+
+Run from the repository root: python test/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds each stubbed backend takes to import
+STUB_IMPORT_DELAY = 0.05
+
+STUB_DELAY = f"import time\ntime.sleep({STUB_IMPORT_DELAY})\n"
+
+# Scanning starts when the scanner is entered, the process then exits printing the time it happened
+STUBS = {
+    "bleak/__init__.py": STUB_DELAY + """import os, sys, time
+class BleakGATTCharacteristic: pass
+class BleakClient:
+    def __init__(self, *args, **kwargs): pass
+class BleakScanner:
+    def __init__(self, *args, **kwargs): pass
+    async def start(self):
+        sys.stdout.write(f"SCAN {time.time()}\\n")
+        sys.stdout.flush()
+        os._exit(0)
+    async def stop(self): pass
+""",
+    "bleak/exc.py": "class BleakError(Exception): pass\n",
+    "bleak/backends/__init__.py": "",
+    "bleak/backends/device.py": """class BLEDevice:
+    def __init__(self, address, name, details):
+        self.address, self.name, self.details = address, name, details
+""",
+    "bleak/backends/scanner.py": "class AdvertisementData: pass\n",
+    "bluetooth.py": STUB_DELAY + "def read_local_bdaddr():\n    return ['00:11:22:33:44:55']\n",
+    "vgamepad/__init__.py": STUB_DELAY + "class VDS4Gamepad: pass\n",
+    "vgamepad/win/__init__.py": "",
+    "vgamepad/win/vigem_commons.py": "class DS4_REPORT_EX: pass\nclass DS4_SUB_REPORT_EX: pass\ndef DS4_SET_DPAD(report, direction): pass\n",
+    "win32api.py": STUB_DELAY,
+    "win32con.py": "",
+}
+
+MODULES = ["config", "controller", "virtual_controller", "discoverer", "gui", "procon2_usb", "capture"]
+
+def write_stubs(directory: str):
+    for path, content in STUBS.items():
+        file_path = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(content)
+
+def get_env(stubs_path: str):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (REPO_PATH, stubs_path, env.get("PYTHONPATH")) if p)
+    return env
+
+def measure_import(module: str, env: dict):
+    """Returns (cumulative import time in seconds, names of the stubbed backends imported)"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, cwd=REPO_PATH, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Unable to import {module}\n{result.stderr}")
+    cumulative = 0
+    backends = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        name = fields[2].strip()
+        if name == module:
+            cumulative = int(fields[1]) / 1000000
+        elif name.split(".")[0] in ("bleak", "bluetooth", "vgamepad", "win32api") and "." not in name:
+            backends.append(name)
+    return cumulative, backends
+
+def measure_first_scan(env: dict):
+    """Returns seconds from process start to the first bluetooth scan"""
+    start_time = time.time()
+    result = subprocess.run([sys.executable, "-c", "import threading, discoverer; discoverer.start_discoverer(None, threading.Event())"],
+                            env=env, cwd=REPO_PATH, capture_output=True, text=True, timeout=30)
+    for line in result.stdout.splitlines():
+        if line.startswith("SCAN "):
+            return float(line[5:]) - start_time
+    raise Exception(f"Scan never started\n{result.stdout}{result.stderr}")
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as stubs_path:
+        write_stubs(stubs_path)
+        env = get_env(stubs_path)
+
+        print(f"Stubbed backends take {STUB_IMPORT_DELAY * 1000:.0f}ms to import, best of {runs} runs")
+        for module in MODULES:
+            measures = [measure_import(module, env) for _ in range(runs)]
+            cumulative = min(m[0] for m in measures)
+            backends = measures[0][1]
+            print(f"import {module:<20}: {cumulative * 1000:7.1f}ms, backends imported : {', '.join(backends) or 'none'}")
+
+        first_scan = min(measure_first_scan(env) for _ in range(runs))
+        print(f"Process start to first scan : {first_scan * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""CPU usage of the USB transport with simulated Pro Controllers 2, compared to polling non-blocking reads.
+
+Run from the repository root: python test/bench_usb_transport.py [controller count] [duration in seconds]
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from procon2_usb import FakeUsbBackend, UsbTransport
+
+# Seconds the controllers have to initialize in
+INIT_TIMEOUT = 5
+
+async def run_transport(controller_count: int, duration: float):
+    backend = FakeUsbBackend()
+    for _ in range(controller_count):
+        backend.plug()
+    processed_reports = 0
+
+    def input_report_callback(inputData, controller, config):
+        nonlocal processed_reports
+        processed_reports += 1
+
+    async def controller_added(controller):
+        controller.set_input_report_callback(input_report_callback)
+
+    async def controller_removed(controller):
+        pass
+
+    transport = UsbTransport(backend, controller_added, controller_removed)
+    task = asyncio.create_task(transport.run())
+    # Let controllers initialize
+    init_deadline = time.perf_counter() + INIT_TIMEOUT
+    while len(transport.controllers) < controller_count:
+        if time.perf_counter() > init_deadline:
+            task.cancel()
+            await transport.close()
+            raise Exception(f"Only {len(transport.controllers)} of {controller_count} controllers initialized in {INIT_TIMEOUT}s, see the log for the error")
+        await asyncio.sleep(0.01)
+
+    processed_reports = 0
+    cpu_start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_start
+    task.cancel()
+    await transport.close()
+    return processed_reports, cpu
+
+def run_polling(controller_count: int, duration: float):
+    """Previous behaviour, a thread per controller reading without blocking in a loop"""
+    backend = FakeUsbBackend()
+    connections = [backend.open(backend.plug()) for _ in range(controller_count)]
+    read_reports = 0
+    stop_time = time.perf_counter() + duration
+
+    def poll(connection):
+        nonlocal read_reports
+        while time.perf_counter() < stop_time:
+            if connection.read_report(0):
+                read_reports += 1
+
+    cpu_start = time.process_time()
+    threads = [threading.Thread(target=poll, args=(connection,)) for connection in connections]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return read_reports, time.process_time() - cpu_start
+
+def main():
+    controller_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    reports, cpu = run_polling(controller_count, duration)
+    print(f"Polling      : {reports / duration:.0f} reports/s, CPU usage {cpu / duration:.1%}")
+    reports, cpu = asyncio.run(run_transport(controller_count, duration))
+    print(f"UsbTransport : {reports / duration:.0f} reports/s processed, CPU usage {cpu / duration:.1%}")
+
+if __name__ == "__main__":
+    main()
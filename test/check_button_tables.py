@@ -0,0 +1,90 @@
+"""Checks that the compiled button tables of ButtonConfig give the same result as the previous convert_buttons,
+for every button mapping of config.yaml, both with the bluetooth and USB button layouts.
+
+Run from the repository root: python test/check_button_tables.py [random values count]
+"""
+import os
+import random
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import yaml
+from config import ButtonConfig, DS4_BUTTONS, SWITCH_BUTTONS, SWITCH_BUTTONS_USB, get_config_file_path
+
+def legacy_convert_buttons(config: ButtonConfig, switch_buttons: int):
+    """convert_buttons before the lookup tables"""
+    DS4_BUTTONS_ = 0x0000
+    DS4_SPECIAL = 0x0000
+    DS4_DPAD = []
+    for switch_button, ds4_button in config.buttons.items():
+        if switch_buttons & switch_button:
+            if ds4_button == DS4_BUTTONS["TOUCHPAD"] or ds4_button == DS4_BUTTONS["GUIDE"]:
+                DS4_SPECIAL |= ds4_button
+            else:
+                DS4_BUTTONS_ |= ds4_button
+
+    for switch_button, dpad_key in config.dpad.items():
+        if switch_buttons & switch_button:
+            DS4_DPAD.append(dpad_key)
+
+    left_trigger = any([b & switch_buttons for b in config.left_trigger])
+    right_trigger = any([b & switch_buttons for b in config.right_trigger])
+
+    dpad_value = {
+        frozenset(): 0x8,
+        frozenset(["UP"]): 0x0,
+        frozenset(["UP", "RIGHT"]): 0x1,
+        frozenset(["RIGHT"]): 0x2,
+        frozenset(["DOWN", "RIGHT"]): 0x3,
+        frozenset(["DOWN"]): 0x4,
+        frozenset(["DOWN", "LEFT"]): 0x5,
+        frozenset(["LEFT"]): 0x6,
+        frozenset(["UP", "LEFT"]): 0x7,
+    }.get(frozenset(d.upper() for d in DS4_DPAD), 0x8)
+
+    return DS4_BUTTONS_, DS4_SPECIAL, dpad_value, left_trigger, right_trigger
+
+def get_values(config: ButtonConfig, switch_buttons: dict[str, int], random_count: int):
+    """Switch buttons values to check : none, every single button, every combination of the dpad and trigger buttons, and random values"""
+    values = [0]
+    values += [b for b in switch_buttons.values() if b]
+    values += [1 << bit for bit in range(32)]
+    combined = list(config.dpad) + list(config.left_trigger) + list(config.right_trigger)
+    for mask in range(1 << len(combined)):
+        value = 0
+        for i, switch_button in enumerate(combined):
+            if mask & (1 << i):
+                value |= switch_button
+        values.append(value)
+    rng = random.Random(0)
+    mapped = [b for b in switch_buttons.values() if b]
+    for _ in range(random_count):
+        values.append(rng.getrandbits(32))
+        values.append(sum(set(rng.sample(mapped, rng.randint(2, 6)))))
+    return values
+
+def main():
+    random_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with open(get_config_file_path()) as f:
+        buttons_config = yaml.safe_load(f)["buttons"]
+
+    mismatches = 0
+    for is_usb, switch_buttons in ((False, SWITCH_BUTTONS), (True, SWITCH_BUTTONS_USB)):
+        for name, buttons_dict in buttons_config.items():
+            config = ButtonConfig(buttons_dict, is_usb)
+            values = get_values(config, switch_buttons, random_count)
+            for value in values:
+                expected = legacy_convert_buttons(config, value)
+                result = config.convert_buttons(value)
+                if result != expected:
+                    mismatches += 1
+                    if mismatches <= 10:
+                        print(f"{name}{' (USB)' if is_usb else ''} {value:#010x} : {result} instead of {expected}")
+            print(f"{name}{' (USB)' if is_usb else ''} : {len(values)} values checked")
+
+    if mismatches:
+        print(f"{mismatches} mismatches")
+        sys.exit(1)
+    print("Identical to the previous convert_buttons")
+
+if __name__ == "__main__":
+    main()
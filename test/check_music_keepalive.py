@@ -0,0 +1,51 @@
+"""Checks that the music player keeps sending a held note, with a fake HID device.
+A note held for 1s has to be written about every VIBRATION_KEEPALIVE_INTERVAL, about 50 times, and nothing once it ended.
+
+Run from the repository root: python test/check_music_keepalive.py
+"""
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from music_player import FakeHidDevice, FrameScheduler, MusicController, MusicOutput, SongTimeline, HAPTIC_FRAME_SIZE, HAPTIC_REPORT_ID
+from vibration import VIBRATION_KEEPALIVE_INTERVAL
+
+NOTE_DURATION = 1
+# Silence after the note, during which nothing must be written
+SILENCE_DURATION = 0.2
+
+def create_timeline():
+    """A single note from 0 to NOTE_DURATION, then silence"""
+    times = np.array([0, NOTE_DURATION, NOTE_DURATION + SILENCE_DURATION], dtype=np.float64)
+    frames = np.zeros((3, 1, HAPTIC_FRAME_SIZE), dtype=np.uint8)
+    frames[:, :, 0] = HAPTIC_REPORT_ID
+    frames[0, 0, 2:7] = (0xE1, 0xFD, 0x0C, 0x18, 0xC8)
+    note_counts = np.array([[1], [0], [0]], dtype=np.int64)
+    return SongTimeline(times, frames, note_counts)
+
+def main():
+    device = FakeHidDevice()
+    output = MusicOutput([MusicController(device)])
+    scheduler = FrameScheduler(output)
+    start_time = time.perf_counter()
+    scheduler.run(create_timeline())
+    print(scheduler.format_summary())
+
+    note_end = start_time + NOTE_DURATION
+    note_writes = [t for t, _ in device.writes if t < note_end]
+    silence_writes = [t for t, _ in device.writes if t >= note_end]
+    gaps = np.diff(note_writes)
+    expected = NOTE_DURATION / VIBRATION_KEEPALIVE_INTERVAL
+    print(f"{len(note_writes)} writes during the note (expected about {expected:.0f}), longest gap {gaps.max() * 1000:.1f}ms, {len(silence_writes)} writes after it")
+
+    if not 0.9 * expected <= len(note_writes) <= 1.1 * expected + 1:
+        print("Held note not kept vibrating")
+        sys.exit(1)
+    if len(silence_writes) != 1:
+        print("Writes after the end of the note, expected only the stop frame")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
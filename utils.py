@@ -1,7 +1,3 @@
-import win32api
-
-from config import CONFIG
-
 def to_hex(buffer):
     return " ".join("{:02x}".format(x) for x in buffer)
 
@@ -26,20 +22,15 @@ def signed_looping_difference_16bit(a, b):
     diff = (b - a) % 65536
     return diff - 65536 if diff > 32768 else diff
 
-def apply_calibration_to_axis(raw_value, center, max_abs, min_abs):
+def apply_calibration_to_axis(raw_value, center, max_abs, min_abs, deadzone):
     signed_value = raw_value - center
-    if signed_value > CONFIG.deadzone:
-        return min(signed_value / max_abs, 1)
-    if signed_value < -CONFIG.deadzone:
-        return -min(-signed_value / min_abs, 1)
+    # An empty range (invalid calibration data) saturates instead of dividing by zero
+    if signed_value > deadzone:
+        return min(signed_value / max_abs, 1) if max_abs else 1
+    if signed_value < -deadzone:
+        return -min(-signed_value / min_abs, 1) if min_abs else -1
     return 0
 
-def press_or_release_mouse_button(state: bool, prev_state: bool, button: int, mouse_x: int, mouse_y):
-    if (state and not prev_state):
-        win32api.mouse_event(button, mouse_x, mouse_y, 0, 0)
-    if (not state and prev_state):
-        win32api.mouse_event(button << 1, mouse_x, mouse_y, 0, 0)
-
 def reverse_bits(n: int, no_of_bits: int):
     result = 0
     for i in range(no_of_bits):
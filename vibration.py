@@ -0,0 +1,68 @@
+"""Encoding of vibration samples, shared by rumble and music playback
+
+A sample is 5 bytes (little endian) : for each of the low and high frequency tones,
+a 9 bits frequency code, a tone enable bit and a 10 bits amplitude code
+"""
+import math
+
+# Frequency code : code = log(hz / FREQUENCY_CODE_A) / FREQUENCY_CODE_B, on 9 signed bits
+FREQUENCY_CODE_A = 403.1279
+FREQUENCY_CODE_B = 0.00718869
+MIN_FREQUENCY_CODE = -0x100
+MAX_FREQUENCY_CODE = 0xFF
+MAX_AMPLITUDE_CODE = 0x3FF
+
+# Frequencies in the lookup table, from 0 to MAX_TABLE_HZ Hz (above the highest code)
+MAX_TABLE_HZ = 2600
+
+# Amplitude code of the strongest rumble
+MAX_RUMBLE_AMPLITUDE = 800
+# Rumble intensities are raised to this power, weak rumbles being barely felt with a linear mapping
+RUMBLE_AMPLITUDE_EXPONENT = 0.5
+
+# Seconds after which a vibration has to be sent again for the motors to keep vibrating
+VIBRATION_KEEPALIVE_INTERVAL = 0.02
+
+def compute_frequency_code(hz: float):
+    """Frequency code of <hz>, clamped to the range of codes"""
+    if hz <= 0:
+        return MIN_FREQUENCY_CODE
+    code = int(math.log(hz / FREQUENCY_CODE_A) / FREQUENCY_CODE_B)
+    return min(max(code, MIN_FREQUENCY_CODE), MAX_FREQUENCY_CODE)
+
+# Frequency code of each integer frequency in Hz
+HZ_TO_CODE = [compute_frequency_code(hz) for hz in range(MAX_TABLE_HZ + 1)]
+
+# Amplitude code of each rumble intensity (0-255) of the virtual controller motors
+RUMBLE_TO_AMPLITUDE = [round(MAX_RUMBLE_AMPLITUDE * (intensity / 255) ** RUMBLE_AMPLITUDE_EXPONENT) for intensity in range(256)]
+
+def frequency_to_code(hz: float):
+    """Frequency code of <hz>, from the table for whole frequencies in Hz"""
+    if hz == int(hz) and 0 <= hz <= MAX_TABLE_HZ:
+        return HZ_TO_CODE[int(hz)]
+    return compute_frequency_code(hz)
+
+def encode_sample(lf_freq: int, lf_en_tone: bool, lf_amp: int, hf_freq: int, hf_en_tone: bool, hf_amp: int):
+    """Returns the 5 bytes of a sample, from frequency and amplitude codes"""
+    return ((lf_freq & 0x1FF) | (lf_en_tone << 9) | ((lf_amp & 0x3FF) << 10) |
+            ((hf_freq & 0x1FF) << 20) | (hf_en_tone << 29) | ((hf_amp & 0x3FF) << 30)).to_bytes(5, "little")
+
+def frequencies_to_codes(hz):
+    """Vectorized frequency_to_code, <hz> being a NumPy array. Computed exactly, fractional frequencies included"""
+    import numpy as np
+    hz = np.asarray(hz, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        codes = np.trunc(np.log(hz / FREQUENCY_CODE_A) / FREQUENCY_CODE_B)
+    codes = np.where(hz > 0, codes, MIN_FREQUENCY_CODE)
+    return np.clip(codes, MIN_FREQUENCY_CODE, MAX_FREQUENCY_CODE).astype(np.int64)
+
+def encode_samples(lf_freq, lf_en_tone, lf_amp, hf_freq, hf_en_tone, hf_amp):
+    """Vectorized encode_sample, from NumPy arrays of n codes, returns a [n, 5] uint8 array"""
+    import numpy as np
+    value = ((np.asarray(lf_freq).astype(np.uint64) & 0x1FF) |
+             (np.asarray(lf_en_tone).astype(np.uint64) << 9) |
+             ((np.asarray(lf_amp).astype(np.uint64) & 0x3FF) << 10) |
+             ((np.asarray(hf_freq).astype(np.uint64) & 0x1FF) << 20) |
+             (np.asarray(hf_en_tone).astype(np.uint64) << 29) |
+             ((np.asarray(hf_amp).astype(np.uint64) & 0x3FF) << 30))
+    return value.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :5]
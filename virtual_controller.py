@@ -1,64 +1,138 @@
-import vgamepad
 import asyncio
-import threading
 import ctypes
-import vgamepad.win.vigem_commons as vcom
+import time
+from typing import TYPE_CHECKING
 from controller import Controller, ControllerInputData, VibrationData
-from config import CONFIG, ButtonConfig
+from config import Config, get_config
 import logging
 
 logger = logging.getLogger(__name__)
 
+# vgamepad loads the ViGEm client library when imported, it is imported when the first virtual controller is created
+if TYPE_CHECKING:
+    import vgamepad
+    import vgamepad.win.vigem_commons as vcom
+else:
+    vgamepad = None
+    vcom = None
+
+def load_vgamepad():
+    global vgamepad, vcom
+    if vgamepad is None:
+        import vgamepad.win.vigem_commons as vcom
+        import vgamepad
+
+MAX_VIRTUAL_CONTROLLERS = 8
+
+# Sides of combined joycons that updated the current frame
+SIDE_LEFT = 0x1
+SIDE_RIGHT = 0x2
+SIDE_BOTH = SIDE_LEFT | SIDE_RIGHT
+
+# Vibration commands need to be repeated for the controller to keep vibrating
+VIBRATION_REFRESH_INTERVAL = 0.02
+# Limit for how long we vibrate if we don't receive any command, just in case
+VIBRATION_TIMEOUT = 10
+
+class VibrationDispatcher:
+    """Sends the latest vibration state of a virtual controller to its controllers.
+    Runs as a single task on the event loop owning the controllers bleak clients
+    """
+    def __init__(self, virtual_controller: "VirtualController"):
+        self.virtual_controller = virtual_controller
+        self.loop = asyncio.get_running_loop()
+        self.vibration: VibrationData = None
+        self.last_update_time = 0
+        self.new_vibration_event = asyncio.Event()
+        self.pending = False
+        self.writes = 0
+        self.coalesced = 0
+        self.task = self.loop.create_task(self.run())
+
+    def update_threadsafe(self, vibration: VibrationData):
+        """Can be called from any thread"""
+        try:
+            self.loop.call_soon_threadsafe(self.update, vibration)
+        except RuntimeError:
+            # Loop already closed
+            pass
+
+    def update(self, vibration: VibrationData):
+        if self.pending:
+            # previous state was never sent
+            self.coalesced += 1
+        self.vibration = vibration
+        self.pending = True
+        self.last_update_time = self.loop.time()
+        self.new_vibration_event.set()
+
+    async def run(self):
+        while True:
+            await self.new_vibration_event.wait()
+            while True:
+                self.new_vibration_event.clear()
+                vibration = self.vibration
+                self.pending = False
+                await self.send(vibration)
+
+                if vibration.lf_amp == 0 and vibration.hf_amp == 0:
+                    # No Need to send command repeatedly
+                    break
+                if self.loop.time() - self.last_update_time > VIBRATION_TIMEOUT:
+                    logger.debug("Vibration timeout")
+                    break
+                try:
+                    await asyncio.wait_for(self.new_vibration_event.wait(), VIBRATION_REFRESH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            logger.debug(f"Vibration stopped, {self.writes} writes, {self.coalesced} updates coalesced")
+
+    async def send(self, vibration: VibrationData):
+        results = await asyncio.gather(*(c.set_vibration(vibration) for c in self.virtual_controller.controllers if c.is_connected()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.debug(f"Unable to send vibration : {result}")
+        self.writes += 1
+
+    def stop(self):
+        self.task.cancel()
+
 class VirtualController:
     player_number: int
     controllers: list[Controller]
-    xb_controller: vgamepad.VDS4Gamepad
+    xb_controller: "vgamepad.VDS4Gamepad"
     previous_buttons_left: int
     previous_buttons_right: int
-    next_vibration_event: asyncio.Event
+    vibration_dispatcher: VibrationDispatcher
+    last_report_bytes: bytes
+    last_report_time: float
+    submitted_reports: int
+    suppressed_reports: int
+    report_ex: "vcom.DS4_REPORT_EX"
+    report: "vcom.DS4_SUB_REPORT_EX"
+    updated_sides: int
+    frame_clock_task: asyncio.Task
 
     def __init__(self, player_number: int):
+        """Needs to be created from the event loop the controllers are connected on"""
+        load_vgamepad()
         self.player_number = player_number
         self.controllers = []
         self.xb_controller = vgamepad.VDS4Gamepad()
         self.previous_buttons_left = 0x00000000
         self.previous_buttons_right = 0x00000000
-        self.next_vibration_event = None
+        self.vibration_dispatcher = VibrationDispatcher(self)
+        self.last_report_bytes = None
+        self.last_report_time = 0
+        self.submitted_reports = 0
+        self.suppressed_reports = 0
+        self.reset_report()
+        frame_interval = get_config().frame_interval
+        self.frame_clock_task = asyncio.get_running_loop().create_task(self.run_frame_clock(frame_interval)) if frame_interval else None
 
         def vibration_callback(client, target, large_motor, small_motor, led_number, user_data):
                 logger.debug("Vibration : {}, {}".format(large_motor, small_motor))
-                vibrationData = VibrationData()
-                vibrationData.lf_amp = int(800 * large_motor / 256)
-                vibrationData.hf_amp = int(800 * small_motor / 256)
-
-                if self.next_vibration_event:
-                    # Notifify previous call to stop sending vibration commands
-                    self.next_vibration_event.set()
-                    self.next_vibration_event = None
-
-                next_event = asyncio.Event()
-                if large_motor == 0 and small_motor == 0:
-                    # No Need to send command repeatedly
-                    next_event.set()
-                else:
-                    self.next_vibration_event = next_event
-
-                async def send_vibration_task():
-                    # imit for how long we vibrate if we don't receive any command, just in case
-                    for i in range(500):
-                        if self.is_single():
-                            await self.controllers[0].set_vibration(vibrationData)
-                        elif len(self.controllers) == 2:
-                            await asyncio.gather(self.controllers[0].set_vibration(vibrationData), self.controllers[1].set_vibration(vibrationData))
-                        await asyncio.sleep(0.02)
-                        if next_event.is_set():
-                            break
-
-                def run_async_loop_in_thread():
-                    asyncio.run(send_vibration_task())
-
-                t = threading.Thread(target=run_async_loop_in_thread)
-                t.start()
+                self.vibration_dispatcher.update_threadsafe(VibrationData.from_rumble(large_motor, small_motor))
 
         self.xb_controller.register_notification(callback_function=vibration_callback)
 
@@ -77,86 +151,146 @@ class VirtualController:
                 raise Exception("Can only combine left and right joycons")
             
         self.controllers.append(controller)
+        # The layout changes when combining joycons
+        self.reset_report()
 
     async def init_added_controller(self, controller: Controller):
         """This async method needs to be called after calling add_controller"""
         
         await self.update_leds()
 
-        def input_report_callback(inputData: ControllerInputData, controller: Controller):
-            buttons = inputData.buttons
-            # print(f"Raw data: {inputData.raw_data[0:].hex(' ')}")
-
-            if not self.is_single():
-                buttonsConfig = CONFIG.dual_joycons_config
-                # In case of 2 joycons, we need to merge the left and right buttons input
-                if controller.is_joycon_left():
-                    buttons |= self.previous_buttons_right
-                    self.previous_buttons_left = inputData.buttons
-                elif controller.is_joycon_right():
-                    buttons |= self.previous_buttons_left
-                    self.previous_buttons_right = inputData.buttons
-            elif controller.is_joycon_left():
-                buttonsConfig = CONFIG.single_joycon_l_config
-            elif controller.is_joycon_right():
-                buttonsConfig = CONFIG.single_joycon_r_config
-            else:
-                buttonsConfig = CONFIG.procon_config
-
-            report = vcom.DS4_SUB_REPORT_EX()
-
-            report.wButtons, report.bSpecial, dpad_direction, left_trigger, right_trigger = buttonsConfig.convert_buttons(buttons)
-            vcom.DS4_SET_DPAD(report, dpad_direction)
-            report.bTriggerL = 255 if left_trigger else 0
-            report.bTriggerR = 255 if right_trigger else 0
-            if controller.is_joycon_right() and self.is_single():
-                report.bThumbRX = 128 + round(inputData.right_stick[1] * 127)
-                report.bThumbRY = 128 + round(inputData.right_stick[0] * 127)
-                # self.xb_controller.left_joystick_float(inputData.right_stick[1], -inputData.right_stick[0])
-
-            elif controller.is_joycon_left() and self.is_single():
-                report.bThumbLX = 128 + round(-inputData.left_stick[1] * 127)
-                report.bThumbLY = 128 + round(-inputData.left_stick[0] * 127)
-                # self.xb_controller.left_joystick_float(-inputData.left_stick[1], inputData.left_stick[0])
+        def input_report_callback(inputData: ControllerInputData, controller: Controller, config: Config):
+            side = SIDE_LEFT if controller.is_joycon_left() else SIDE_RIGHT
+            self.update_report(inputData, controller, config)
+            controller.input_latency.mark("mapping")
+
+            if self.frame_clock_task is None:
+                # A report from a side that already updated the current frame means the frame is complete
+                if self.is_single() or self.updated_sides & side or self.updated_sides | side == SIDE_BOTH:
+                    self.submit_report(config.max_report_interval)
+                    self.updated_sides = 0
+                else:
+                    self.updated_sides |= side
             else:
-                if not controller.is_joycon_left(): # dual stick or joycon right (dual)
-                    report.bThumbRX = 128 + round(inputData.right_stick[0] * 127)
-                    report.bThumbRY = 128 + round(-inputData.right_stick[1] * 127)
-                    # self.xb_controller.right_joystick_float(inputData.right_stick[0], -inputData.right_stick[1])
-                if not controller.is_joycon_right(): # dual stick or joycon left (dual)
-                    report.bThumbLX = 128 + round(inputData.left_stick[0] * 127)
-                    report.bThumbLY = 128 + round(-inputData.left_stick[1] * 127)
-                    # self.xb_controller.left_joystick_float(inputData.left_stick[0], -inputData.left_stick[1])
-            
-            # Motion Controls 
+                self.updated_sides |= side
+            controller.input_latency.mark("virtual_controller")
+
+        controller.set_input_report_callback(input_report_callback)
+
+
+    def update_report(self, inputData: ControllerInputData, controller: Controller, config: Config):
+        """Update the fused state of the virtual controller with the fields this controller provides"""
+        report = self.report
+        buttons = inputData.buttons
+        # print(f"Raw data: {inputData.raw_data[0:].hex(' ')}")
+
+        if not self.is_single():
+            buttonsConfig = config.dual_joycons_config
+            # In case of 2 joycons, we need to merge the left and right buttons input
+            if controller.is_joycon_left():
+                buttons |= self.previous_buttons_right
+                self.previous_buttons_left = inputData.buttons
+            elif controller.is_joycon_right():
+                buttons |= self.previous_buttons_left
+                self.previous_buttons_right = inputData.buttons
+        elif controller.is_joycon_left():
+            buttonsConfig = config.single_joycon_l_config
+        elif controller.is_joycon_right():
+            buttonsConfig = config.single_joycon_r_config
+        else:
+            buttonsConfig = config.procon_config
+
+        report.wButtons, report.bSpecial, dpad_direction, left_trigger, right_trigger = buttonsConfig.convert_buttons(buttons)
+        vcom.DS4_SET_DPAD(report, dpad_direction)
+        report.bTriggerL = 255 if left_trigger else 0
+        report.bTriggerR = 255 if right_trigger else 0
+        # Stick calibration tables directly give the DS4 axis values
+        if controller.is_joycon_right() and self.is_single():
+            x, y = inputData.right_stick_raw
+            calibration = inputData.right_stick_calibration
+            report.bThumbRX = calibration.y_ds4[y]
+            report.bThumbRY = calibration.x_ds4[x]
+            # self.xb_controller.left_joystick_float(inputData.right_stick[1], -inputData.right_stick[0])
+
+        elif controller.is_joycon_left() and self.is_single():
+            x, y = inputData.left_stick_raw
+            calibration = inputData.left_stick_calibration
+            report.bThumbLX = calibration.y_ds4_inverted[y]
+            report.bThumbLY = calibration.x_ds4_inverted[x]
+            # self.xb_controller.left_joystick_float(-inputData.left_stick[1], inputData.left_stick[0])
+        else:
+            if not controller.is_joycon_left(): # dual stick or joycon right (dual)
+                x, y = inputData.right_stick_raw
+                calibration = inputData.right_stick_calibration
+                report.bThumbRX = calibration.x_ds4[x]
+                report.bThumbRY = calibration.y_ds4_inverted[y]
+                # self.xb_controller.right_joystick_float(inputData.right_stick[0], -inputData.right_stick[1])
+            if not controller.is_joycon_right(): # dual stick or joycon left (dual)
+                x, y = inputData.left_stick_raw
+                calibration = inputData.left_stick_calibration
+                report.bThumbLX = calibration.x_ds4[x]
+                report.bThumbLY = calibration.y_ds4_inverted[y]
+                # self.xb_controller.left_joystick_float(inputData.left_stick[0], -inputData.left_stick[1])
+
+        # Motion Controls, only from the right joycon when combined
+        if self.is_single() or not controller.is_joycon_left():
             report.wAccelX = inputData.accelerometer[0] * 2
             report.wAccelY = inputData.accelerometer[2] * 2
             report.wAccelZ = -inputData.accelerometer[1] * 2
-            report.wGyroX = inputData.gyroscope[0]
-            report.wGyroY = inputData.gyroscope[2]
-            report.wGyroZ = -inputData.gyroscope[1]
-
-            ex = vcom.DS4_REPORT_EX(Report=report)
+            # Gyroscope with its bias removed, when estimated
+            gyroscope = controller.motion_estimator.corrected_gyroscope if controller.motion_estimator is not None else inputData.gyroscope
+            report.wGyroX = gyroscope[0]
+            report.wGyroY = gyroscope[2]
+            report.wGyroZ = -gyroscope[1]
             # print(f"X: {report.wAccelX}, Y: {report.wAccelY}, Z: {report.wAccelZ}, X: {report.wGyroX}, Y: {report.wGyroY}, Z: {report.wGyroZ}")
 
-            self.xb_controller.update_extended_report(ex)
+    def submit_report(self, max_report_interval: float):
+        """Send the fused state to the virtual controller, unless nothing changed since last time"""
+        # Skip the driver call when nothing changed, but still refresh periodically
+        report_bytes = bytes(self.report_ex)
+        now = time.perf_counter()
+        if report_bytes != self.last_report_bytes or now - self.last_report_time >= max_report_interval:
+            self.xb_controller.update_extended_report(self.report_ex)
+            self.last_report_bytes = report_bytes
+            self.last_report_time = now
+            self.submitted_reports += 1
+        else:
+            self.suppressed_reports += 1
 
-        controller.set_input_report_callback(input_report_callback)
+    def reset_report(self):
+        self.report_ex = vcom.DS4_REPORT_EX()
+        # Shares the memory of report_ex
+        self.report = self.report_ex.Report
+        self.report.bThumbLX = self.report.bThumbLY = self.report.bThumbRX = self.report.bThumbRY = 128
+        vcom.DS4_SET_DPAD(self.report, 0x8)
+        self.updated_sides = 0
 
+    async def run_frame_clock(self, frame_interval: float):
+        """Submit the fused state at a fixed rate, instead of when receiving reports"""
+        while True:
+            await asyncio.sleep(frame_interval)
+            if self.updated_sides:
+                self.updated_sides = 0
+                self.submit_report(get_config().max_report_interval)
 
     async def update_leds(self):
-        for controller in self.controllers:
-            await controller.set_leds(self.player_number, reversed=self.is_single_joycon_right())
+        await asyncio.gather(*(controller.set_leds(self.player_number, reversed=self.is_single_joycon_right()) for controller in self.controllers if controller.is_connected()))
 
     async def remove_controller(self, controller: Controller):
         """Returns True if this was the last controller
         """
         if controller in self.controllers:
             self.controllers.remove(controller)
+            self.previous_buttons_left = 0x00000000
+            self.previous_buttons_right = 0x00000000
+            self.reset_report()
 
             await self.update_leds()
 
             if len(self.controllers) == 0:
+                self.vibration_dispatcher.stop()
+                if self.frame_clock_task is not None:
+                    self.frame_clock_task.cancel()
                 del self.xb_controller
                 return True
 
@@ -168,3 +302,23 @@ class VirtualController:
     
     def is_single(self):
         return len(self.controllers) == 1
+
+
+def assign_virtual_controller(virtual_controllers: list[VirtualController], controller: Controller):
+    """Add <controller> to an existing virtual controller it can be combined with, or to a new one in the first empty slot of <virtual_controllers>"""
+    virtual_controller = None
+    if get_config().combine_joycons and not controller.side_buttons_pressed:
+        # try to find an already connected joycon to combine with
+        if controller.is_joycon_left():
+            virtual_controller = next(filter(lambda vc: vc is not None and vc.is_single_joycon_right(), virtual_controllers), None)
+        elif controller.is_joycon_right():
+            virtual_controller = next(filter(lambda vc: vc is not None and vc.is_single_joycon_left(), virtual_controllers), None)
+
+    if virtual_controller is None:
+        # Find an emtpy slot
+        slot_index = next(i for i, c in enumerate(virtual_controllers) if c == None)
+        virtual_controller = VirtualController(slot_index+1)
+        virtual_controllers[slot_index] = virtual_controller
+
+    virtual_controller.add_controller(controller)
+    return virtual_controller